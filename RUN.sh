@@ -7,10 +7,17 @@ docker build -t aws-athena-tool .
 rm -rf .aws
 
 if [ "$1" == "wizard" ]; then
-    docker run -it --rm aws-athena-tool python main.py wizard
+    docker run -it --rm -v aws-athena-tool-cache:/root/.cache/aws-athena-tool aws-athena-tool python main.py wizard
 elif [ "$1" == "arguments" ]; then
     shift
-    docker run -it --rm aws-athena-tool python main.py $@
+    docker run -it --rm -v aws-athena-tool-cache:/root/.cache/aws-athena-tool aws-athena-tool python main.py $@
+elif [ "$1" == "history" ]; then
+    docker run -it --rm -v aws-athena-tool-cache:/root/.cache/aws-athena-tool aws-athena-tool python main.py history
+elif [ "$1" == "daemon" ]; then
+    docker run -it --rm -v aws-athena-tool-cache:/root/.cache/aws-athena-tool -v /tmp:/tmp aws-athena-tool python main.py daemon
+elif [ "$1" == "client" ]; then
+    shift
+    docker run -i --rm -v aws-athena-tool-cache:/root/.cache/aws-athena-tool aws-athena-tool python main.py client $@
 else
-    echo "Usage: ./RUN.sh [wizard|argument] [arguments...]"
+    echo "Usage: ./RUN.sh [wizard|argument|history|daemon|client] [arguments...]"
 fi
\ No newline at end of file
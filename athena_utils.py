@@ -1,135 +1,251 @@
+from client_pool import get_client
+from query_poller import QueryPoller
+from table_catalog import TableCatalog
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import re
+
+# Days Athena can project for partitioned tables, relative so long-lived tables never need updating
+PROJECTION_RANGE = 'NOW-1YEARS,NOW'
+
+# Shared with the local query engine so both parse the logs the same way
+CLOUDFRONT_COLUMNS = [
+    ('date', 'DATE'),
+    ('time', 'STRING'),
+    ('x_edge_location', 'STRING'),
+    ('sc_bytes', 'BIGINT'),
+    ('c_ip', 'STRING'),
+    ('cs_method', 'STRING'),
+    ('cs_host', 'STRING'),
+    ('cs_uri_stem', 'STRING'),
+    ('sc_status', 'INT'),
+    ('cs_referrer', 'STRING'),
+    ('cs_user_agent', 'STRING'),
+    ('cs_uri_query', 'STRING'),
+    ('cs_cookie', 'STRING'),
+    ('x_edge_result_type', 'STRING'),
+    ('x_edge_request_id', 'STRING'),
+    ('x_host_header', 'STRING'),
+    ('cs_protocol', 'STRING'),
+    ('cs_bytes', 'BIGINT'),
+    ('time_taken', 'FLOAT'),
+    ('x_forwarded_for', 'STRING'),
+    ('ssl_protocol', 'STRING'),
+    ('ssl_cipher', 'STRING'),
+    ('x_edge_response_result_type', 'STRING'),
+    ('cs_protocol_version', 'STRING'),
+    ('fle_status', 'STRING'),
+    ('fle_encrypted_fields', 'INT'),
+    ('c_port', 'INT'),
+    ('time_to_first_byte', 'FLOAT'),
+    ('x_edge_detailed_result_type', 'STRING'),
+    ('sc_content_type', 'STRING'),
+    ('sc_content_len', 'BIGINT'),
+    ('sc_range_start', 'BIGINT'),
+    ('sc_range_end', 'BIGINT'),
+]
+
+ELBV2_COLUMNS = [
+    ('type', 'string'),
+    ('time', 'string'),
+    ('elb', 'string'),
+    ('client_ip', 'string'),
+    ('client_port', 'int'),
+    ('target_ip', 'string'),
+    ('target_port', 'int'),
+    ('request_processing_time', 'double'),
+    ('target_processing_time', 'double'),
+    ('response_processing_time', 'double'),
+    ('elb_status_code', 'int'),
+    ('target_status_code', 'string'),
+    ('received_bytes', 'bigint'),
+    ('sent_bytes', 'bigint'),
+    ('request_verb', 'string'),
+    ('request_url', 'string'),
+    ('request_proto', 'string'),
+    ('user_agent', 'string'),
+    ('ssl_cipher', 'string'),
+    ('ssl_protocol', 'string'),
+    ('target_group_arn', 'string'),
+    ('trace_id', 'string'),
+    ('domain_name', 'string'),
+    ('chosen_cert_arn', 'string'),
+    ('matched_rule_priority', 'string'),
+    ('request_creation_time', 'string'),
+    ('actions_executed', 'string'),
+    ('redirect_url', 'string'),
+    ('lambda_error_reason', 'string'),
+    ('target_port_list', 'string'),
+    ('target_status_code_list', 'string'),
+    ('classification', 'string'),
+    ('classification_reason', 'string'),
+    ('traceability_id', 'string'),
+]
+
+ELBV2_INPUT_REGEX = r'([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) "([^ ]*) (.*) (- |[^ ]*)" "([^"]*)" ([A-Z0-9-_]+) ([A-Za-z0-9.-]*) ([^ ]*) "([^"]*)" "([^"]*)" "([^"]*)" ([-.0-9]*) ([^ ]*) "([^"]*)" "([^"]*)" "([^ ]*)" "([^\s]+?)" "([^\s]+)" "([^ ]*)" "([^ ]*)" ?([^ ]*)?( .*)?'
 
 class AthenaManager:
-    def __init__(self, session, athena_database='aws-athena-tool', athena_table='aws-athena-tool'):
+    def __init__(self, session, athena_database='aws-athena-tool', athena_table='aws-athena-tool', partition_projection=True, table_catalog=None):
         self.session = session
+        self.table_catalog = table_catalog or TableCatalog(session)
         self.athena_database = athena_database
         self.today = datetime.today()
-        self.athena_table = athena_table + f"_{self.today.strftime('%Y%m%d')}"
+        self.partition_projection = partition_projection
+        if partition_projection:
+            self.athena_table = athena_table
+        else:
+            self.athena_table = athena_table + f"_{self.today.strftime('%Y%m%d')}"
         self.athena_bucket = ''
         self.log_prefix = ''
+        self.table_location = ''
+        self.partition_column = None
+        self.table_columns = []
+        self.table_ddl = None
+
+    def execute_ddl(self, query):
+        athena_client = get_client(self.session, 'athena')
+        query_execution_id = athena_client.start_query_execution(QueryString=query,
+                                                                 ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"})['QueryExecutionId']
+        query_execution = QueryPoller(athena_client).wait(query_execution_id, progress=False)
+        if query_execution['Status']['State'] != 'SUCCEEDED':
+            raise RuntimeError(query_execution['Status'].get('StateChangeReason') or query_execution['Status']['State'])
 
     def create_athena_database(self):
-        print("Creating Athena database...")
-        athena_client = self.session.client('athena')
         try:
-            athena_client.start_query_execution(QueryString=f"CREATE DATABASE IF NOT EXISTS `{self.athena_database}`",
-                                                ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"})
+            if self.table_catalog.database_exists(self.athena_database):
+                return True
+            print("Creating Athena database...")
+            self.execute_ddl(f"CREATE DATABASE IF NOT EXISTS `{self.athena_database}`")
+            self.table_catalog.database_created(self.athena_database)
             print(f"\033[92mAthena database {self.athena_database} created successfully.\033[0m")
+            return True
         except Exception as e:
             print(f"Error creating Athena database: {e}")
+            return False
+
+    def get_column_definitions(self, columns):
+        return ",\n                    ".join(f"`{name}` {column_type}" for name, column_type in columns)
+
+    def get_table_suffix(self, selected_resource):
+        # ELB ARNs end in app/NAME/ID, keep the name so the table does not change between manual and scanned selection
+        if selected_resource.startswith('arn:'):
+            selected_resource = selected_resource.split('/')[-2]
+        return re.sub(r'[^a-z0-9_]', '_', selected_resource.lower())
+
+    def get_projection_properties(self, location_template):
+        return f"""
+                    'projection.enabled' = 'true',
+                    'projection.{self.partition_column}.type' = 'date',
+                    'projection.{self.partition_column}.range' = '{PROJECTION_RANGE}',
+                    'projection.{self.partition_column}.format' = 'yyyy/MM/dd',
+                    'projection.{self.partition_column}.interval' = '1',
+                    'projection.{self.partition_column}.interval.unit' = 'DAYS',
+                    'storage.location.template' = '{location_template}${{{self.partition_column}}}/'"""
+
+    def get_table_location(self, bucket_name, log_type, dated_layout=False):
+        if log_type == 'cloudfront' and not self.partition_projection:
+            return f"s3://{bucket_name}/"
+        if log_type == 'cloudfront' and not dated_layout:
+            # Legacy delivery writes flat files, so the table can only be narrowed down to the log prefix folder
+            log_folder = self.log_prefix.rpartition('/')[0]
+            return f"s3://{bucket_name}/{log_folder}/" if log_folder else f"s3://{bucket_name}/"
+        return f"s3://{bucket_name}/{self.log_prefix}/"
 
-    def create_athena_table(self, bucket_name, selected_resource, log_type):
-        print("Creating Athena table...")
-        athena_client = self.session.client('athena')
+    def create_athena_table(self, bucket_name, selected_resource, log_type, dated_layout=False):
+        self.define_athena_table(bucket_name, selected_resource, log_type, dated_layout)
+        return self.ensure_athena_table()
+
+    def define_athena_table(self, bucket_name, selected_resource, log_type, dated_layout=False):
         try:
+            s3_full_path = self.get_table_location(bucket_name, log_type, dated_layout)
             if log_type == 'cloudfront':
-                self.athena_table = "cloudfront_logs"
-                s3_full_path = f"s3://{bucket_name}/"
+                partitioned_by = ''
+                table_properties = ''
+                if not self.partition_projection:
+                    self.athena_table = "cloudfront_logs"
+                elif dated_layout:
+                    self.athena_table = f"cloudfront_logs_{self.get_table_suffix(selected_resource)}"
+                    self.partition_column = 'dt'
+                    partitioned_by = f"PARTITIONED BY (`{self.partition_column}` STRING)"
+                    table_properties = "," + self.get_projection_properties(s3_full_path)
+                else:
+                    self.athena_table = f"cloudfront_logs_{self.get_table_suffix(selected_resource)}"
+                    print(f"\033[93mCloudFront logs are not delivered in date folders, queries will scan {s3_full_path}\033[0m")
                 query = f"""
-                CREATE EXTERNAL TABLE IF NOT EXISTS `{self.athena_database}`.`cloudfront_logs` (
-                    `date` DATE,
-                    time STRING,
-                    x_edge_location STRING,
-                    sc_bytes BIGINT,
-                    c_ip STRING,
-                    cs_method STRING,
-                    cs_host STRING,
-                    cs_uri_stem STRING,
-                    sc_status INT,
-                    cs_referrer STRING,
-                    cs_user_agent STRING,
-                    cs_uri_query STRING,
-                    cs_cookie STRING,
-                    x_edge_result_type STRING,
-                    x_edge_request_id STRING,
-                    x_host_header STRING,
-                    cs_protocol STRING,
-                    cs_bytes BIGINT,
-                    time_taken FLOAT,
-                    x_forwarded_for STRING,
-                    ssl_protocol STRING,
-                    ssl_cipher STRING,
-                    x_edge_response_result_type STRING,
-                    cs_protocol_version STRING,
-                    fle_status STRING,
-                    fle_encrypted_fields INT,
-                    c_port INT,
-                    time_to_first_byte FLOAT,
-                    x_edge_detailed_result_type STRING,
-                    sc_content_type STRING,
-                    sc_content_len BIGINT,
-                    sc_range_start BIGINT,
-                    sc_range_end BIGINT
+                CREATE EXTERNAL TABLE IF NOT EXISTS `{self.athena_database}`.`{self.athena_table}` (
+                    {self.get_column_definitions(CLOUDFRONT_COLUMNS)}
                     )
+                    {partitioned_by}
                     ROW FORMAT DELIMITED 
                     FIELDS TERMINATED BY '\\t'
                     LOCATION '{s3_full_path}'
-                    TBLPROPERTIES ( 'skip.header.line.count'='2' )
+                    TBLPROPERTIES ( 'skip.header.line.count'='2'{table_properties} )
                     """
+                self.table_columns = CLOUDFRONT_COLUMNS
             elif log_type == 'elbv2':
-                self.athena_table = f"{self.athena_table}_{selected_resource}"
-                s3_full_path = f"s3://{bucket_name}/{self.log_prefix}/"
+                partitioned_by = ''
+                table_properties = ''
+                if self.partition_projection:
+                    self.athena_table = f"{self.athena_table}_{self.get_table_suffix(selected_resource)}"
+                    self.partition_column = 'day'
+                    partitioned_by = f"PARTITIONED BY (`{self.partition_column}` STRING)"
+                    table_properties = f"TBLPROPERTIES ({self.get_projection_properties(s3_full_path)}\n                    )"
+                else:
+                    self.athena_table = f"{self.athena_table}_{selected_resource}"
                 query = f"""
                 CREATE EXTERNAL TABLE IF NOT EXISTS `{self.athena_database}`.`{self.athena_table}` (
-                    type string,
-                    time string,
-                    elb string,
-                    client_ip string,
-                    client_port int,
-                    target_ip string,
-                    target_port int,
-                    request_processing_time double,
-                    target_processing_time double,
-                    response_processing_time double,
-                    elb_status_code int,
-                    target_status_code string,
-                    received_bytes bigint,
-                    sent_bytes bigint,
-                    request_verb string,
-                    request_url string,
-                    request_proto string,
-                    user_agent string,
-                    ssl_cipher string,
-                    ssl_protocol string,
-                    target_group_arn string,
-                    trace_id string,
-                    domain_name string,
-                    chosen_cert_arn string,
-                    matched_rule_priority string,
-                    request_creation_time string,
-                    actions_executed string,
-                    redirect_url string,
-                    lambda_error_reason string,
-                    target_port_list string,
-                    target_status_code_list string,
-                    classification string,
-                    classification_reason string,
-                    traceability_id string
+                    {self.get_column_definitions(ELBV2_COLUMNS)}
                     )
+                    {partitioned_by}
                     ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.RegexSerDe'
                     WITH SERDEPROPERTIES (
                     'serialization.format' = '1',
                     'input.regex' = 
-                '([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) (.*) (- |[^ ]*)\" \"([^\"]*)\" ([A-Z0-9-_]+) ([A-Za-z0-9.-]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^\"]*)\" ([-.0-9]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^ ]*)\" \"([^\s]+?)\" \"([^\s]+)\" \"([^ ]*)\" \"([^ ]*)\" ?([^ ]*)?( .*)?')
-                    LOCATION '{s3_full_path}';
+                '{ELBV2_INPUT_REGEX}')
+                    LOCATION '{s3_full_path}'
+                    {table_properties};
                 """
+                self.table_columns = ELBV2_COLUMNS
 
-            athena_client.start_query_execution(QueryString=query,
-                                                ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"})
-            if log_type == 'cloudfront':
-                print(f"\033[92mAthena table cloudfront_logs created successfully.\033[0m")
-            elif log_type == 'elbv2':
-                print(f"\033[92mAthena table {self.athena_table} created successfully.\033[0m")
+            self.table_location = s3_full_path
+            self.table_ddl = query
+        except Exception as e:
+            print(f"Error defining Athena table: {e}")
+
+    def ensure_athena_table(self):
+        if not self.table_ddl:
+            return False
+        partition_keys = [self.partition_column] if self.partition_column else []
+        try:
+            state = self.table_catalog.get_table_state(self.athena_database, self.athena_table, self.table_location, self.table_columns, partition_keys)
+            if state == 'current':
+                print(f"\033[92mAthena table {self.athena_table} is up to date.\033[0m")
+                return True
+            if state == 'different':
+                # CREATE ... IF NOT EXISTS would keep the old definition, dropping an external table leaves the logs in place
+                print(f"\033[93mAthena table {self.athena_table} has another location or schema, recreating it.\033[0m")
+                self.execute_ddl(f"DROP TABLE IF EXISTS `{self.athena_database}`.`{self.athena_table}`")
+            print(f"Creating Athena table {self.athena_table}...")
+            self.execute_ddl(self.table_ddl)
+            self.table_catalog.table_created(self.athena_database, self.athena_table, self.table_location, self.table_columns, partition_keys)
+            print(f"\033[92mAthena table {self.athena_table} created successfully.\033[0m")
+            return True
         except Exception as e:
             print(f"Error creating Athena table: {e}")
+            return False
+
+    def create_in_background(self):
+        # The DDL runs while the user picks a query, the query executor waits for it before running the first one
+        executor = ThreadPoolExecutor(max_workers=1)
+        table_ready = executor.submit(lambda: self.create_athena_database() and self.ensure_athena_table())
+        executor.shutdown(wait=False)
+        return table_ready
 
     def delete_athena_table(self):
         print("Deleting Athena table...")
-        athena_client = self.session.client('athena')
         try:
-            athena_client.start_query_execution(QueryString=f"DROP TABLE IF EXISTS `{self.athena_database}`.`{self.athena_table}`",
-                                                ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"})
+            self.execute_ddl(f"DROP TABLE IF EXISTS `{self.athena_database}`.`{self.athena_table}`")
+            self.table_catalog.forget(self.athena_database, self.athena_table)
             print(f"\033[92mAthena table {self.athena_table} deleted successfully.\033[0m")
         except Exception as e:
             print(f"Error deleting Athena table: {e}")
\ No newline at end of file
@@ -1,33 +1,75 @@
 import boto3
 import botocore
-import subprocess
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+from datetime import datetime
 from logger import Logger
+from client_pool import get_client
+
+class SessionExpiredError(Exception):
+    pass
 
 class AWSAuthenticator:
-    def __init__(self, region):
+    def __init__(self, region, credential_cache=None):
         self.session = ''
         self.region = region
         self.account_id = ''
         self.logger = Logger()
+        self.credential_cache = credential_cache
 
     def get_aws_profiles(self):
         try:
-            result = subprocess.run(['aws', 'configure', 'list-profiles'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if result.returncode != 0:
-                raise Exception("AWS CLI returned an error")
-            profiles = result.stdout.decode('utf-8').split()
-            return profiles
+            # Read from ~/.aws/config and ~/.aws/credentials by botocore, no AWS CLI process is started
+            return list(botocore.session.Session().available_profiles)
         except Exception as e:
             self.logger.log(f"Error getting AWS profiles: {e}", "red")
             return ["default"]
 
+    def create_session(self, profile, region, credentials=None):
+        if not credentials:
+            return boto3.Session(profile_name=profile, region_name=region)
+        metadata = {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+        # Botocore calls expire_session when the credentials run out, every client of the session stops with SessionExpiredError
+        refreshable_credentials = RefreshableCredentials.create_from_metadata(metadata, lambda: self.expire_session(profile, region), 'aws-athena-tool-cache')
+        # The profile name is kept so caches keyed by profile tell accounts apart
+        botocore_session = botocore.session.Session(profile=profile)
+        botocore_session._credentials = refreshable_credentials
+        return boto3.Session(botocore_session=botocore_session, region_name=region)
+
+    def expire_session(self, profile, region):
+        # Temporary credentials only come from the MFA prompt. A token obtained without MFA would be refused where the policies
+        # require MFA, so the entry is removed and the next run asks for a new code
+        if self.credential_cache:
+            self.credential_cache.remove(profile, region)
+        raise SessionExpiredError(f"The MFA session of {profile} in {region} has expired, run the tool again to enter a new MFA code.")
+
+    def load_cached_session(self, profile, region):
+        entry = self.credential_cache.get(profile, region) if self.credential_cache else None
+        if not entry:
+            return False
+        credentials = entry['credentials']
+        if credentials:
+            credentials = dict(credentials, Expiration=datetime.fromisoformat(entry['expiration']))
+        self.session = self.create_session(profile, region, credentials)
+        self.account_id = entry['account_id']
+        self.logger.log(f"Using cached AWS authentication of {profile} in {region} (account {self.account_id}).", "green")
+        return True
+
     def authenticate_with_mfa(self, profile, region):
+        if self.load_cached_session(profile, region):
+            return
         self.session = boto3.Session(profile_name=profile, region_name=region)
-        sts_client = self.session.client('sts')
+        sts_client = get_client(self.session, 'sts')
         while True:
             try:
-                sts_client.get_caller_identity()
                 self.account_id = sts_client.get_caller_identity()['Account']
+                if self.credential_cache:
+                    self.credential_cache.put(profile, region, self.account_id)
                 break
             except botocore.exceptions.ParamValidationError as e:
                 self.logger.log("Invalid MFA code. Make sure the MFA code is correct.", "red")
@@ -46,10 +88,10 @@ class AWSAuthenticator:
                             mfa_code = input("Enter MFA code: ")
                             mfa_token = input("Enter MFA token: ")
                             response = sts_client.get_session_token(DurationSeconds=3600, SerialNumber=mfa_serial, TokenCode=mfa_code)
-                            self.session = boto3.Session(aws_access_key_id=response['Credentials']['AccessKeyId'],
-                                                    aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                                                    aws_session_token=response['Credentials']['SessionToken'],
-                                                    region_name=region)
+                            self.session = self.create_session(profile, region, response['Credentials'])
+                            self.account_id = get_client(self.session, 'sts').get_caller_identity()['Account']
+                            if self.credential_cache:
+                                self.credential_cache.put(profile, region, self.account_id, response['Credentials'])
                             break
                     except botocore.exceptions.ClientError as e:
                         self.logger.log(f"Error authenticating with MFA: {e}", "red")
@@ -69,14 +111,10 @@ class AWSAuthenticator:
             if select_region == "y":
                 # check if region is valid
                 region = input("Enter the region: ")
+                # authenticate_with_mfa only returns once get_caller_identity succeeded in the new region
                 self.authenticate_with_mfa(selected_profile, region)
-                try:
-                    self.session.client('sts').get_caller_identity()
-                    self.region = region
-                    break
-                except botocore.exceptions.ClientError as e:
-                    self.logger.log(f"Error: {e}", "red")
-                    continue
+                self.region = region
+                break
             elif select_region == "n" or select_region == "":
                 self.authenticate_with_mfa(selected_profile, self.region)
                 break
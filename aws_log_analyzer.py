@@ -1,15 +1,28 @@
 import argparse
-from aws_auth import AWSAuthenticator
+from aws_auth import AWSAuthenticator, SessionExpiredError
+from credential_cache import CredentialCache
 from log_check import LogChecker
 from athena_utils import AthenaManager
 from query_executor import QueryExecutor
+from result_cache import ResultCache
+from query_history import QueryHistory, format_bytes
+from scan_estimator import ScanEstimator
+from parquet_compactor import ParquetCompactor, COMPRESSIONS
+from rollup_manager import RollupManager
+from local_engine import LocalQueryEngine
+from fleet_analyzer import FleetAnalyzer, FLEET_MAX_CONCURRENCY
+from query_rewriter import QueryRewriter
+from query_explorer import QueryExplorer, DEFAULT_SAMPLE_PERCENT
+from query_templates import QueryTemplates, VALUE_SEPARATOR
+from log_watcher import LogWatcher, DEFAULT_WATCH_INTERVAL, DEFAULT_WATCH_MINUTES
+from result_writer import OUTPUT_FORMATS
 from logger import Logger
-import re
+from startup_timer import startup_timer
 import sys
 
 class AWSLogAnalyzer:
-    def __init__(self, profile=None, region='eu-west-1', log_type=None, resource_choice=None, selected_resource=None, start_time=None, end_time=None, endpoint=None, min_status_code=None, max_status_code=None):
-        self.authenticator = AWSAuthenticator(region=region)
+    def __init__(self, profile=None, region='eu-west-1', log_type=None, resource_choice=None, selected_resource=None, start_time=None, end_time=None, endpoint=None, min_status_code=None, max_status_code=None, fetch_mode='auto', query_timeout=None, use_cache=True, cache_max_age=60, partition_projection=True, compact_range=None, compact_compression='ZSTD', compact_bucket_by=None, max_concurrency=5, discovery_ttl=3600, engine='athena', local_paths=None, output_format='table', use_credential_cache=True, query_scan_budget=None, session_scan_budget=None, scan_estimate=True, fleet=False, scan_regions=None, rollup=False, rollup_days=7, sample_percent=DEFAULT_SAMPLE_PERCENT, progressive=False, watch_interval=DEFAULT_WATCH_INTERVAL, watch_minutes=DEFAULT_WATCH_MINUTES):
+        self.authenticator = AWSAuthenticator(region=region, credential_cache=CredentialCache() if use_credential_cache else None)
         self.logger = Logger()
         self.profile = profile
         self.region = region
@@ -21,6 +34,35 @@ class AWSLogAnalyzer:
         self.endpoint = endpoint
         self.min_status_code = min_status_code
         self.max_status_code = max_status_code
+        self.fetch_mode = fetch_mode
+        self.query_timeout = query_timeout
+        self.use_cache = use_cache
+        self.cache_max_age = cache_max_age
+        self.partition_projection = partition_projection
+        self.compact_range = compact_range
+        self.compact_compression = compact_compression
+        self.compact_bucket_by = compact_bucket_by
+        self.max_concurrency = max_concurrency
+        self.discovery_ttl = discovery_ttl
+        self.resource_region = None
+        self.engine = engine
+        self.local_paths = local_paths or []
+        self.output_format = output_format
+        self.query_scan_budget = query_scan_budget
+        self.session_scan_budget = session_scan_budget
+        self.scan_estimate = scan_estimate
+        self.fleet = fleet
+        self.scan_regions = scan_regions
+        self.fleet_analyzer = None
+        self.rollup = rollup
+        self.rollup_days = rollup_days
+        self.rollup_manager = None
+        self.query_rewriter = None
+        self.query_explorer = QueryExplorer(sample_percent)
+        self.query_templates = QueryTemplates()
+        self.progressive = progressive
+        self.watch_interval = watch_interval
+        self.watch_minutes = watch_minutes
         self.queries = {
             "elbv2": {
                 "0": f"DONT CHANGE THIS",
@@ -33,6 +75,7 @@ class AWSLogAnalyzer:
                 "7": f"SELECT count(request_url) AS retries, client_ip, request_url FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE target_status_code LIKE '4%' GROUP BY request_url, client_ip ORDER BY retries DESC;",
                 "8": f"SELECT count(request_url) AS retries, request_url FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE target_status_code LIKE '4%' AND time BETWEEN parse_datetime('@@@start_time@@@','yyyy-MM-dd-HH:mm:ss') AND parse_datetime('@@@end_time@@@','yyyy-MM-dd-HH:mm:ss') GROUP BY request_url ORDER BY retries DESC;",
                 "9": f"SELECT count(request_url) AS retries, request_url FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE time LIKE '@@@start_time@@@%' or time LIKE '@@@end_time@@@%' GROUP BY request_url ORDER BY retries DESC;",
+                "10": f"SELECT request_url, count(*) AS requests, approx_percentile(target_processing_time, 0.5) AS p50_target, approx_percentile(target_processing_time, 0.95) AS p95_target, approx_percentile(target_processing_time, 0.99) AS p99_target, approx_percentile(request_processing_time + target_processing_time + response_processing_time, 0.99) AS p99_total FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE request_processing_time >= 0 AND target_processing_time >= 0 AND response_processing_time >= 0 GROUP BY request_url ORDER BY p99_target DESC LIMIT 100;",
             },
             "cloudfront": {
                 "0": f"DONT CHANGE THIS",
@@ -42,43 +85,159 @@ class AWSLogAnalyzer:
                 "4": f"SELECT DISTINCT * FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" LIMIT 10;",
                 "5": f"SELECT count(c_ip) AS retries, c_ip FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE cs_uri_stem LIKE '%@@@endpoint@@@%' GROUP BY c_ip ORDER BY retries DESC;",
                 "6": f"SELECT count(cs_uri_stem) AS retries, c_ip, cs_uri_stem FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE sc_status > @@@min_status_code@@@ AND sc_status < @@@max_status_code@@@ GROUP BY cs_uri_stem, c_ip ORDER BY retries DESC;",
-                "7": f"SELECT count(cs_uri_stem) AS retries, cs_uri_stem FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE sc_status > @@@min_status_code@@@ AND sc_status < @@@max_status_code@@@ AND time BETWEEN parse_datetime('@@@start_time@@@','yyyy-MM-dd-HH:mm:ss') AND parse_datetime('@@@end_time@@@','yyyy-MM-dd-HH:mm:ss') GROUP BY cs_uri_stem ORDER BY retries DESC;"
+                "7": f"SELECT count(cs_uri_stem) AS retries, cs_uri_stem FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" WHERE sc_status > @@@min_status_code@@@ AND sc_status < @@@max_status_code@@@ AND time BETWEEN parse_datetime('@@@start_time@@@','yyyy-MM-dd-HH:mm:ss') AND parse_datetime('@@@end_time@@@','yyyy-MM-dd-HH:mm:ss') GROUP BY cs_uri_stem ORDER BY retries DESC;",
+                "8": f"SELECT cs_uri_stem, count(*) AS requests, approx_percentile(time_to_first_byte, 0.5) AS p50_first_byte, approx_percentile(time_to_first_byte, 0.99) AS p99_first_byte, approx_percentile(time_taken, 0.5) AS p50_time_taken, approx_percentile(time_taken, 0.99) AS p99_time_taken FROM \"@@@athena_database@@@\".\"@@@athena_table@@@\" GROUP BY cs_uri_stem ORDER BY p99_time_taken DESC LIMIT 100;"
             }
         }
 
-    def replace_placeholders(self, query):
+    def get_placeholder_values(self, query, values=None, keep=()):
         # Verifica que query sea una cadena
         if not isinstance(query, str):
             raise ValueError("The query must be a string.")
-        
-        # Encuentra todos los placeholders en la consulta
-        placeholders = re.findall(r'@@@(\w+)@@@', query)
-        for placeholder in placeholders:
-            attribute_name = placeholder
+
+        placeholder_values = {}
+        for attribute_name in self.query_templates.get_placeholders(query):
+            if attribute_name in keep:
+                continue
             # Comprueba si la instancia tiene el atributo
             if hasattr(self, attribute_name) and getattr(self, attribute_name) is not None:
                 value = getattr(self, attribute_name)
+            elif values is not None and attribute_name in values:
+                # Valor ya introducido para otra consulta del mismo lote
+                value = values[attribute_name]
             else:
                 # Si no tiene el atributo, solicita al usuario que ingrese el valor
-                value = input(f"Enter value for {attribute_name}: ")
-            # Reemplaza el placeholder en la consulta con el valor correspondiente
-            query = query.replace(f"@@@{attribute_name}@@@", value)
-        return query
+                value = input(f"Enter value for {attribute_name} (separate several values with {VALUE_SEPARATOR}): ")
+                if values is not None:
+                    values[attribute_name] = value
+            placeholder_values[attribute_name] = str(value)
+        return placeholder_values
+
+    def bind_placeholders(self, query, values=None, keep=()):
+        # The template is compiled once, each set of values only binds its parameters. Returns (variant, query, parameters) per set
+        placeholder_values = self.get_placeholder_values(query, values, keep)
+        table_values = {name: placeholder_values.pop(name) for name in ('athena_database', 'athena_table') if name in placeholder_values}
+        variants = []
+        for label, variant in self.query_templates.expand(placeholder_values):
+            bound_query, parameters = self.query_templates.bind(query, {**variant, **table_values}, keep)
+            variants.append((label, self.rewrite_time_filters(bound_query), parameters))
+        return variants
 
     def setup(self, selected_bucket, log_checker):
+        dated_layout = False
         if self.log_type == 'elbv2':
-            log_checker.select_s3_folder(selected_bucket, self.authenticator.account_id, self.authenticator.region)
+            if self.partition_projection:
+                log_checker.log_prefix = log_checker.get_elb_log_path(self.authenticator.account_id, self.resource_region or self.authenticator.region)
+            else:
+                log_checker.select_s3_folder(selected_bucket, self.authenticator.account_id, self.resource_region or self.authenticator.region)
+        elif self.log_type == 'cloudfront' and self.partition_projection:
+            dated_layout = log_checker.has_dated_cloudfront_logs(selected_bucket, self.selected_resource)
+            if dated_layout:
+                log_checker.log_prefix = log_checker.get_cloudfront_log_path(self.selected_resource)
         self.log_prefix = log_checker.log_prefix
         self.athena_manager.log_prefix = self.log_prefix
-        self.athena_manager.create_athena_database()
         self.athena_database = self.athena_manager.athena_database
         self.athena_manager.athena_bucket = selected_bucket
-        self.athena_manager.create_athena_table(selected_bucket, self.selected_resource, self.log_type)
+        self.athena_manager.define_athena_table(selected_bucket, self.selected_resource, self.log_type, dated_layout)
         self.athena_table = self.athena_manager.athena_table
-        self.query_executor = QueryExecutor(self.authenticator.session, self.athena_manager.athena_database, self.athena_manager.athena_table, self.log_type, self.athena_manager.athena_bucket)
+        table_ready = self.athena_manager.create_in_background()
+        result_cache = ResultCache(max_age_minutes=self.cache_max_age) if self.use_cache else None
+        query_history = QueryHistory()
+        scan_estimator = None
+        if self.scan_estimate:
+            scan_estimator = ScanEstimator(self.authenticator.session, self.athena_manager.table_location, self.athena_manager.partition_column, query_history)
+        self.query_executor = QueryExecutor(self.authenticator.session, self.athena_manager.athena_database, self.athena_manager.athena_table, self.log_type, self.athena_manager.athena_bucket,
+                                            fetch_mode=self.fetch_mode, query_timeout=self.query_timeout, table_location=self.athena_manager.table_location,
+                                            result_cache=result_cache, result_reuse_max_age=self.cache_max_age,
+                                            output_format=self.output_format, query_history=query_history,
+                                            query_scan_budget=self.query_scan_budget, session_scan_budget=self.session_scan_budget,
+                                            scan_estimator=scan_estimator, table_ready=table_ready)
+        self.query_rewriter = QueryRewriter(self.log_type, self.athena_manager.partition_column)
+        if self.athena_manager.partition_column:
+            if self.compact_range or self.rollup:
+                self.query_executor.wait_until_ready()
+            self.setup_parquet_table(selected_bucket)
+            if self.rollup:
+                self.setup_rollup(selected_bucket)
+        elif self.compact_range or self.rollup:
+            self.logger.log("Parquet compaction and rollups need a partitioned table.", "red")
+
+    def setup_rollup(self, selected_bucket):
+        rollup_manager = RollupManager(self.authenticator.session, self.query_executor, self.athena_database, self.athena_manager.athena_table,
+                                       self.athena_manager.partition_column, selected_bucket, self.log_type, backfill_days=self.rollup_days)
+        if rollup_manager.update():
+            self.logger.log(f"Using hourly rollup {rollup_manager.rollup_table} up to {rollup_manager.watermark}", "cyan")
+            self.rollup_manager = rollup_manager
+
+    def rewrite_with_rollup(self, query):
+        if not self.rollup_manager:
+            return query
+        rewritten = self.rollup_manager.rewrite(query, self.athena_table)
+        if rewritten != query:
+            self.logger.log(f"Answered from the hourly rollup {self.rollup_manager.rollup_table}.", "cyan")
+        return rewritten
+
+    def rewrite_time_filters(self, query):
+        if not self.query_rewriter:
+            return query
+        rewritten = self.query_rewriter.rewrite(query)
+        if rewritten == query:
+            return query
+        self.logger.log("Time filters rewritten to partition predicates:", "cyan")
+        self.logger.log(rewritten, "cyan")
+        scan_estimator = self.query_executor.scan_estimator
+        if scan_estimator:
+            try:
+                saved_bytes = scan_estimator.estimate(query)[0] - scan_estimator.estimate(rewritten)[0]
+                self.logger.log(f"Partition pruning skips {format_bytes(max(saved_bytes, 0))} of logs.", "cyan")
+            except Exception as e:
+                print(f"Error estimating the bytes saved: {e}")
+        return rewritten
+
+    def setup_fleet(self, log_checker):
+        if not self.partition_projection:
+            self.logger.log("Fleet mode needs partition projection.", "red")
+            return False
+        if not log_checker.resources:
+            self.logger.log(f"No resources with logs enabled found in the account for {self.log_type}.", "red")
+            return False
+        query_history = QueryHistory()
+        self.fleet_analyzer = FleetAnalyzer(self.authenticator.session, log_checker, self.log_type, self.authenticator.account_id,
+                                            query_history=query_history, scan_estimate=self.scan_estimate)
+        groups = self.fleet_analyzer.plan_groups(log_checker.resources)
+        # Query results are written next to the logs of the first table, like the single resource mode does
+        self.athena_manager.athena_bucket = groups[0]['bucket']
+        if not self.athena_manager.create_athena_database():
+            return False
+        self.athena_database = self.athena_manager.athena_database
+        self.fleet_analyzer.create_tables(self.athena_database)
+        # CloudFront tables without dated folders have no partition column, the rewrite must work on every table
+        partition_column = 'day' if self.log_type == 'elbv2' else 'dt' if all(group['dated_layout'] for group in groups) else None
+        self.query_rewriter = QueryRewriter(self.log_type, partition_column)
+        self.athena_table = f"{self.log_type}_fleet"
+        result_cache = ResultCache(max_age_minutes=self.cache_max_age) if self.use_cache else None
+        self.query_executor = QueryExecutor(self.authenticator.session, self.athena_database, self.athena_table, self.log_type, self.athena_manager.athena_bucket,
+                                            fetch_mode=self.fetch_mode, query_timeout=self.query_timeout,
+                                            result_cache=result_cache, result_reuse_max_age=self.cache_max_age,
+                                            output_format=self.output_format, query_history=query_history,
+                                            query_scan_budget=self.query_scan_budget, session_scan_budget=self.session_scan_budget)
+        self.fleet_analyzer.query_executor = self.query_executor
+        return True
+
+    def setup_parquet_table(self, selected_bucket):
+        parquet_compactor = ParquetCompactor(self.authenticator.session, self.query_executor, self.athena_database, self.athena_table,
+                                             self.athena_manager.partition_column, selected_bucket,
+                                             compression=self.compact_compression, bucket_by=self.compact_bucket_by)
+        if self.compact_range:
+            parquet_compactor.compact(*self.compact_range)
+        if parquet_compactor.view_exists():
+            self.logger.log(f"Using compacted table {parquet_compactor.view_name}", "cyan")
+            self.athena_table = parquet_compactor.view_name
+            self.query_executor.athena_table = parquet_compactor.view_name
 
     def run_interactive(self):
         profiles = self.authenticator.get_aws_profiles()
+        startup_timer.mark('profiles')
         if not profiles:
             self.logger.log("No AWS profiles found. Please configure AWS CLI profiles.", "red")
             return
@@ -87,9 +246,10 @@ class AWSLogAnalyzer:
             return
 
         self.authenticator.select_region(selected_profile)
-        self.athena_manager = AthenaManager(self.authenticator.session)
+        startup_timer.mark('authentication')
+        self.athena_manager = AthenaManager(self.authenticator.session, partition_projection=self.partition_projection)
         self.athena_manager.athena_bucket = f"{self.authenticator.account_id}-athena-{self.authenticator.region}"
-        log_checker = LogChecker(self.authenticator.session)
+        log_checker = LogChecker(self.authenticator.session, self.authenticator.account_id, discovery_ttl=self.discovery_ttl)
 
         self.log_type = self.select_log_type()
         if not self.log_type:
@@ -99,33 +259,90 @@ class AWSLogAnalyzer:
         if not selected_bucket:
             return
 
-        self.setup(selected_bucket, log_checker)
+        if self.fleet:
+            if not self.setup_fleet(log_checker):
+                return
+        else:
+            self.setup(selected_bucket, log_checker)
+        startup_timer.mark('table setup')
         self.query_choice()
     
     def run_with_arguments(self):
+        if self.prepare_with_arguments():
+            self.query_choice()
+
+    def prepare_with_arguments(self):
         profiles = self.authenticator.get_aws_profiles()
+        startup_timer.mark('profiles')
         if self.profile not in profiles:
             self.logger.log("Profile not found. Make sure the profile name is correct.", "red")
             self.logger.log("Actual profiles:", "cyan")
             for profile in profiles:
                 self.logger.log(profile)
-            return
+            return False
         self.logger.log(f"Actual profile: {self.profile}", "cyan")
         self.logger.log(f"Actual resource: {self.selected_resource}", "cyan")
         self.authenticator.select_region(self.profile, True)
-        self.athena_manager = AthenaManager(self.authenticator.session)
+        startup_timer.mark('authentication')
+        self.athena_manager = AthenaManager(self.authenticator.session, partition_projection=self.partition_projection)
         self.athena_manager.athena_bucket = f"{self.authenticator.account_id}-athena-{self.authenticator.region}"
-        log_checker = LogChecker(self.authenticator.session)
+        log_checker = LogChecker(self.authenticator.session, self.authenticator.account_id, discovery_ttl=self.discovery_ttl)
 
         selected_bucket = self.select_manual_resource(log_checker, self.selected_resource)
 
         if not selected_bucket:
             self.logger.log("No log bucket found.", "red")
-            return
+            return False
 
         self.setup(selected_bucket, log_checker)
+        startup_timer.mark('table setup')
+        return True
+
+    def run_fleet(self):
+        if self.prepare_fleet():
+            self.query_choice()
+
+    def prepare_fleet(self):
+        profiles = self.authenticator.get_aws_profiles()
+        startup_timer.mark('profiles')
+        if self.profile not in profiles:
+            self.logger.log("Profile not found. Make sure the profile name is correct.", "red")
+            return False
+        self.logger.log(f"Actual profile: {self.profile}", "cyan")
+        self.authenticator.select_region(self.profile, True)
+        startup_timer.mark('authentication')
+        self.athena_manager = AthenaManager(self.authenticator.session, partition_projection=self.partition_projection)
+        log_checker = LogChecker(self.authenticator.session, self.authenticator.account_id, discovery_ttl=self.discovery_ttl)
+        if self.log_type == 'cloudfront':
+            log_checker.get_cloudfront_with_logs_enabled()
+        else:
+            log_checker.get_elb_with_logs_enabled(self.scan_regions or [self.authenticator.region])
+        if not self.setup_fleet(log_checker):
+            return False
+        startup_timer.mark('table setup')
+        return True
+
+    def run_local(self):
+        session = None
+        if any(path.startswith('s3://') for path in self.local_paths):
+            # S3 prefixes are synced to the local cache first, which is the only part that needs AWS
+            profiles = self.authenticator.get_aws_profiles()
+            startup_timer.mark('profiles')
+            if self.profile not in profiles:
+                self.logger.log("Profile not found. Make sure the profile name is correct.", "red")
+                return
+            self.authenticator.select_region(self.profile, True)
+            startup_timer.mark('authentication')
+            session = self.authenticator.session
+        self.athena_database = 'aws-athena-tool'
+        self.athena_table = f"{self.log_type}_local"
+        local_engine = LocalQueryEngine(self.log_type, self.local_paths, self.athena_database, self.athena_table, session)
+        self.query_executor = QueryExecutor(session, self.athena_database, self.athena_table, self.log_type, '', local_engine=local_engine, output_format=self.output_format)
+        self.query_rewriter = QueryRewriter(self.log_type, 'day' if self.log_type == 'elbv2' else 'dt')
         self.query_choice()
 
+    def deletes_table_on_exit(self):
+        return self.engine == 'athena' and self.log_type == 'elbv2' and not self.partition_projection
 
     def select_aws_profile(self, profiles):
         while True:
@@ -166,8 +383,10 @@ class AWSLogAnalyzer:
             self.logger.log("Do you want to enter the resource name manually or scan automatically?", "cyan")
             self.logger.log("1. Enter manually")
             self.logger.log("2. Scan automatically All resources")
+            self.logger.log("3. Scan automatically All resources, ignoring the cached resource list")
+            self.logger.log("4. Query all resources with logs enabled at once (fleet mode)")
             resource_choice = input("Enter the number corresponding to your choice: ")
-            if resource_choice not in ["1", "2"]:
+            if resource_choice not in ["1", "2", "3", "4"]:
                 self.logger.log("Invalid choice.", "red")
                 continue
 
@@ -175,6 +394,14 @@ class AWSLogAnalyzer:
                 return self.select_manual_resource(log_checker)
             elif resource_choice == "2":
                 return self.select_auto_resource(log_checker)
+            elif resource_choice == "3":
+                return self.select_auto_resource(log_checker, use_cache=False)
+            elif resource_choice == "4":
+                self.fleet = True
+                self.max_concurrency = max(self.max_concurrency, FLEET_MAX_CONCURRENCY)
+                if self.log_type == 'cloudfront':
+                    return log_checker.get_cloudfront_with_logs_enabled()
+                return log_checker.get_elb_with_logs_enabled(self.select_scan_regions())
 
     def select_manual_resource(self, log_checker, selected_resource=None):
         if self.log_type == 'cloudfront':
@@ -202,11 +429,15 @@ class AWSLogAnalyzer:
                 self.logger.log(f"Logs are enabled for the specified ALB: {selected_resource}", "green")
                 return selected_bucket
 
-    def select_auto_resource(self, log_checker):
+    def select_scan_regions(self):
+        regions = input(f"Enter the regions to scan separated by commas (default {self.authenticator.region}): ")
+        return [region.strip() for region in regions.split(",") if region.strip()] or [self.authenticator.region]
+
+    def select_auto_resource(self, log_checker, use_cache=True):
         if self.log_type == 'cloudfront':
-            log_buckets = log_checker.get_cloudfront_with_logs_enabled()
+            log_buckets = log_checker.get_cloudfront_with_logs_enabled(use_cache=use_cache)
         elif self.log_type == 'elbv2':
-            log_buckets = log_checker.get_elb_with_logs_enabled()
+            log_buckets = log_checker.get_elb_with_logs_enabled(self.select_scan_regions(), use_cache=use_cache)
 
         if not log_buckets:
             self.logger.log(f"No log buckets found in the account for {self.log_type}.", "red")
@@ -217,14 +448,20 @@ class AWSLogAnalyzer:
             self.logger.log(f"{i + 1}. {bucket}")
         selected_resource_index = int(input("Enter the number corresponding to the resource: ")) - 1
         selected_resource = list(log_buckets.keys())[selected_resource_index]
+        resource = log_checker.select_resource(selected_resource)
+        # Use the ARN so the table is the same one a manual selection of this resource creates
+        self.selected_resource = resource['arn']
+        if resource['region'] != 'global':
+            self.resource_region = resource['region']
         selected_bucket = log_buckets[selected_resource]
         return selected_bucket
 
     def query_choice(self):
+        startup_timer.report()
         while True:
             self.logger.log("Select a query or enter 0 to exit:", "cyan")
 
-            if self.log_type == 'elbv2':
+            if self.deletes_table_on_exit():
                 self.logger.log("0. Exit and delete Athena table")
             else:
                 self.logger.log("0. Exit")
@@ -233,55 +470,278 @@ class AWSLogAnalyzer:
                 if i == "0" or i == "1":
                     continue
                 self.logger.log(f"{i}. {query}")
+            self.logger.log("Enter several numbers separated by commas (for example 3,4,6,7) to run them concurrently.")
+            self.logger.log(f"Enter e and a number (for example e4) to get an approximate answer from a {self.query_explorer.sample_percent:g}% sample first.")
+            self.logger.log(f"Enter w and a number (for example w4) to watch the logs and refresh the result every {self.watch_interval}s with the new log files only.")
 
             query_choice = input("Enter the number corresponding to the query: ")
 
-            if not query_choice.isdigit():
-                self.logger.log("Invalid choice: not a digit.", "red")
-                continue
+            # The session can run out in the middle of any query, the menu stays open to exit cleanly
+            try:
+                if "," in query_choice:
+                    self.run_batch(query_choice)
+                    continue
 
-            if query_choice not in map(str, range(len(self.queries[self.log_type]))):
-                self.logger.log("Invalid choice: not in available queries.", "red")
-                continue
+                explore = query_choice.lower().startswith("e")
+                watch = query_choice.lower().startswith("w")
+                if explore or watch:
+                    query_choice = query_choice[1:].strip()
 
-            if query_choice == "0":
-                if self.log_type == 'elbv2':
-                    self.athena_manager.delete_athena_table()
-                break
-            elif query_choice == "1":
-                query = input("Enter the query: ")
-            elif query_choice in self.queries[self.log_type].keys():
-                query = self.queries[self.log_type][query_choice]
+                if not query_choice.isdigit():
+                    self.logger.log("Invalid choice: not a digit.", "red")
+                    continue
 
-            if "@@@" in query:
-                query = self.replace_placeholders(query)
+                if query_choice not in map(str, range(len(self.queries[self.log_type]))):
+                    self.logger.log("Invalid choice: not in available queries.", "red")
+                    continue
 
-            query_execution_id = self.query_executor.execute_athena_query(query)
-            if query_execution_id:
-                df = self.query_executor.get_query_results(query_execution_id)
-                self.query_executor.display_results(df)
+                if query_choice == "0":
+                    if self.deletes_table_on_exit():
+                        self.athena_manager.delete_athena_table()
+                    break
+                elif query_choice == "1":
+                    query = input("Enter the query: ")
+                elif query_choice in self.queries[self.log_type].keys():
+                    query = self.queries[self.log_type][query_choice]
+
+                if watch and query_choice != "0":
+                    self.watch_query(query, query_choice)
+                    continue
+                if explore and query_choice != "0":
+                    df = self.explore_query(query, query_choice)
+                else:
+                    df = self.run_query(query, query_choice, progressive=self.progressive)
+                if df is not None:
+                    self.query_executor.display_results(df)
+            except SessionExpiredError as e:
+                self.logger.log(str(e), "red")
+
+    def explore_query(self, query, query_choice, values=None):
+        # Shows an approximate answer first and returns the exact one when the user asks for it
+        if self.fleet_analyzer:
+            self.logger.log("Exploration is not available in fleet mode, running the exact query.", "red")
+            return self.run_query(query, query_choice, values)
+        try:
+            variants = self.bind_placeholders(query, values)
+        except ValueError as e:
+            self.logger.log(f"Invalid value: {e}", "red")
+            return None
+        if len(variants) > 1:
+            self.logger.log("Exploration runs one set of values at a time, running the exact queries.", "red")
+            return self.run_variants(variants, query_choice)
+        _, query, parameters = variants[0]
+        rollup_query = self.rewrite_with_rollup(query) if query_choice != "1" else query
+        if rollup_query != query:
+            return self.query_executor.run_query(rollup_query, template=query_choice, parameters=parameters)
+        approximation = self.query_explorer.approximate(query, f'"{self.athena_database}"."{self.athena_table}"')
+        if not approximation:
+            self.logger.log("This query has no counts, sums or percentiles to approximate, running the exact query.", "cyan")
+            return self.query_executor.run_query(query, template=query_choice, parameters=parameters)
+        approximate_query, estimated = approximation
+        df = self.query_executor.run_query(approximate_query, template=f"{query_choice}_approx", parameters=parameters)
+        if df is None:
+            return None
+        self.query_executor.display_results(df, label=f"{query_choice}_approx")
+        relative_error = self.query_explorer.get_relative_error(df, estimated)
+        if relative_error is not None:
+            self.logger.log(f"Estimated from a {self.query_explorer.sample_percent:g}% sample, the *_error columns are 95% intervals. Largest error in the first rows: {relative_error:.1%}.", "cyan")
+        if not self.query_explorer.needs_exact(df, estimated):
+            if relative_error is not None:
+                self.logger.log(f"The estimates are within {self.query_explorer.max_relative_error:.0%}, the exact query is not needed.", "green")
+            return None
+        if input("The estimates are not precise enough. Run the exact query? [y/N]: ").strip().lower() != "y":
+            return None
+        return self.query_executor.run_query(query, template=query_choice, parameters=parameters)
+
+    def watch_query(self, query, query_choice):
+        # Each cycle reads only the log files delivered since the previous one and adds their counts to the running result
+        if self.fleet_analyzer or self.engine != "athena":
+            self.logger.log("Watch mode is only available for a single resource queried in Athena.", "red")
+            return
+        if not self.athena_manager.partition_column:
+            self.logger.log("Watch mode needs logs delivered in date folders and a partitioned table.", "red")
+            return
+        try:
+            variants = self.bind_placeholders(query)
+        except ValueError as e:
+            self.logger.log(f"Invalid value: {e}", "red")
+            return
+        if len(variants) > 1:
+            self.logger.log("Watch mode runs one set of values at a time.", "red")
+            return
+        _, query, parameters = variants[0]
+        log_watcher = LogWatcher(self.authenticator.session, self.log_type, self.athena_manager.table_location, self.athena_database, self.athena_table,
+                                 interval=self.watch_interval, lookback_minutes=self.watch_minutes, output_format=self.output_format)
+        log_watcher.watch(query, parameters, label=f"{query_choice}_watch")
+
+    def run_query(self, query, query_choice, values=None, progressive=False):
+        # Each table of the fleet replaces the table placeholder with its own name
+        if self.fleet_analyzer and "@@@athena_table@@@" not in query:
+            self.logger.log("In fleet mode use @@@athena_database@@@.@@@athena_table@@@ as table name.", "red")
+            return None
+        try:
+            variants = self.bind_placeholders(query, values, keep=['athena_table'] if self.fleet_analyzer else ())
+        except ValueError as e:
+            self.logger.log(f"Invalid value: {e}", "red")
+            return None
+        if query_choice != "1":
+            variants = [(label, self.rewrite_with_rollup(variant_query), parameters) for label, variant_query, parameters in variants]
+        if len(variants) > 1:
+            return self.run_variants(variants, query_choice)
+        _, query, parameters = variants[0]
+        if self.fleet_analyzer:
+            return self.fleet_analyzer.run_query(query, template=query_choice, max_concurrency=self.max_concurrency, parameters=parameters)
+        if progressive:
+            # The results are shown while they download, nothing is left to display afterwards
+            self.query_executor.run_query_progressive(query, template=query_choice, parameters=parameters)
+            return None
+        return self.query_executor.run_query(query, template=query_choice, parameters=parameters)
+
+    def run_variants(self, variants, query_choice):
+        # Values given with | run the same statement concurrently, the results are combined with a column naming the values
+        import pandas as pd
+
+        queries = [(f"{query_choice} {label}", query, parameters) for label, query, parameters in variants]
+        runner = self.fleet_analyzer or self.query_executor
+        results = {}
+        batch = runner.run_queries(queries, self.max_concurrency)
+        try:
+            for label, _, df in batch:
+                if df is not None:
+                    results[label] = df
+        except KeyboardInterrupt:
+            batch.close()
+        frames = [results[label].assign(variant=variant).reindex(columns=['variant', *results[label].columns])
+                  for (label, _, _), (variant, _, _) in zip(queries, variants) if label in results]
+        return pd.concat(frames, ignore_index=True) if frames else None
+
+    def run_batch(self, query_choice):
+        queries = []
+        values = {}
+        for choice in [choice.strip() for choice in query_choice.split(",") if choice.strip()]:
+            if choice in ["0", "1"] or choice not in self.queries[self.log_type]:
+                self.logger.log(f"Invalid choice in batch: {choice}", "red")
+                return
+            try:
+                variants = self.bind_placeholders(self.queries[self.log_type][choice], values, keep=['athena_table'] if self.fleet_analyzer else ())
+            except ValueError as e:
+                self.logger.log(f"Invalid value: {e}", "red")
+                return
+            for label, query, parameters in variants:
+                queries.append((f"{choice} {label}" if label else choice, self.rewrite_with_rollup(query), parameters))
+
+        if self.fleet_analyzer:
+            batch = self.fleet_analyzer.run_queries(queries, self.max_concurrency)
+        else:
+            batch = self.query_executor.run_queries(queries, self.max_concurrency)
+        try:
+            for label, query, df in batch:
+                self.logger.log(f"Results of query {label}:", "cyan")
+                if df is not None:
+                    self.query_executor.display_results(df, pager=False, label=label)
+        except KeyboardInterrupt:
+            batch.close()
 
     def main(self):
         if len(sys.argv) > 1 and sys.argv[1] == "wizard":
             self.run_interactive()
+        elif len(sys.argv) > 1 and sys.argv[1] == "history":
+            QueryHistory().print_summary()
+        elif len(sys.argv) > 1 and sys.argv[1] == "daemon":
+            from session_daemon import SessionDaemon, SOCKET_PATH
+            parser = argparse.ArgumentParser(prog="main.py daemon", description="Keep sessions and tables ready for queries sent with main.py client")
+            parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket the daemon listens on")
+            args = parser.parse_args(sys.argv[2:])
+            SessionDaemon(args.socket).serve()
         else:
             parser = argparse.ArgumentParser(description="AWS-Athena-Tool")
-            parser.add_argument("--profile", required=True, help="AWS CLI profile name")
-            parser.add_argument("--region", required=True, help="AWS region")
+            parser.add_argument("--profile", help="AWS CLI profile name")
+            parser.add_argument("--region", help="AWS region")
             parser.add_argument("--log_type", required=True, choices=["cloudfront", "elbv2"], help="Log type")
-            parser.add_argument("--selected_resource", required=True, help="Cloudfront distribution ID or LB ARN")
+            parser.add_argument("--selected_resource", help="Cloudfront distribution ID or LB ARN")
+            parser.add_argument("--engine", default="athena", choices=["athena", "local"], help="Run queries in Athena or locally on downloaded log files")
+            parser.add_argument("--local_path", nargs="+", default=[], help="Log files, folders or s3://bucket/prefix locations read by the local engine")
+            parser.add_argument("--output_format", default="table", choices=list(OUTPUT_FORMATS), help="Format of the result files saved in /tmp")
+            parser.add_argument("--fetch_mode", default="auto", choices=["auto", "s3", "paginate"], help="How query results are downloaded: stream the output CSV from S3 when large (auto), always (s3) or never (paginate)")
+            parser.add_argument("--query_timeout", type=int, help="Stop queries that run longer than this many seconds")
+            parser.add_argument("--no_credential_cache", action="store_true", help="Authenticate with STS on every run instead of reusing the encrypted credential cache")
+            parser.add_argument("--no_cache", action="store_true", help="Bypass the Athena result reuse and the local result cache")
+            parser.add_argument("--cache_max_age", type=int, default=60, help="Maximum age in minutes of reused or cached query results")
+            parser.add_argument("--no_partition_projection", action="store_true", help="Create one ELBv2 table per day instead of a long-lived date partitioned table")
+            parser.add_argument("--compact", nargs=2, metavar=("START_DAY", "END_DAY"), help="Convert the logs of these days (YYYY-MM-DD) to partitioned Parquet before querying")
+            parser.add_argument("--compact_compression", default="ZSTD", choices=COMPRESSIONS, help="Parquet compression codec")
+            parser.add_argument("--compact_bucket_by", help="Column used to bucket the Parquet files, for example client_ip")
+            parser.add_argument("--startup_timing", action="store_true", help="Print how long each startup stage took before the query menu (or set AWS_ATHENA_TOOL_STARTUP_TIMING=1)")
+            parser.add_argument("--query_scan_budget", type=float, help="Stop any Athena query that scans more than this many GB")
+            parser.add_argument("--session_scan_budget", type=float, help="Stop queries and start no new ones once this run scanned this many GB in total")
+            parser.add_argument("--no_scan_estimate", action="store_true", help="Do not list the table location in S3 to estimate the size, cost and runtime of each query")
+            parser.add_argument("--max_concurrency", type=int, help=f"Maximum number of queries running at the same time in Athena (default 5, {FLEET_MAX_CONCURRENCY} in fleet mode)")
+            parser.add_argument("--rollup", action="store_true", help="Keep hourly pre-aggregated counts and bytes up to date and answer the predefined top-N queries from them")
+            parser.add_argument("--rollup_days", type=int, default=7, help="Days rolled up the first time --rollup is used")
+            parser.add_argument("--progressive", action="store_true", help="Show the first page of results as soon as a query finishes and download the rest in the background")
+            parser.add_argument("--sample_percent", type=float, default=DEFAULT_SAMPLE_PERCENT, help="Percentage of rows read by the approximate queries of the exploration mode (e4 in the query menu)")
+            parser.add_argument("--watch_interval", type=int, default=DEFAULT_WATCH_INTERVAL, help="Seconds between two refreshes of the watch mode (w4 in the query menu)")
+            parser.add_argument("--watch_minutes", type=int, default=DEFAULT_WATCH_MINUTES, help="Minutes of logs read before the first refresh of the watch mode")
+            parser.add_argument("--fleet", action="store_true", help="Query every resource of --log_type with logs enabled at once and merge the results")
+            parser.add_argument("--scan_regions", nargs="+", help="Regions scanned for ALBs in fleet mode (default --region)")
 
             try:
                 args = parser.parse_args()
+                if args.engine == "local" and not args.local_path:
+                    parser.error("--local_path is required with --engine local")
+                needs_aws = args.engine == "athena" or any(path.startswith("s3://") for path in args.local_path)
+                if needs_aws and not (args.profile and args.region):
+                    parser.error("--profile and --region are required")
+                if not 0 < args.sample_percent <= 100:
+                    parser.error("--sample_percent must be between 0 and 100")
+                if args.watch_interval < 1 or args.watch_minutes < 0:
+                    parser.error("--watch_interval must be at least 1 and --watch_minutes can't be negative")
+                if args.fleet and args.engine != "athena":
+                    parser.error("--fleet needs --engine athena")
+                if args.engine == "athena" and not args.selected_resource and not args.fleet:
+                    parser.error("--selected_resource or --fleet is required")
             except SystemExit as e:
                 if e.code != 0:
                     parser.print_help()
                 sys.exit(e.code)
 
+            startup_timer.mark('arguments')
+            startup_timer.enabled = startup_timer.enabled or args.startup_timing
             self.profile = args.profile
-            self.region = args.region
+            self.region = args.region or self.region
+            self.authenticator.region = self.region
+            if args.no_credential_cache:
+                self.authenticator.credential_cache = None
             self.log_type = args.log_type
             self.selected_resource = args.selected_resource
-
-            self.run_with_arguments()
+            self.fetch_mode = args.fetch_mode
+            self.query_timeout = args.query_timeout
+            self.use_cache = not args.no_cache
+            self.cache_max_age = args.cache_max_age
+            self.partition_projection = not args.no_partition_projection
+            self.compact_range = args.compact
+            self.compact_compression = args.compact_compression
+            self.compact_bucket_by = args.compact_bucket_by
+            self.max_concurrency = args.max_concurrency or (FLEET_MAX_CONCURRENCY if args.fleet else 5)
+            self.fleet = args.fleet
+            self.rollup = args.rollup
+            self.rollup_days = args.rollup_days
+            self.query_explorer.sample_percent = args.sample_percent
+            self.progressive = args.progressive
+            self.watch_interval = args.watch_interval
+            self.watch_minutes = args.watch_minutes
+            self.scan_regions = args.scan_regions
+            self.query_scan_budget = int(args.query_scan_budget * 1024 ** 3) if args.query_scan_budget else None
+            self.scan_estimate = not args.no_scan_estimate
+            self.session_scan_budget = int(args.session_scan_budget * 1024 ** 3) if args.session_scan_budget else None
+            self.engine = args.engine
+            self.local_paths = args.local_path
+            self.output_format = args.output_format
+
+            if self.engine == "local":
+                self.run_local()
+            elif self.fleet:
+                self.run_fleet()
+            else:
+                self.run_with_arguments()
 
@@ -0,0 +1,303 @@
+from athena_utils import CLOUDFRONT_COLUMNS
+from datetime import datetime, timedelta
+import botocore
+import bisect
+import io
+import itertools
+import random
+import re
+import threading
+import time
+
+ACCOUNT_ID = '123456789012'
+ATHENA_TYPES = {'string': 'varchar', 'int': 'integer', 'bigint': 'bigint', 'double': 'double', 'float': 'float', 'date': 'date'}
+PAGE_ROWS = 1000
+LIST_PAGE_KEYS = 1000
+
+def generate_elb_records(count, seed=0, day=datetime(2024, 5, 1)):
+    rng = random.Random(seed)
+    paths = [f"/api/v1/{name}" for name in ['users', 'orders', 'items', 'search', 'login', 'health', 'cart', 'checkout']]
+    records = []
+    for i in range(count):
+        timestamp = (day + timedelta(seconds=i * 86400 / max(count, 1))).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        status = rng.choice(['200'] * 8 + ['301', '404', '403', '500'])
+        records.append({
+            'type': 'https', 'time': timestamp, 'elb': 'app/bench-lb/50dc6c495c0c9188',
+            'client_ip': f"10.{rng.randint(0, 3)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}", 'client_port': str(rng.randint(1024, 65535)),
+            'target_ip': f"172.16.0.{rng.randint(1, 20)}", 'target_port': '80',
+            'request_processing_time': f"{rng.random() / 100:.3f}", 'target_processing_time': f"{rng.random():.3f}", 'response_processing_time': f"{rng.random() / 100:.3f}",
+            'elb_status_code': status, 'target_status_code': status, 'received_bytes': str(rng.randint(100, 5000)), 'sent_bytes': str(rng.randint(100, 500000)),
+            'request_verb': rng.choice(['GET', 'GET', 'GET', 'POST', 'PUT']), 'request_url': f"https://www.example.com:443{rng.choice(paths)}?id={rng.randint(1, 5000)}",
+            'request_proto': 'HTTP/1.1', 'user_agent': rng.choice(['curl/7.46.0', 'Mozilla/5.0 (X11; Linux x86_64)', 'python-requests/2.31']),
+            'ssl_cipher': 'ECDHE-RSA-AES128-GCM-SHA256', 'ssl_protocol': 'TLSv1.2',
+            'target_group_arn': f"arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT_ID}:targetgroup/bench/73e2d6bc24d8a067",
+            'trace_id': f"Root=1-{rng.getrandbits(32):08x}-{rng.getrandbits(96):024x}", 'domain_name': 'www.example.com',
+            'chosen_cert_arn': f"arn:aws:acm:eu-west-1:{ACCOUNT_ID}:certificate/12345678-1234-1234-1234-123456789012", 'matched_rule_priority': '1',
+            'request_creation_time': timestamp, 'actions_executed': 'forward', 'redirect_url': '-', 'lambda_error_reason': '-',
+            'target_port_list': '172.16.0.1:80', 'target_status_code_list': status, 'classification': '-', 'classification_reason': '-',
+            'traceability_id': f"TID_{rng.getrandbits(64):016x}",
+        })
+    return records
+
+def format_elb_line(record):
+    return (f"{record['type']} {record['time']} {record['elb']} {record['client_ip']}:{record['client_port']} {record['target_ip']}:{record['target_port']} "
+            f"{record['request_processing_time']} {record['target_processing_time']} {record['response_processing_time']} {record['elb_status_code']} {record['target_status_code']} "
+            f"{record['received_bytes']} {record['sent_bytes']} \"{record['request_verb']} {record['request_url']} {record['request_proto']}\" \"{record['user_agent']}\" "
+            f"{record['ssl_cipher']} {record['ssl_protocol']} {record['target_group_arn']} \"{record['trace_id']}\" \"{record['domain_name']}\" \"{record['chosen_cert_arn']}\" "
+            f"{record['matched_rule_priority']} {record['request_creation_time']} \"{record['actions_executed']}\" \"{record['redirect_url']}\" \"{record['lambda_error_reason']}\" "
+            f"\"{record['target_port_list']}\" \"{record['target_status_code_list']}\" \"{record['classification']}\" \"{record['classification_reason']}\" {record['traceability_id']}")
+
+def generate_cloudfront_lines(count, seed=0, day=datetime(2024, 5, 1)):
+    rng = random.Random(seed)
+    lines = ["#Version: 1.0", "#Fields: " + " ".join(name.replace('_', '-') for name, _ in CLOUDFRONT_COLUMNS)]
+    for i in range(count):
+        timestamp = day + timedelta(seconds=i * 86400 / max(count, 1))
+        values = {name: '-' for name, _ in CLOUDFRONT_COLUMNS}
+        values.update({
+            'date': timestamp.strftime('%Y-%m-%d'), 'time': timestamp.strftime('%H:%M:%S'), 'x_edge_location': rng.choice(['SEA19-C1', 'MAD50-C2', 'FRA6-C1']),
+            'sc_bytes': str(rng.randint(100, 500000)), 'c_ip': f"192.0.{rng.randint(0, 3)}.{rng.randint(1, 254)}", 'cs_method': 'GET',
+            'cs_host': 'd111111abcdef8.cloudfront.net', 'cs_uri_stem': f"/static/{rng.randint(1, 200)}.js", 'sc_status': rng.choice(['200'] * 8 + ['304', '404', '403', '502']),
+            'cs_user_agent': 'Mozilla/5.0', 'x_edge_result_type': rng.choice(['Hit', 'Miss', 'RefreshHit']), 'x_edge_request_id': f"{rng.getrandbits(160):040x}",
+            'x_host_header': 'www.example.com', 'cs_protocol': 'https', 'cs_bytes': str(rng.randint(20, 2000)), 'time_taken': f"{rng.random():.3f}",
+            'ssl_protocol': 'TLSv1.3', 'ssl_cipher': 'TLS_AES_128_GCM_SHA256', 'x_edge_response_result_type': 'Hit', 'cs_protocol_version': 'HTTP/2.0',
+            'c_port': str(rng.randint(1024, 65535)), 'time_to_first_byte': f"{rng.random() / 10:.3f}", 'x_edge_detailed_result_type': 'Hit',
+            'sc_content_type': 'application/javascript', 'sc_content_len': str(rng.randint(100, 500000)),
+        })
+        lines.append("\t".join(values[name] for name, _ in CLOUDFRONT_COLUMNS))
+    return lines
+
+def get_column_info(columns):
+    return [{'Name': name, 'Type': ATHENA_TYPES[column_type.lower()]} for name, column_type in columns]
+
+class FakeState:
+    def __init__(self, latency=0.0, query_seconds=0.0):
+        self.latency = latency
+        self.query_seconds = query_seconds
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.query_ids = itertools.count()
+        self.queries = {}
+        self.load_balancers = {}
+        self.distributions = []
+        self.objects = {}
+        self.sorted_keys = []
+        self.result_columns = []
+        self.result_rows = []
+        self.result_csv = b''
+        self.databases = set()
+        self.tables = {}
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_objects(self, bucket, objects):
+        self.objects.update({(bucket, key): size for key, size in objects})
+        self.sorted_keys = sorted(self.objects)
+
+    def set_results(self, columns, rows):
+        self.result_columns = get_column_info(columns)
+        self.result_rows = rows
+        output = io.StringIO()
+        output.write(",".join(f'"{column["Name"]}"' for column in self.result_columns) + "\n")
+        for row in rows:
+            output.write(",".join('"' + value.replace('"', '""') + '"' for value in row) + "\n")
+        self.result_csv = output.getvalue().encode()
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+class FakeSTS:
+    def __init__(self, state):
+        self.state = state
+
+    def get_caller_identity(self):
+        self.state.call()
+        return {'Account': ACCOUNT_ID, 'Arn': f"arn:aws:iam::{ACCOUNT_ID}:user/bench", 'UserId': 'AIDABENCH'}
+
+class FakeELBv2:
+    def __init__(self, state, region):
+        self.state = state
+        self.region = region
+
+    def get_paginator(self, name):
+        def pages():
+            load_balancers = self.state.load_balancers.get(self.region, [])
+            for start in range(0, max(len(load_balancers), 1), 400):
+                self.state.call()
+                yield {'LoadBalancers': load_balancers[start:start + 400]}
+        return FakePaginator(pages)
+
+    def describe_load_balancer_attributes(self, LoadBalancerArn):
+        self.state.call()
+        name = LoadBalancerArn.split('/')[-2]
+        enabled = int(LoadBalancerArn.split('/')[-1]) % 2 == 0
+        return {'Attributes': [
+            {'Key': 'access_logs.s3.enabled', 'Value': 'true' if enabled else 'false'},
+            {'Key': 'access_logs.s3.bucket', 'Value': 'bench-logs'},
+            {'Key': 'access_logs.s3.prefix', 'Value': name},
+        ]}
+
+class FakeCloudFront:
+    def __init__(self, state):
+        self.state = state
+
+    def get_paginator(self, name):
+        def pages():
+            for start in range(0, max(len(self.state.distributions), 1), 100):
+                self.state.call()
+                yield {'DistributionList': {'Items': [{'Id': dist_id} for dist_id in self.state.distributions[start:start + 100]]}}
+        return FakePaginator(pages)
+
+    def get_distribution_config(self, Id):
+        self.state.call()
+        return {'DistributionConfig': {'Logging': {'Enabled': True, 'Bucket': 'bench-logs.s3.amazonaws.com', 'Prefix': f"cf/{Id}"}}}
+
+class FakeAthena:
+    def __init__(self, state):
+        self.state = state
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.state.call()
+        query_execution_id = f"bench-{next(self.state.query_ids)}"
+        self.state.queries[query_execution_id] = {'query': QueryString, 'started': time.monotonic(), 'stopped': False}
+        self.update_catalog(QueryString)
+        return {'QueryExecutionId': query_execution_id}
+
+    def update_catalog(self, query):
+        database = re.search(r"CREATE DATABASE IF NOT EXISTS `([^`]+)`", query)
+        if database:
+            self.state.databases.add(database.group(1))
+        table = re.search(r"CREATE EXTERNAL TABLE IF NOT EXISTS `([^`]+)`\.`([^`]+)` \((.*?)\n\s*\)", query, re.DOTALL)
+        if table and (table.group(1), table.group(2)) not in self.state.tables:
+            partition_keys = re.findall(r"PARTITIONED BY \(`([^`]+)`", query)
+            self.state.tables[(table.group(1), table.group(2))] = {
+                'Name': table.group(2),
+                'Columns': [{'Name': name, 'Type': column_type.lower()} for name, column_type in re.findall(r"`([^`]+)` (\w+)", table.group(3))],
+                'PartitionKeys': [{'Name': name, 'Type': 'string'} for name in partition_keys],
+                'Parameters': {'location': re.search(r"LOCATION '([^']+)'", query).group(1)},
+            }
+        dropped = re.search(r"DROP TABLE IF EXISTS `([^`]+)`\.`([^`]+)`", query)
+        if dropped:
+            self.state.tables.pop((dropped.group(1), dropped.group(2)), None)
+
+    def get_database(self, CatalogName, DatabaseName):
+        self.state.call()
+        if DatabaseName not in self.state.databases:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'MetadataException', 'Message': 'Database not found'}}, 'GetDatabase')
+        return {'Database': {'Name': DatabaseName}}
+
+    def get_table_metadata(self, CatalogName, DatabaseName, TableName):
+        self.state.call()
+        if (DatabaseName, TableName) not in self.state.tables:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'MetadataException', 'Message': 'Table not found'}}, 'GetTableMetadata')
+        return {'TableMetadata': self.state.tables[(DatabaseName, TableName)]}
+
+    def describe(self, query_execution_id):
+        query = self.state.queries[query_execution_id]
+        elapsed = time.monotonic() - query['started']
+        state = 'CANCELLED' if query['stopped'] else 'SUCCEEDED' if elapsed >= self.state.query_seconds else 'RUNNING'
+        return {
+            'QueryExecutionId': query_execution_id,
+            'Query': query['query'],
+            'StatementType': 'DML' if query['query'].lstrip().upper().startswith(('SELECT', 'WITH')) else 'DDL',
+            'ResultConfiguration': {'OutputLocation': f"s3://bench-results/{query_execution_id}.csv"},
+            'Status': {'State': state},
+            'Statistics': {'DataScannedInBytes': int(min(elapsed, self.state.query_seconds) * 100 * 1024 ** 2), 'EngineExecutionTimeInMillis': int(elapsed * 1000),
+                           'TotalExecutionTimeInMillis': int(elapsed * 1000), 'QueryQueueTimeInMillis': 0, 'ServiceProcessingTimeInMillis': 0},
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        self.state.call()
+        return {'QueryExecution': self.describe(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.state.call()
+        return {'QueryExecutions': [self.describe(query_execution_id) for query_execution_id in QueryExecutionIds], 'UnprocessedQueryExecutionIds': []}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.state.call()
+        self.state.queries[QueryExecutionId]['stopped'] = True
+
+    def get_result_page(self, start, count):
+        rows = []
+        if start == 0:
+            rows.append({'Data': [{'VarCharValue': column['Name']} for column in self.state.result_columns]})
+            count -= 1
+        # Like the API, NULL values have no VarCharValue
+        for row in self.state.result_rows[max(start - 1, 0):max(start - 1, 0) + count]:
+            rows.append({'Data': [{'VarCharValue': value} if value != '' else {} for value in row]})
+        return {'ResultSet': {'Rows': rows, 'ResultSetMetadata': {'ColumnInfo': self.state.result_columns}}}
+
+    def get_query_results(self, QueryExecutionId, MaxResults=PAGE_ROWS, NextToken=None):
+        self.state.call()
+        return self.get_result_page(int(NextToken or 0), MaxResults)
+
+    def get_paginator(self, name):
+        def pages(QueryExecutionId, PaginationConfig=None):
+            page_rows = (PaginationConfig or {}).get('PageSize', PAGE_ROWS)
+            for start in range(0, len(self.state.result_rows) + 1, page_rows):
+                self.state.call()
+                yield self.get_result_page(start, page_rows)
+        return FakePaginator(pages)
+
+class FakeS3:
+    def __init__(self, state):
+        self.state = state
+
+    def head_object(self, Bucket, Key):
+        self.state.call()
+        return {'ContentLength': len(self.state.result_csv)}
+
+    def get_object(self, Bucket, Key):
+        self.state.call()
+        return {'Body': io.BytesIO(self.state.result_csv)}
+
+    def get_paginator(self, name):
+        def pages(Bucket, Prefix='', Delimiter=None):
+            start = bisect.bisect_left(self.state.sorted_keys, (Bucket, Prefix))
+            contents, common_prefixes = [], []
+            for bucket, key in itertools.islice(self.state.sorted_keys, start, None):
+                if bucket != Bucket or not key.startswith(Prefix):
+                    break
+                rest = key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    common_prefix = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                    if not common_prefixes or common_prefixes[-1] != common_prefix:
+                        common_prefixes.append(common_prefix)
+                    continue
+                contents.append({'Key': key, 'Size': self.state.objects[(bucket, key)]})
+                if len(contents) == LIST_PAGE_KEYS:
+                    self.state.call()
+                    yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': prefix} for prefix in common_prefixes]}
+                    contents, common_prefixes = [], []
+            self.state.call()
+            yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': prefix} for prefix in common_prefixes]}
+        return FakePaginator(pages)
+
+class FakeSession:
+    def __init__(self, profile_name=None, region_name='eu-west-1', state=None, **kwargs):
+        self.profile_name = profile_name
+        self.region_name = region_name
+        self.state = state or FakeSession.default_state
+
+    def client(self, service, region_name=None, config=None):
+        if service == 'sts':
+            return FakeSTS(self.state)
+        if service == 'elbv2':
+            return FakeELBv2(self.state, region_name or self.region_name)
+        if service == 'cloudfront':
+            return FakeCloudFront(self.state)
+        if service == 'athena':
+            return FakeAthena(self.state)
+        if service == 's3':
+            return FakeS3(self.state)
+        raise ValueError(f"Service {service} is not simulated")
+
+FakeSession.default_state = FakeState()
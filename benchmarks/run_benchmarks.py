@@ -0,0 +1,301 @@
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Every cache of the tool goes to a throwaway folder, a benchmark must never reuse or pollute the user's caches
+os.environ['AWS_ATHENA_TOOL_CACHE_DIR'] = tempfile.mkdtemp(prefix='aws-athena-tool-bench-')
+
+from fake_aws import FakeSession, FakeState, ACCOUNT_ID, generate_elb_records, format_elb_line, generate_cloudfront_lines
+from athena_utils import ELBV2_COLUMNS
+
+STAGES = ['auth', 'discovery_elbv2', 'discovery_cloudfront', 'ddl', 'poll', 'poll_batch', 'decode_paginate', 'decode_stream', 'first_page_paginate', 'first_page_stream', 'render', 'scan_estimate', 'local_engine']
+
+def read_rss_mb(field):
+    # VmRSS is the current resident size, VmHWM its peak since the process started
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def reset_peak_rss():
+    # Linux resets VmHWM to the current RSS, so the peak only covers the measured part and not the data generation before it
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def timed(function):
+    reset_peak_rss()
+    timed.rss_start = read_rss_mb('VmRSS')
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+def get_result_rows(count, seed):
+    return [[record[name] for name, _ in ELBV2_COLUMNS] for record in generate_elb_records(count, seed)]
+
+def bench_auth(args, state):
+    import aws_auth
+    config_dir = tempfile.mkdtemp()
+    with open(os.path.join(config_dir, 'config'), 'w') as f:
+        f.write("".join(f"[profile bench{i}]\nregion = eu-west-1\n" for i in range(args.profiles)))
+    os.environ['AWS_CONFIG_FILE'] = os.path.join(config_dir, 'config')
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(config_dir, 'credentials')
+    aws_auth.boto3.Session = lambda profile_name=None, region_name=None, **kwargs: FakeSession(profile_name, region_name, state)
+    authenticator = aws_auth.AWSAuthenticator('eu-west-1')
+    seconds, profiles = timed(lambda: (authenticator.get_aws_profiles(), authenticator.authenticate_with_mfa('bench0', 'eu-west-1')))
+    return {'seconds': seconds, 'profiles': len(profiles[0])}
+
+def bench_discovery_elbv2(args, state):
+    from log_check import LogChecker
+    regions = [f"region-{i}" for i in range(args.regions)]
+    for region in regions:
+        state.load_balancers[region] = [{'LoadBalancerArn': f"arn:aws:elasticloadbalancing:{region}:{ACCOUNT_ID}:loadbalancer/app/lb-{i}/{i}",
+                                         'LoadBalancerName': f"lb-{i}"} for i in range(args.load_balancers)]
+    log_checker = LogChecker(FakeSession(state=state), ACCOUNT_ID, cache_dir=tempfile.mkdtemp())
+    seconds, resources = timed(lambda: log_checker.get_elb_with_logs_enabled(regions, use_cache=False))
+    return {'seconds': seconds, 'resources': len(resources), 'api_calls': state.calls}
+
+def bench_discovery_cloudfront(args, state):
+    from log_check import LogChecker
+    state.distributions = [f"E{i:012d}" for i in range(args.load_balancers)]
+    log_checker = LogChecker(FakeSession(state=state), ACCOUNT_ID, cache_dir=tempfile.mkdtemp())
+    seconds, resources = timed(lambda: log_checker.get_cloudfront_with_logs_enabled(use_cache=False))
+    return {'seconds': seconds, 'resources': len(resources), 'api_calls': state.calls}
+
+def bench_ddl(args, state):
+    from athena_utils import AthenaManager
+    from table_catalog import TableCatalog
+    catalog_path = os.path.join(tempfile.mkdtemp(), 'catalog.json')
+    def create_tables():
+        for log_type, resource in [('elbv2', f"arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT_ID}:loadbalancer/app/bench/1"), ('cloudfront', 'E0000000000')]:
+            athena_manager = AthenaManager(FakeSession(state=state), table_catalog=TableCatalog(FakeSession(state=state), path=catalog_path))
+            athena_manager.athena_bucket = 'bench-results'
+            athena_manager.log_prefix = 'AWSLogs'
+            athena_manager.create_athena_database()
+            athena_manager.create_athena_table('bench-logs', resource, log_type, dated_layout=True)
+    seconds, _ = timed(create_tables)
+    api_calls = state.calls
+    # A later session finds both tables in the local catalog cache
+    warm_seconds, _ = timed(create_tables)
+    return {'seconds': seconds, 'api_calls': api_calls, 'warm_seconds': warm_seconds, 'warm_api_calls': state.calls - api_calls}
+
+def bench_poll(args, state):
+    from query_executor import QueryExecutor
+    state.query_seconds = args.query_seconds
+    query_executor = QueryExecutor(FakeSession(state=state), 'bench', 'bench', 'elbv2', 'bench-results')
+    seconds, _ = timed(lambda: query_executor.execute_athena_query("SELECT 1"))
+    # Time between the query finishing and the poller noticing it
+    return {'seconds': seconds, 'overhead_seconds': seconds - args.query_seconds, 'api_calls': state.calls}
+
+def bench_poll_batch(args, state):
+    from query_executor import QueryExecutor
+    state.query_seconds = args.query_seconds
+    state.set_results(ELBV2_COLUMNS[:2], [['https', '2024-05-01T00:00:00Z']])
+    query_executor = QueryExecutor(FakeSession(state=state), 'bench', 'bench', 'elbv2', 'bench-results')
+    queries = [(str(i), f"SELECT {i}") for i in range(args.batch_queries)]
+    seconds, results = timed(lambda: list(query_executor.run_queries(queries, args.max_concurrency)))
+    return {'seconds': seconds, 'queries': len(results), 'api_calls': state.calls}
+
+def bench_decode(args, state, fetch_mode):
+    from query_executor import QueryExecutor
+    state.set_results(ELBV2_COLUMNS, get_result_rows(args.rows, args.seed))
+    query_executor = QueryExecutor(FakeSession(state=state), 'bench', 'bench', 'elbv2', 'bench-results', fetch_mode=fetch_mode)
+    query_execution_id = FakeSession(state=state).client('athena').start_query_execution(QueryString="SELECT * FROM bench")['QueryExecutionId']
+    seconds, df = timed(lambda: query_executor.get_query_results(query_execution_id))
+    return {'seconds': seconds, 'rows': len(df), 'rows_per_s': len(df) / seconds, 'frame_mb': df.memory_usage(deep=True).sum() / 1024 ** 2}
+
+def bench_first_page(args, state, fetch_mode):
+    from query_executor import QueryExecutor
+    state.set_results(ELBV2_COLUMNS, get_result_rows(args.rows, args.seed))
+    query_executor = QueryExecutor(FakeSession(state=state), 'bench', 'bench', 'elbv2', 'bench-results', fetch_mode=fetch_mode)
+    query_execution_id = FakeSession(state=state).client('athena').start_query_execution(QueryString="SELECT * FROM bench")['QueryExecutionId']
+    # Time until the progressive display can show something
+    chunks = query_executor.iter_result_chunks(query_execution_id)
+    seconds, df = timed(lambda: next(chunks))
+    chunks.close()
+    return {'seconds': seconds, 'rows': len(df), 'api_calls': state.calls}
+
+def bench_render(args, state):
+    from query_executor import QueryExecutor
+    import pandas as pd
+
+    state.set_results(ELBV2_COLUMNS, get_result_rows(args.rows, args.seed))
+    query_executor = QueryExecutor(FakeSession(state=state), 'bench', 'bench', 'elbv2', 'bench-results', output_format=args.output_format)
+    df = query_executor.apply_column_types(pd.DataFrame(state.result_rows, columns=[name for name, _ in ELBV2_COLUMNS]), state.result_columns)
+    seconds, _ = timed(lambda: query_executor.display_results(df, pager=False, label='bench'))
+    for name in os.listdir('/tmp'):
+        if '-aws-athena-tool-bench-bench-elbv2-qbench.' in name:
+            os.remove(os.path.join('/tmp', name))
+    return {'seconds': seconds, 'rows': len(df), 'rows_per_s': len(df) / seconds}
+
+def bench_scan_estimate(args, state):
+    from scan_estimator import ScanEstimator
+    prefix = f"AWSLogs/{ACCOUNT_ID}/elasticloadbalancing/eu-west-1/"
+    state.add_objects('bench-logs', [(f"{prefix}2024/{1 + i // (31 * 24) % 12:02d}/{1 + i // 24 % 31:02d}/{i:08d}.log.gz", 1024 * (i % 500 + 1)) for i in range(args.objects)])
+    scan_estimator = ScanEstimator(FakeSession(state=state), f"s3://bench-logs/{prefix}", 'day', cache_path=os.path.join(tempfile.mkdtemp(), 'estimates.json'))
+    seconds, (scanned_bytes, objects) = timed(lambda: scan_estimator.estimate("SELECT * FROM bench"))
+    return {'seconds': seconds, 'objects': objects, 'objects_per_s': objects / seconds, 'api_calls': state.calls}
+
+def bench_local_engine(args, state):
+    try:
+        import duckdb
+    except ImportError:
+        return {'skipped': 'duckdb is not installed'}
+    from local_engine import LocalQueryEngine
+    log_dir = tempfile.mkdtemp()
+    records = generate_elb_records(args.rows, args.seed)
+    files = max(1, args.rows // 50000)
+    for i in range(files):
+        with gzip.open(os.path.join(log_dir, f"{i}.log.gz"), 'wt') as f:
+            f.write("\n".join(format_elb_line(record) for record in records[i::files]) + "\n")
+    cf_dir = tempfile.mkdtemp()
+    with gzip.open(os.path.join(cf_dir, 'E1.2024-05-01-00.bench.gz'), 'wt') as f:
+        f.write("\n".join(generate_cloudfront_lines(args.rows, args.seed)) + "\n")
+    def run():
+        rows = 0
+        for log_type, path, query in [('elbv2', log_dir, 'SELECT count(client_ip) AS retries, client_ip FROM "bench"."elbv2" GROUP BY client_ip ORDER BY retries DESC'),
+                                      ('cloudfront', cf_dir, 'SELECT count(c_ip) AS retries, c_ip FROM "bench"."cloudfront" GROUP BY c_ip ORDER BY retries DESC')]:
+            engine = LocalQueryEngine(log_type, [path], 'bench', log_type)
+            rows += len(engine.run_query(query))
+        return rows
+    seconds, rows = timed(run)
+    return {'seconds': seconds, 'log_lines_per_s': 2 * args.rows / seconds, 'result_rows': rows}
+
+def run_stage(stage, args, connection):
+    # Runs in a forked child: the stage's peak RSS is not mixed with earlier stages and its output does not reach the report
+    try:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        state = FakeState(latency=args.latency_ms / 1000)
+        if stage in ['decode_paginate', 'decode_stream']:
+            result = bench_decode(args, state, 'paginate' if stage == 'decode_paginate' else 's3')
+        elif stage in ['first_page_paginate', 'first_page_stream']:
+            result = bench_first_page(args, state, 'paginate' if stage == 'first_page_paginate' else 's3')
+        else:
+            result = globals()[f"bench_{stage}"](args, state)
+        result['peak_rss_mb'] = read_rss_mb('VmHWM')
+        result['rss_growth_mb'] = result['peak_rss_mb'] - timed.rss_start
+        connection.send(result)
+    except Exception:
+        connection.send({'error': traceback.format_exc()})
+    finally:
+        connection.close()
+
+def measure(stage, args):
+    context = multiprocessing.get_context('fork')
+    runs = []
+    for _ in range(args.repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_stage, args=(stage, args, sender))
+        process.start()
+        result = receiver.recv()
+        process.join()
+        if 'error' in result or 'skipped' in result:
+            return result
+        runs.append(result)
+    # The median run is reported, the other metrics of a stage vary much less than its time
+    median = dict(sorted(runs, key=lambda run: run['seconds'])[len(runs) // 2])
+    median['seconds_min'] = min(run['seconds'] for run in runs)
+    median['seconds_runs'] = [run['seconds'] for run in runs]
+    return median
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return ''
+
+def print_results(results):
+    print(f"{'stage':<22}{'seconds':>10}{'peak RSS':>12}{'RSS growth':>12}  details")
+    for stage, result in results['stages'].items():
+        if 'error' in result or 'skipped' in result:
+            print(f"{stage:<22}\033[91m{result.get('skipped') or result['error'].strip().splitlines()[-1]}\033[00m")
+            continue
+        details = ", ".join(f"{name}={value:.1f}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()
+                            if name not in ['seconds', 'seconds_min', 'seconds_runs', 'peak_rss_mb', 'rss_growth_mb'])
+        print(f"{stage:<22}{result['seconds']:>10.3f}{result['peak_rss_mb']:>9.1f} MB{result['rss_growth_mb']:>9.1f} MB  {details}")
+
+def compare_results(baseline, results, threshold):
+    if baseline['params'] != results['params']:
+        print("\033[93mThe baseline was run with different parameters, the comparison is only indicative.\033[00m")
+    print(f"\n{'stage':<22}{'baseline':>10}{'current':>10}{'change':>9}{'RSS change':>12}")
+    regressions = []
+    for stage, result in results['stages'].items():
+        old = baseline['stages'].get(stage)
+        if not old or 'seconds' not in old or 'seconds' not in result:
+            continue
+        change = result['seconds'] / old['seconds'] - 1 if old['seconds'] else 0.0
+        rss_change = result['rss_growth_mb'] - old['rss_growth_mb']
+        color = '\033[91m' if change > threshold else '\033[92m' if change < -threshold else '\033[00m'
+        print(f"{stage:<22}{old['seconds']:>10.3f}{result['seconds']:>10.3f}{color}{change:>+9.1%}\033[00m{rss_change:>+9.1f} MB")
+        if change > threshold:
+            regressions.append(stage)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="AWS-Athena-Tool benchmarks against a simulated AWS")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages to run")
+    parser.add_argument("--rows", type=int, default=50000, help="Rows of the synthetic result set and log lines of the local engine")
+    parser.add_argument("--load_balancers", type=int, default=200, help="Load balancers per region and CloudFront distributions to discover")
+    parser.add_argument("--regions", type=int, default=3, help="Regions scanned for load balancers")
+    parser.add_argument("--profiles", type=int, default=20, help="Profiles in the generated AWS config")
+    parser.add_argument("--objects", type=int, default=20000, help="Log objects listed by the scan estimate")
+    parser.add_argument("--batch_queries", type=int, default=8, help="Queries of the batch stage")
+    parser.add_argument("--max_concurrency", type=int, default=5, help="Concurrency of the batch stage")
+    parser.add_argument("--query_seconds", type=float, default=2.0, help="Simulated Athena run time of each query")
+    parser.add_argument("--latency_ms", type=float, default=5.0, help="Simulated latency of each AWS API call")
+    parser.add_argument("--output_format", default="table", choices=["table", "csv", "jsonl", "parquet"], help="Format of the render stage")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the median is reported")
+    parser.add_argument("--output", help="JSON file for the results (default benchmarks/results/TIMESTAMP.json)")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown reported as a regression, 0.1 is 10%%")
+    parser.add_argument("--fail_on_regression", action="store_true", help="Exit with status 1 when a stage regressed")
+    args = parser.parse_args()
+
+    params = {name: value for name, value in vars(args).items() if name not in ['stages', 'output', 'compare', 'threshold', 'fail_on_regression', 'repeat']}
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'stages': {},
+    }
+    for stage in args.stages:
+        print(f"Running {stage}...", file=sys.stderr)
+        results['stages'][stage] = measure(stage, args)
+    print_results(results)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{time.strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\033[93mResults saved in {output}\033[00m")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"\033[91mRegressions: {', '.join(regressions)}\033[00m")
+            if args.fail_on_regression:
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
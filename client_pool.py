@@ -0,0 +1,25 @@
+from botocore.config import Config
+import threading
+
+# Sized for the thread pools used by discovery, batches and S3 listings; adaptive retries back off on throttling
+CLIENT_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive=True)
+
+class ClientPool:
+    def __init__(self, config=CLIENT_CONFIG):
+        self.config = config
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get_client(self, session, service, region=None):
+        region = region or session.region_name
+        key = (id(session), service, region)
+        with self.lock:
+            if key not in self.clients:
+                # The session is kept with its clients so its id cannot be reused by another session
+                self.clients[key] = (session, session.client(service, region_name=region, config=self.config))
+            return self.clients[key][1]
+
+client_pool = ClientPool()
+
+def get_client(session, service, region=None):
+    return client_pool.get_client(session, service, region)
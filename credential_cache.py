@@ -0,0 +1,79 @@
+from settings import CACHE_DIR
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+
+# Long-term keys never expire, only the account id is cached for them and checked again after this long
+IDENTITY_TTL_HOURS = 12
+
+class CredentialCache:
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'credentials'), refresh_margin_minutes=10):
+        self.cache_dir = cache_dir
+        self.refresh_margin_minutes = refresh_margin_minutes
+        self.fernet = None
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    def get_fernet(self):
+        if self.fernet is None:
+            from cryptography.fernet import Fernet
+
+            key = os.environ.get('AWS_ATHENA_TOOL_CACHE_KEY')
+            if not key:
+                key_path = os.path.join(self.cache_dir, 'key')
+                if not os.path.exists(key_path):
+                    # Created readable by the owner only, a concurrent run that won the race keeps its key
+                    try:
+                        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, 'wb') as f:
+                            f.write(Fernet.generate_key())
+                    except FileExistsError:
+                        pass
+                with open(key_path, 'rb') as f:
+                    key = f.read().strip()
+            self.fernet = Fernet(key)
+        return self.fernet
+
+    def get_path(self, profile, region):
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(f'{profile}|{region}'.encode()).hexdigest()}.bin")
+
+    def get(self, profile, region):
+        path = self.get_path(profile, region)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(self.get_fernet().decrypt(f.read()))
+        except Exception as e:
+            print(f"Error reading cached credentials: {e}")
+            os.remove(path)
+            return None
+        # Credentials about to expire are not reused, a query started with them could fail halfway
+        if datetime.fromisoformat(entry['expiration']) - timedelta(minutes=self.refresh_margin_minutes) <= datetime.now(timezone.utc):
+            os.remove(path)
+            return None
+        return entry
+
+    def put(self, profile, region, account_id, credentials=None):
+        if credentials:
+            expiration = credentials['Expiration']
+            credentials = {name: value for name, value in credentials.items() if name != 'Expiration'}
+        else:
+            expiration = datetime.now(timezone.utc) + timedelta(hours=IDENTITY_TTL_HOURS)
+        entry = {'account_id': account_id, 'credentials': credentials, 'expiration': expiration.isoformat()}
+        path = self.get_path(profile, region)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.get_fernet().encrypt(json.dumps(entry).encode()))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error caching credentials: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, profile, region):
+        path = self.get_path(profile, region)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,76 @@
+from settings import CACHE_DIR
+import argparse
+import json
+import os
+import socket
+
+SOCKET_PATH = os.path.join(CACHE_DIR, 'daemon.sock')
+
+class DaemonClient:
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+
+    def request(self, payload):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket_path)
+            client.sendall((json.dumps(payload) + "\n").encode())
+            with client.makefile('rb') as response:
+                return json.loads(response.readline())
+
+    def is_running(self):
+        try:
+            return self.request({'command': 'status'}).get('status') == 'ok'
+        except (OSError, ValueError):
+            return False
+
+    def main(self, argv):
+        parser = argparse.ArgumentParser(prog="main.py client", description="Run a query in the aws-athena-tool daemon")
+        parser.add_argument("--socket", default=self.socket_path, help="Unix socket of the daemon")
+        parser.add_argument("--status", action="store_true", help="List the resources the daemon keeps ready")
+        parser.add_argument("--shutdown", action="store_true", help="Stop the daemon")
+        parser.add_argument("--profile", help="AWS CLI profile name")
+        parser.add_argument("--region", help="AWS region")
+        parser.add_argument("--log_type", choices=["cloudfront", "elbv2"], help="Log type")
+        parser.add_argument("--selected_resource", help="Cloudfront distribution ID or LB ARN")
+        parser.add_argument("--fleet", action="store_true", help="Query every resource of --log_type with logs enabled")
+        parser.add_argument("--scan_regions", nargs="+", help="Regions scanned for ALBs in fleet mode")
+        parser.add_argument("--query_choice", default="1", help="Number of the predefined query")
+        parser.add_argument("--query", help="Custom query, use @@@athena_database@@@ and @@@athena_table@@@ for the table")
+        parser.add_argument("--value", action="append", default=[], metavar="NAME=VALUE", help="Value of a query placeholder, for example endpoint=/api")
+        parser.add_argument("--output_format", help="Format of the result file saved by the daemon")
+        parser.add_argument("--max_rows", type=int, help="Rows printed, the full result is in the saved file")
+        parser.add_argument("--json", action="store_true", help="Print the response as JSON")
+        args = parser.parse_args(argv)
+        self.socket_path = args.socket
+
+        if args.status:
+            payload = {'command': 'status'}
+        elif args.shutdown:
+            payload = {'command': 'shutdown'}
+        else:
+            if not (args.profile and args.region and args.log_type):
+                parser.error("--profile, --region and --log_type are required")
+            payload = {'command': 'query', 'profile': args.profile, 'region': args.region, 'log_type': args.log_type,
+                       'selected_resource': args.selected_resource, 'fleet': args.fleet, 'scan_regions': args.scan_regions,
+                       'query_choice': args.query_choice, 'query': args.query, 'output_format': args.output_format, 'max_rows': args.max_rows,
+                       'values': dict(value.split("=", 1) for value in args.value)}
+        try:
+            response = self.request(payload)
+        except OSError as e:
+            print(f"\033[91mError connecting to the daemon on {self.socket_path}: {e}. Start it with: python main.py daemon\033[00m")
+            return 1
+        if args.json:
+            print(json.dumps(response))
+        elif response['status'] != 'ok':
+            print(f"\033[91mError: {response['error']}\033[00m")
+        elif 'rows' in response:
+            from tabulate import tabulate
+
+            print(tabulate(response['rows'], headers=response['columns'], tablefmt='simple'))
+            if response['total_rows'] > len(response['rows']):
+                print(f"... {response['total_rows'] - len(response['rows'])} more rows in {response['file']}")
+            print(f"\033[93mAthena query results saved in {response['file']}\033[00m")
+        elif 'workspaces' in response:
+            for workspace in response['workspaces']:
+                print(f"{workspace['profile']} {workspace['region']} {workspace['log_type']} {workspace['selected_resource'] or 'fleet'}: {workspace['table']}")
+        return 0 if response['status'] == 'ok' else 1
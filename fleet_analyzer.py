@@ -0,0 +1,162 @@
+from athena_utils import AthenaManager
+from concurrent.futures import ThreadPoolExecutor
+from query_history import format_bytes
+from scan_estimator import ScanEstimator
+from table_catalog import TableCatalog
+from logger import Logger
+import hashlib
+import re
+
+# Athena runs 20 DML queries at a time per account in most regions
+FLEET_MAX_CONCURRENCY = 20
+# How the partial results of each table are combined into the fleet result
+MERGE_FUNCTIONS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max', 'min_distinct': 'min', 'max_distinct': 'max'}
+
+def get_aggregations(query):
+    select_list = re.split(r'\bFROM\b', query, maxsplit=1, flags=re.IGNORECASE)[0]
+    # count(DISTINCT ...) and sum(DISTINCT ...) of each part can't be added up, the same value can appear in several parts
+    return {alias.lower(): function.lower() + ('_distinct' if distinct else '')
+            for function, distinct, alias in re.findall(r'\b(\w+)\s*\(\s*(DISTINCT\b)?[^()]*\)\s+AS\s+"?(\w+)"?', select_list, re.IGNORECASE)}
+
+def is_mergeable(query):
+    aggregations = get_aggregations(query)
+    return bool(aggregations) and all(function in MERGE_FUNCTIONS for function in aggregations.values())
+
+def get_partial_query(query):
+    # Partial results are merged before the top rows are picked, a LIMIT on each of them would drop rows that add up later
+    return re.sub(r'\bLIMIT\s+\d+\s*;?\s*$', '', query.strip().rstrip(';'), flags=re.IGNORECASE)
+
+def combine_aggregates(df, aggregations):
+    # Partial results of the same query combined into one, None when their aggregates can't be combined, such as averages
+    value_columns = [column for column in df.columns if column.lower() in aggregations]
+    if not value_columns or any(aggregations[column.lower()] not in MERGE_FUNCTIONS for column in value_columns):
+        return None
+    key_columns = [column for column in df.columns if column not in value_columns]
+    functions = {column: MERGE_FUNCTIONS[aggregations[column.lower()]] for column in value_columns}
+    if key_columns:
+        return df.groupby(key_columns, dropna=False, observed=True, sort=False).agg(functions).reset_index()[list(df.columns)]
+    return df.agg(functions).to_frame().T
+
+def apply_order_and_limit(query, df):
+    order = re.search(r'\bORDER\s+BY\s+"?(\w+)"?(\s+DESC)?', query, re.IGNORECASE)
+    if order and order.group(1) in df.columns:
+        df = df.sort_values(order.group(1), ascending=not order.group(2), ignore_index=True)
+    limit = re.search(r'\bLIMIT\s+(\d+)', query, re.IGNORECASE)
+    if limit:
+        df = df.head(int(limit.group(1)))
+    return df
+
+class FleetAnalyzer:
+    def __init__(self, session, log_checker, log_type, account_id, query_history=None, scan_estimate=True, max_workers=16):
+        self.session = session
+        self.log_checker = log_checker
+        self.log_type = log_type
+        self.account_id = account_id
+        self.query_history = query_history
+        self.scan_estimate = scan_estimate
+        self.max_workers = max_workers
+        self.logger = Logger()
+        self.query_executor = None
+        self.table_catalog = TableCatalog(session)
+        self.groups = []
+
+    def get_location(self, name, resource):
+        if self.log_type == 'elbv2':
+            return self.log_checker.get_elb_log_path(self.account_id, resource['region'], prefix=resource['prefix']), True
+        if self.log_checker.has_dated_cloudfront_logs(resource['bucket'], name, resource['prefix']):
+            return self.log_checker.get_cloudfront_log_path(name, resource['prefix']), True
+        return resource['prefix'], False
+
+    def plan_groups(self, resources):
+        # Resources writing to the same place share one table, ALBs of a region usually log to the same bucket
+        names = list(resources)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            locations = list(executor.map(lambda name: self.get_location(name, resources[name]), names))
+        groups = {}
+        for name, (log_prefix, dated_layout) in zip(names, locations):
+            resource = resources[name]
+            athena_manager = AthenaManager(self.session, table_catalog=self.table_catalog)
+            athena_manager.log_prefix = log_prefix
+            location = athena_manager.get_table_location(resource['bucket'], self.log_type, dated_layout)
+            group = groups.setdefault(location, {'bucket': resource['bucket'], 'log_prefix': log_prefix, 'dated_layout': dated_layout, 'location': location, 'names': [], 'resources': []})
+            group['names'].append(name)
+            group['resources'].append(resource['arn'])
+        self.groups = list(groups.values())
+        return self.groups
+
+    def create_table(self, group, athena_database):
+        athena_manager = AthenaManager(self.session, table_catalog=self.table_catalog)
+        athena_manager.athena_database = athena_database
+        athena_manager.athena_bucket = group['bucket']
+        athena_manager.log_prefix = group['log_prefix']
+        # Resources in different regions can share a name, a hash of the location keeps their tables apart
+        location_hash = hashlib.sha1(group['location'].encode()).hexdigest()[:8]
+        table_suffix = f"{athena_manager.get_table_suffix(group['resources'][0])}_{location_hash}"
+        athena_manager.create_athena_table(group['bucket'], table_suffix, self.log_type, group['dated_layout'])
+        group['table'] = athena_manager.athena_table
+        group['location'] = athena_manager.table_location
+        group['scan_estimator'] = ScanEstimator(self.session, athena_manager.table_location, athena_manager.partition_column, self.query_history)
+
+    def create_tables(self, athena_database):
+        # Known tables are skipped by the catalog, the others are created at the same time
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda group: self.create_table(group, athena_database), self.groups))
+        self.logger.log(f"Querying {sum(len(group['resources']) for group in self.groups)} resources through {len(self.groups)} tables.", "cyan")
+
+    def print_scan_estimate(self, query):
+        if not self.scan_estimate:
+            return
+        total_bytes, objects, seconds = 0, 0, 0
+        try:
+            for group in self.groups:
+                scanned_bytes, group_objects = group['scan_estimator'].estimate(self.get_group_query(query, group))
+                total_bytes += scanned_bytes
+                objects += group_objects
+                # The tables are queried at the same time, the largest one sets the runtime
+                seconds = max(seconds, scanned_bytes / group['scan_estimator'].get_scan_rate())
+        except Exception as e:
+            print(f"Error estimating the scan size: {e}")
+            return
+        runtime = f"{seconds / 60:.1f} min" if seconds >= 60 else f"{seconds:.0f}s"
+        print(f"\033[96mEstimated scan of the fleet: up to {format_bytes(total_bytes)} in {objects} objects over {len(self.groups)} tables, about {self.query_history.get_cost(total_bytes):.4f} USD and {runtime}.\033[00m")
+
+    def get_group_query(self, query, group):
+        return query.replace('@@@athena_table@@@', group['table'])
+
+    def merge_results(self, query, results):
+        import pandas as pd
+
+        results = [(group, df) for group, df in results if df is not None]
+        if not results:
+            return None
+        merged = combine_aggregates(pd.concat([df for _, df in results], ignore_index=True), get_aggregations(query))
+        if merged is None:
+            # Raw rows or aggregates that can't be combined, such as averages, are listed per table
+            merged = pd.concat([df.assign(resource=', '.join(group['names'])) for group, df in results], ignore_index=True)
+        return apply_order_and_limit(query, merged)
+
+    def run_queries(self, queries, max_concurrency=FLEET_MAX_CONCURRENCY):
+        # Each query runs once per table, the partial results are merged as soon as all tables answered
+        group_queries = []
+        owners = {}
+        for label, query, *parameters in queries:
+            self.print_scan_estimate(query)
+            partial_query = get_partial_query(query) if is_mergeable(query) else query
+            for group in self.groups:
+                group_query = self.get_group_query(partial_query, group)
+                owners[(label, group_query)] = group
+                group_queries.append((label, group_query, *parameters))
+        results = {label: [] for label, *_ in queries}
+        batch = self.query_executor.run_queries(group_queries, max_concurrency)
+        try:
+            for label, group_query, df in batch:
+                results[label].append((owners[(label, group_query)], df))
+                if len(results[label]) == len(self.groups):
+                    query = {label: query for label, query, *_ in queries}[label]
+                    yield label, query, self.merge_results(query, results[label])
+        finally:
+            batch.close()
+
+    def run_query(self, query, template=None, max_concurrency=FLEET_MAX_CONCURRENCY, parameters=None):
+        for _, _, df in self.run_queries([(template or '1', query, parameters)], max_concurrency):
+            return df
@@ -0,0 +1,132 @@
+from athena_utils import CLOUDFRONT_COLUMNS, ELBV2_COLUMNS, ELBV2_INPUT_REGEX
+from concurrent.futures import ThreadPoolExecutor
+from client_pool import get_client
+from settings import CACHE_DIR
+import os
+import re
+
+DUCKDB_TYPES = {
+    'string': 'VARCHAR',
+    'int': 'INTEGER',
+    'bigint': 'BIGINT',
+    'double': 'DOUBLE',
+    'float': 'FLOAT',
+    'date': 'DATE',
+}
+
+# Java date patterns used by Athena's parse_datetime and their strptime equivalents
+JAVA_DATE_TOKENS = [('yyyy', '%Y'), ('MM', '%m'), ('dd', '%d'), ('HH', '%H'), ('mm', '%M'), ('ss', '%S')]
+
+class LocalQueryEngine:
+    def __init__(self, log_type, paths, athena_database, athena_table, session=None, cache_dir=os.path.join(CACHE_DIR, 'logs'), max_workers=16):
+        self.log_type = log_type
+        self.paths = paths
+        self.athena_database = athena_database
+        self.athena_table = athena_table
+        self.session = session
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.connection = None
+
+    def sync_s3_prefix(self, s3_uri):
+        bucket, _, prefix = s3_uri.replace('s3://', '', 1).partition('/')
+        local_dir = os.path.join(self.cache_dir, bucket, prefix)
+        from tqdm import tqdm
+
+        s3_client = get_client(self.session, 's3')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        downloads = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('/'):
+                    continue
+                local_path = os.path.join(self.cache_dir, bucket, obj['Key'])
+                # Log objects are never rewritten, a local copy of the same size is up to date
+                if not os.path.exists(local_path) or os.path.getsize(local_path) != obj['Size']:
+                    downloads.append((obj['Key'], local_path))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, tqdm(total=len(downloads), desc=f"Syncing {s3_uri}") as pbar:
+            def download(download_item):
+                key, local_path = download_item
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                s3_client.download_file(bucket, key, f"{local_path}.tmp")
+                os.replace(f"{local_path}.tmp", local_path)
+                pbar.update(1)
+            list(executor.map(download, downloads))
+        return local_dir
+
+    def get_log_files(self):
+        files = []
+        for path in self.paths:
+            if path.startswith('s3://'):
+                path = self.sync_s3_prefix(path)
+            if os.path.isfile(path):
+                files.append(path)
+                continue
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if not name.endswith('.tmp'))
+        return files
+
+    def get_column_expressions(self, columns, values):
+        expressions = []
+        for i, (name, column_type) in enumerate(columns):
+            duckdb_type = DUCKDB_TYPES[column_type.lower()]
+            value = values(i, name)
+            if duckdb_type == 'VARCHAR':
+                expressions.append(f'{value} AS "{name}"')
+            else:
+                # Like the SerDe, fields such as '-' that are not valid for the column type become NULL
+                expressions.append(f'TRY_CAST({value} AS {duckdb_type}) AS "{name}"')
+        return expressions
+
+    def load(self):
+        import duckdb
+
+        files = self.get_log_files()
+        if not files:
+            raise ValueError(f"No log files found in {', '.join(self.paths)}")
+        print(f"Loading {len(files)} log files...")
+        self.connection = duckdb.connect()
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.athena_database}"')
+        # Athena's approximate aggregates under DuckDB names
+        self.connection.execute("CREATE MACRO approx_percentile(x, percentage) AS approx_quantile(x, percentage)")
+        self.connection.execute("CREATE MACRO approx_distinct(x) AS approx_count_distinct(x)")
+        # Each file is read line by line and decompressed by DuckDB, parsing runs vectorized inside the engine
+        lines = "read_csv($files, columns={'line': 'VARCHAR'}, delim='\\x1f', header=false, quote='', escape='', auto_detect=false)"
+        if self.log_type == 'elbv2':
+            names = [name for name, _ in ELBV2_COLUMNS]
+            columns = self.get_column_expressions(ELBV2_COLUMNS, lambda i, name: f"NULLIF(fields['{name}'], '')")
+            query = f"""CREATE TABLE "{self.athena_database}"."{self.athena_table}" AS
+                SELECT {', '.join(columns)}, replace(substr(fields['time'], 1, 10), '-', '/') AS "day"
+                FROM (SELECT regexp_extract(line, $regex, {names!r}) AS fields FROM {lines} WHERE regexp_full_match(line, $regex))"""
+            self.connection.execute(query, {'files': files, 'regex': ELBV2_INPUT_REGEX})
+        else:
+            columns = self.get_column_expressions(CLOUDFRONT_COLUMNS, lambda i, name: f"fields[{i + 1}]")
+            query = f"""CREATE TABLE "{self.athena_database}"."{self.athena_table}" AS
+                SELECT *, strftime("date", '%Y/%m/%d') AS "dt" FROM (
+                SELECT {', '.join(columns)}
+                FROM (SELECT string_split(line, '\t') AS fields FROM {lines} WHERE NOT starts_with(line, '#')))"""
+            self.connection.execute(query, {'files': files})
+        rows = self.connection.execute(f'SELECT count(*) FROM "{self.athena_database}"."{self.athena_table}"').fetchone()[0]
+        print(f"\033[92mLoaded {rows} log lines into the local table {self.athena_table}.\033[00m")
+
+    def translate_query(self, query):
+        def translate_format(match):
+            date_format = match.group(2)
+            for java_token, strptime_token in JAVA_DATE_TOKENS:
+                date_format = date_format.replace(java_token, strptime_token)
+            return f"strptime({match.group(1)}, '{date_format}')"
+        query = re.sub(r"parse_datetime\(\s*('(?:[^']|'')*')\s*,\s*'([^']*)'\s*\)", translate_format, query, flags=re.IGNORECASE)
+        # DuckDB reads a Bernoulli sample size as a row count unless it is given as a percentage
+        return re.sub(r"TABLESAMPLE\s+BERNOULLI\s*\(\s*([\d.]+)\s*\)", r"TABLESAMPLE bernoulli(\1%)", query, flags=re.IGNORECASE)
+
+    def run_query(self, query):
+        if self.connection is None:
+            self.load()
+        print(f"\033[92m{query}\033[00m")
+        try:
+            df = self.connection.execute(self.translate_query(query)).df()
+        except Exception as e:
+            print(f"Local query failed: {e}")
+            return None
+        print("Local query executed successfully.")
+        return df
@@ -1,56 +1,123 @@
-from tqdm import tqdm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from client_pool import get_client
+from settings import CACHE_DIR
 import botocore
+import json
+import os
+import time
 
 class LogChecker:
-    def __init__(self, session):
+    def __init__(self, session, account_id='', discovery_ttl=3600, max_workers=16, cache_dir=os.path.join(CACHE_DIR, 'discovery')):
         self.session = session
+        self.account_id = account_id
         self.today = datetime.today()
         self.default_year = self.today.strftime("%Y")
         self.default_month = self.today.strftime("%m")
         self.default_day = self.today.strftime("%d")
         self.log_prefix = ''
+        # Discovered resources by name: {'arn', 'bucket', 'prefix', 'region'}
+        self.resources = {}
+        self.discovery_ttl = discovery_ttl
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
 
-    def get_elb_with_logs_enabled(self):
-        elb_client = self.session.client('elbv2')
-        load_balancers = elb_client.describe_load_balancers()
-        log_enabled_elbs = {}
-
-        total_lb = len(load_balancers['LoadBalancers'])
-        with tqdm(total=total_lb, desc="Fetching ELBv2 load balancers") as pbar:
-            for lb in load_balancers['LoadBalancers']:
-                lb_name = lb.get('LoadBalancerName')
-                attributes = elb_client.describe_load_balancer_attributes(LoadBalancerArn=lb['LoadBalancerArn'])
-                for attr in attributes['Attributes']:
-                    if attr['Key'] == 'access_logs.s3.enabled' and attr['Value'] == 'true':
-                        for attr in attributes['Attributes']:
-                            if attr['Key'] == 'access_logs.s3.bucket':
-                                for attr_prefix in attributes['Attributes']:
-                                    if attr_prefix['Key'] == 'access_logs.s3.prefix':
-                                        self.log_prefix = attr_prefix['Value']
-                                log_bucket_name = attr['Value']
-                        log_enabled_elbs[lb_name] = log_bucket_name
-                pbar.update(1)
-        return log_enabled_elbs
-
-    def get_cloudfront_with_logs_enabled(self):
-        cf_client = self.session.client('cloudfront')
-        distributions = cf_client.list_distributions()
-        log_enabled_distributions = {}
-
-        total_dist = len(distributions['DistributionList']['Items'])
-        with tqdm(total=total_dist, desc="Fetching CloudFront distributions") as pbar:
-            for dist in distributions['DistributionList']['Items']:
-                dist_id = dist.get('Id')
-                config = cf_client.get_distribution_config(Id=dist_id)
-                if config['DistributionConfig']['Logging']['Enabled']:
-                    log_enabled_distributions[dist_id] = config['DistributionConfig']['Logging']['Bucket'].split('.s3')[0]
-                    self.log_prefix = config['DistributionConfig']['Logging']['Prefix']
-                pbar.update(1)
-        return log_enabled_distributions
+    def get_cache_path(self, log_type, regions):
+        return os.path.join(self.cache_dir, f"{self.account_id}-{log_type}-{'_'.join(sorted(regions))}.json")
+
+    def load_discovery_cache(self, log_type, regions):
+        cache_path = self.get_cache_path(log_type, regions)
+        if self.discovery_ttl <= 0 or not os.path.exists(cache_path):
+            return None
+        with open(cache_path) as f:
+            cached = json.load(f)
+        age = time.time() - cached['created']
+        if age > self.discovery_ttl:
+            return None
+        print(f"\033[93mUsing resources discovered {int(age / 60)} minutes ago.\033[00m")
+        return cached['resources']
+
+    def save_discovery_cache(self, log_type, regions, resources):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        with open(self.get_cache_path(log_type, regions), 'w') as f:
+            json.dump({'created': time.time(), 'resources': resources}, f, indent=2)
+
+    def get_elb_log_settings(self, attributes):
+        attributes = {attr['Key']: attr['Value'] for attr in attributes['Attributes']}
+        if attributes.get('access_logs.s3.enabled') != 'true' or not attributes.get('access_logs.s3.bucket'):
+            return None
+        return attributes['access_logs.s3.bucket'], attributes.get('access_logs.s3.prefix', '')
+
+    def list_load_balancers(self, elb_client):
+        paginator = elb_client.get_paginator('describe_load_balancers')
+        load_balancers = []
+        for page in paginator.paginate():
+            load_balancers.extend(page['LoadBalancers'])
+        return load_balancers
+
+    def get_elb_with_logs_enabled(self, regions=None, use_cache=True):
+        from tqdm import tqdm
+
+        regions = regions or [self.session.region_name]
+        resources = self.load_discovery_cache('elbv2', regions) if use_cache else None
+        if resources is None:
+            resources = {}
+            # Clients are created up front, creating them from several threads is not thread-safe
+            elb_clients = {region: get_client(self.session, 'elbv2', region) for region in regions}
+            with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+                load_balancers = list(executor.map(lambda region: (region, self.list_load_balancers(elb_clients[region])), regions))
+            load_balancers = [(region, lb) for region, region_lbs in load_balancers for lb in region_lbs]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor, tqdm(total=len(load_balancers), desc="Fetching ELBv2 load balancers") as pbar:
+                futures = {executor.submit(elb_clients[region].describe_load_balancer_attributes, LoadBalancerArn=lb['LoadBalancerArn']): (region, lb)
+                           for region, lb in load_balancers}
+                for future in as_completed(futures):
+                    region, lb = futures[future]
+                    pbar.update(1)
+                    try:
+                        log_settings = self.get_elb_log_settings(future.result())
+                    except botocore.exceptions.ClientError as e:
+                        print(f"Error checking ELBv2 logs of {lb['LoadBalancerName']}: {e}")
+                        continue
+                    if log_settings:
+                        lb_name = lb['LoadBalancerName'] if len(regions) == 1 else f"{region}/{lb['LoadBalancerName']}"
+                        resources[lb_name] = {'arn': lb['LoadBalancerArn'], 'bucket': log_settings[0], 'prefix': log_settings[1], 'region': region}
+            self.save_discovery_cache('elbv2', regions, resources)
+        self.resources = resources
+        return {name: resource['bucket'] for name, resource in sorted(resources.items())}
+
+    def get_cloudfront_with_logs_enabled(self, use_cache=True):
+        from tqdm import tqdm
+
+        resources = self.load_discovery_cache('cloudfront', ['global']) if use_cache else None
+        if resources is None:
+            resources = {}
+            cf_client = get_client(self.session, 'cloudfront')
+            paginator = cf_client.get_paginator('list_distributions')
+            distributions = []
+            for page in paginator.paginate():
+                distributions.extend(page['DistributionList'].get('Items', []))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor, tqdm(total=len(distributions), desc="Fetching CloudFront distributions") as pbar:
+                futures = {executor.submit(cf_client.get_distribution_config, Id=dist['Id']): dist['Id'] for dist in distributions}
+                for future in as_completed(futures):
+                    dist_id = futures[future]
+                    pbar.update(1)
+                    try:
+                        logging = future.result()['DistributionConfig']['Logging']
+                    except botocore.exceptions.ClientError as e:
+                        print(f"Error checking CloudFront logs of {dist_id}: {e}")
+                        continue
+                    if logging['Enabled']:
+                        resources[dist_id] = {'arn': dist_id, 'bucket': logging['Bucket'].split('.s3')[0], 'prefix': logging['Prefix'], 'region': 'global'}
+            self.save_discovery_cache('cloudfront', ['global'], resources)
+        self.resources = resources
+        return {name: resource['bucket'] for name, resource in sorted(resources.items())}
+
+    def select_resource(self, name):
+        self.log_prefix = self.resources[name]['prefix']
+        return self.resources[name]
 
     def check_cloudfront_logs_enabled(self, distribution_id):
-        cf_client = self.session.client('cloudfront')
+        cf_client = get_client(self.session, 'cloudfront')
         try:
             distribution_config = cf_client.get_distribution_config(Id=distribution_id)
             if 'Logging' in distribution_config['DistributionConfig'] and distribution_config['DistributionConfig']['Logging']['Enabled']:
@@ -63,19 +130,14 @@ class LogChecker:
             return False
 
     def check_elbv2_logs_enabled(self, elb_arn):
-        elb_client = self.session.client('elbv2')
+        elb_client = get_client(self.session, 'elbv2')
         try:
             attributes = elb_client.describe_load_balancer_attributes(LoadBalancerArn=elb_arn)
-            for attr in attributes['Attributes']:
-                if attr['Key'] == 'access_logs.s3.enabled' and attr['Value'] == 'true':
-                    for attr in attributes['Attributes']:
-                        if attr['Key'] == 'access_logs.s3.bucket':
-                            for attr_prefix in attributes['Attributes']:
-                                if attr_prefix['Key'] == 'access_logs.s3.prefix':
-                                    self.log_prefix = attr_prefix['Value']
-                            log_bucket_name = attr['Value']
-                    return log_bucket_name
-            return False
+            log_settings = self.get_elb_log_settings(attributes)
+            if not log_settings:
+                return False
+            log_bucket_name, self.log_prefix = log_settings
+            return log_bucket_name
         except Exception as e:
             print(f"Error checking ELBv2 logs: {e}")
             return False
@@ -93,9 +155,7 @@ class LogChecker:
                         day = self.default_day
 
             if self.check_is_valid_date(year, month, day):
-                s3_path = f"AWSLogs/{account_id}/elasticloadbalancing/{region}/{year}/{month}/{day}"
-                if self.log_prefix != '':
-                    s3_path = f"{self.log_prefix}/{s3_path}"
+                s3_path = self.get_elb_log_path(account_id, region, year, month, day)
                 if self.check_s3_path_exists(bucket_name, s3_path):
                     self.log_prefix = s3_path
                     break
@@ -104,8 +164,32 @@ class LogChecker:
             else:
                 print("Invalid input. Please enter a valid year, month, and day.")
 
+    def get_elb_log_path(self, account_id, region, year=None, month=None, day=None, prefix=None):
+        # prefix defaults to the one of the selected resource
+        prefix = self.log_prefix if prefix is None else prefix
+        s3_path = f"AWSLogs/{account_id}/elasticloadbalancing/{region}"
+        if year:
+            s3_path = f"{s3_path}/{year}/{month}/{day}"
+        if prefix != '':
+            s3_path = f"{prefix}/{s3_path}"
+        return s3_path
+
+    def get_cloudfront_log_path(self, distribution_id, prefix=None):
+        prefix = (self.log_prefix if prefix is None else prefix).strip('/')
+        return f"{prefix}/{distribution_id}" if prefix else distribution_id
+
+    def has_dated_cloudfront_logs(self, bucket, distribution_id, prefix=None):
+        # Date partitioned delivery writes {prefix}/{DistributionId}/{yyyy}/{MM}/{dd}/{HH}/, legacy delivery writes flat files
+        s3_client = get_client(self.session, 's3')
+        try:
+            response = s3_client.list_objects_v2(Bucket=bucket, Prefix=f"{self.get_cloudfront_log_path(distribution_id, prefix)}/", MaxKeys=1)
+            return response.get('KeyCount', 0) > 0
+        except botocore.exceptions.ClientError as e:
+            print(f"Error checking CloudFront log layout: {e}")
+            return False
+
     def check_s3_path_exists(self, bucket, path):
-        s3_client = self.session.client('s3')
+        s3_client = get_client(self.session, 's3')
         try:
             path = path.rstrip('/') 
             s3_client.list_objects(Bucket=bucket, Prefix=path, Delimiter='/', MaxKeys=1)
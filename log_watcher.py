@@ -0,0 +1,133 @@
+from aws_auth import SessionExpiredError
+from client_pool import get_client
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fleet_analyzer import get_aggregations, combine_aggregates, apply_order_and_limit, get_partial_query, is_mergeable
+from local_engine import LocalQueryEngine
+from query_executor import QueryExecutor
+from query_history import format_bytes
+from query_templates import inline_parameters
+from settings import CACHE_DIR
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_WATCH_INTERVAL = 60
+DEFAULT_WATCH_MINUTES = 60
+# Objects can appear in a listing a little after their LastModified time, the ones this close to the mark are checked again
+LISTING_GRACE_SECONDS = 300
+
+class LogWatcher:
+    def __init__(self, session, log_type, table_location, athena_database, athena_table, interval=DEFAULT_WATCH_INTERVAL, lookback_minutes=DEFAULT_WATCH_MINUTES,
+                 top_rows=20, output_format='table', cache_dir=CACHE_DIR, max_workers=16):
+        self.session = session
+        self.log_type = log_type
+        self.table_location = table_location
+        self.athena_database = athena_database
+        self.athena_table = athena_table
+        self.interval = interval
+        self.lookback = timedelta(minutes=lookback_minutes)
+        self.top_rows = top_rows
+        self.output_format = output_format
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.started = None
+        # High-water mark on LastModified, the keys processed since shortly before it are remembered to skip them
+        self.watermark = None
+        self.processed = {}
+        self.running = None
+        self.objects_read = 0
+        self.bytes_read = 0
+
+    def get_day_prefixes(self, since):
+        # The logs are stored in a folder per day, only the folders since the mark are listed
+        bucket, _, prefix = self.table_location.replace('s3://', '', 1).partition('/')
+        day = since.date()
+        prefixes = []
+        while day <= datetime.now(timezone.utc).date():
+            prefixes.append(f"{prefix}{day.strftime('%Y/%m/%d')}/")
+            day += timedelta(days=1)
+        return bucket, prefixes
+
+    def list_new_objects(self):
+        since = self.watermark - timedelta(seconds=LISTING_GRACE_SECONDS) if self.watermark else self.started
+        bucket, prefixes = self.get_day_prefixes(since)
+        s3_client = get_client(self.session, 's3')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        objects = []
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                objects.extend(obj for obj in page.get('Contents', []) if obj['LastModified'] >= since and obj['Key'] not in self.processed)
+        return bucket, objects
+
+    def download(self, bucket, objects, download_dir):
+        s3_client = get_client(self.session, 's3')
+
+        def download_object(obj):
+            local_path = os.path.join(download_dir, obj['Key'].replace('/', '_'))
+            s3_client.download_file(bucket, obj['Key'], local_path)
+            return local_path
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(download_object, objects))
+
+    def mark_processed(self, objects):
+        for obj in objects:
+            self.processed[obj['Key']] = obj['LastModified']
+        self.watermark = max([self.watermark or self.started] + [obj['LastModified'] for obj in objects])
+        forget_before = self.watermark - timedelta(seconds=LISTING_GRACE_SECONDS)
+        self.processed = {key: modified for key, modified in self.processed.items() if modified >= forget_before}
+
+    def run_cycle(self, query):
+        bucket, objects = self.list_new_objects()
+        if not objects:
+            return None
+        # Each cycle downloads into its own folder, other watchers and runs share the cache folder
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        download_dir = tempfile.mkdtemp(prefix='watch-', dir=self.cache_dir)
+        try:
+            paths = self.download(bucket, objects, download_dir)
+            local_engine = LocalQueryEngine(self.log_type, paths, self.athena_database, self.athena_table)
+            query_executor = QueryExecutor(None, self.athena_database, self.athena_table, self.log_type, '', local_engine=local_engine, output_format=self.output_format)
+            partial = query_executor.run_query(get_partial_query(query))
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        if partial is None:
+            return None
+        if self.running is None:
+            self.running = partial
+        else:
+            import pandas as pd
+
+            self.running = combine_aggregates(pd.concat([self.running, partial], ignore_index=True), get_aggregations(query))
+        self.mark_processed(objects)
+        self.objects_read += len(objects)
+        self.bytes_read += sum(obj['Size'] for obj in objects)
+        return len(objects)
+
+    def watch(self, query, parameters=None, label='watch'):
+        query = inline_parameters(query, parameters)
+        if not is_mergeable(query):
+            print("\033[91mWatch mode needs a query whose columns are counted, summed, or use min or max with an alias, such as count(client_ip) AS retries.\033[00m")
+            return
+        self.started = datetime.now(timezone.utc) - self.lookback
+        display_executor = QueryExecutor(None, self.athena_database, self.athena_table, self.log_type, '', output_format=self.output_format)
+        print(f"\033[96mWatching {self.table_location} every {self.interval}s, press Ctrl-C to stop.\033[00m")
+        try:
+            while True:
+                cycle_started = time.monotonic()
+                try:
+                    new_objects = self.run_cycle(query)
+                except SessionExpiredError:
+                    raise
+                except Exception as e:
+                    # The mark only moves after a cycle succeeded, the same files are read again next time
+                    print(f"Error watching {self.table_location}: {e}")
+                else:
+                    print(f"\033[96m{datetime.now().strftime('%H:%M:%S')} {new_objects or 0} new log objects, {self.objects_read} objects and {format_bytes(self.bytes_read)} read since {self.started.strftime('%Y-%m-%d %H:%M')} UTC.\033[00m")
+                    if self.running is not None and new_objects:
+                        top = apply_order_and_limit(query, self.running).head(self.top_rows)
+                        display_executor.display_results(top, pager=False, label=label, preview_rows=self.top_rows)
+                time.sleep(max(0, self.interval - (time.monotonic() - cycle_started)))
+        except KeyboardInterrupt:
+            print("Stopped watching.")
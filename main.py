@@ -1,5 +1,12 @@
-from aws_log_analyzer import AWSLogAnalyzer
+from startup_timer import startup_timer
+import sys
 
 if __name__ == "__main__":
+    # The client only talks to the daemon, it skips loading the rest of the tool
+    if len(sys.argv) > 1 and sys.argv[1] == "client":
+        from daemon_client import DaemonClient
+        sys.exit(DaemonClient().main(sys.argv[2:]))
+    from aws_log_analyzer import AWSLogAnalyzer
+    startup_timer.mark('imports')
     aws_log_analyzer = AWSLogAnalyzer()
     aws_log_analyzer.main()
@@ -0,0 +1,142 @@
+from client_pool import get_client
+from settings import CACHE_DIR
+from datetime import datetime, timedelta
+import botocore
+import json
+import os
+import urllib.parse
+
+COMPRESSIONS = ['ZSTD', 'SNAPPY']
+
+class ParquetCompactor:
+    def __init__(self, session, query_executor, athena_database, source_table, partition_column, output_bucket,
+                 compression='ZSTD', bucket_by=None, bucket_count=8, manifest_dir=os.path.join(CACHE_DIR, 'manifests')):
+        self.session = session
+        self.query_executor = query_executor
+        self.athena_database = athena_database
+        self.source_table = source_table
+        self.partition_column = partition_column
+        self.parquet_table = f"{source_table}_parquet"
+        # Converted days are read from Parquet, the rest straight from the raw logs
+        self.view_name = f"{source_table}_compacted"
+        self.output_location = f"s3://{output_bucket}/aws-athena-tool/parquet/{athena_database}/{self.parquet_table}"
+        self.compression = compression
+        self.bucket_by = bucket_by
+        self.bucket_count = bucket_count
+        self.manifest_path = os.path.join(manifest_dir, f"{athena_database}.{self.parquet_table}.json")
+        os.makedirs(manifest_dir, mode=0o700, exist_ok=True)
+
+    def get_table_metadata(self, table):
+        athena_client = get_client(self.session, 'athena')
+        try:
+            return athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=self.athena_database, TableName=table)['TableMetadata']
+        except botocore.exceptions.ClientError:
+            return None
+
+    def view_exists(self):
+        return self.get_table_metadata(self.view_name) is not None
+
+    def parse_day(self, day):
+        return datetime.strptime(day.replace('-', '/'), '%Y/%m/%d')
+
+    def get_days(self, start_day, end_day):
+        # Only complete days are converted, today's logs are still arriving
+        last_day = min(self.parse_day(end_day), datetime.today() - timedelta(days=1))
+        current = self.parse_day(start_day)
+        days = []
+        while current <= last_day:
+            days.append(current.strftime('%Y/%m/%d'))
+            current += timedelta(days=1)
+        return days
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return set(json.load(f)['partitions'])
+        if self.get_table_metadata(self.parquet_table) is None:
+            return set()
+        # No local manifest on this machine, rebuild it from the partitions registered in Athena
+        query_execution_id = self.query_executor.execute_athena_query(f"SHOW PARTITIONS `{self.athena_database}`.`{self.parquet_table}`")
+        if not query_execution_id:
+            return set()
+        df = self.query_executor.paginate_query_results(query_execution_id)
+        # Hive escapes the slashes of the partition values, 2024/05/01 is listed as 2024%2F05%2F01
+        partitions = set(urllib.parse.unquote(value.split('=', 1)[1]) for value in df.iloc[:, 0]) if len(df.columns) > 0 else set()
+        self.save_manifest(partitions)
+        return partitions
+
+    def save_manifest(self, partitions):
+        with open(self.manifest_path, 'w') as f:
+            json.dump({'partitions': sorted(partitions), 'location': self.output_location}, f, indent=2)
+
+    def create_parquet_table(self, columns):
+        column_definitions = ",\n                    ".join(f"`{column['Name']}` {column['Type']}" for column in columns)
+        clustered_by = f"CLUSTERED BY (`{self.bucket_by}`) INTO {self.bucket_count} BUCKETS" if self.bucket_by else ''
+        query = f"""
+                CREATE EXTERNAL TABLE IF NOT EXISTS `{self.athena_database}`.`{self.parquet_table}` (
+                    {column_definitions}
+                    )
+                    PARTITIONED BY (`{self.partition_column}` STRING)
+                    {clustered_by}
+                    STORED AS PARQUET
+                    LOCATION '{self.output_location}/'
+                    TBLPROPERTIES ('parquet.compression'='{self.compression}')
+                """
+        return self.query_executor.execute_athena_query(query) is not None
+
+    def delete_partition_objects(self, location):
+        # CTAS refuses to write into a non-empty location, clear what a failed run may have left behind
+        s3_client = get_client(self.session, 's3')
+        bucket, prefix = self.query_executor.split_s3_uri(location)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+
+    def compact_partition(self, day, columns):
+        location = f"{self.output_location}/{self.partition_column}={day.replace('/', '-')}/"
+        temp_table = f"{self.parquet_table}_tmp_{day.replace('/', '')}"
+        properties = [f"format = 'PARQUET'", f"write_compression = '{self.compression}'", f"external_location = '{location}'"]
+        if self.bucket_by:
+            properties += [f"bucketed_by = ARRAY['{self.bucket_by}']", f"bucket_count = {self.bucket_count}"]
+        column_list = ", ".join(f"`{column['Name']}`" for column in columns)
+        self.delete_partition_objects(location)
+        self.query_executor.execute_athena_query(f"DROP TABLE IF EXISTS `{self.athena_database}`.`{temp_table}`")
+        query = f"""CREATE TABLE "{self.athena_database}"."{temp_table}" WITH ({', '.join(properties)}) AS SELECT {column_list} FROM "{self.athena_database}"."{self.source_table}" WHERE {self.partition_column} = '{day}'"""
+        if not self.query_executor.execute_athena_query(query):
+            return False
+        # Only the table definition goes away, the Parquet files stay and become a partition of the compacted table
+        self.query_executor.execute_athena_query(f"DROP TABLE IF EXISTS `{self.athena_database}`.`{temp_table}`")
+        query = f"ALTER TABLE `{self.athena_database}`.`{self.parquet_table}` ADD IF NOT EXISTS PARTITION (`{self.partition_column}` = '{day}') LOCATION '{location}'"
+        return self.query_executor.execute_athena_query(query) is not None
+
+    def update_view(self, partitions):
+        raw_filter = ''
+        if partitions:
+            converted = ", ".join(f"'{partition}'" for partition in sorted(partitions))
+            raw_filter = f" WHERE {self.partition_column} NOT IN ({converted})"
+        query = f"""CREATE OR REPLACE VIEW "{self.athena_database}"."{self.view_name}" AS SELECT * FROM "{self.athena_database}"."{self.parquet_table}" UNION ALL SELECT * FROM "{self.athena_database}"."{self.source_table}"{raw_filter}"""
+        return self.query_executor.execute_athena_query(query) is not None
+
+    def compact(self, start_day, end_day):
+        source_metadata = self.get_table_metadata(self.source_table)
+        if source_metadata is None:
+            print(f"\033[91mTable {self.source_table} not found in {self.athena_database}.\033[00m")
+            return False
+        columns = source_metadata['Columns']
+        partitions = self.load_manifest()
+        pending = [day for day in self.get_days(start_day, end_day) if day not in partitions]
+        print(f"\033[96m{len(pending)} partitions to convert to Parquet, {len(partitions)} already converted.\033[00m")
+        if pending and not self.create_parquet_table(columns):
+            return False
+        for day in pending:
+            print(f"Converting {self.partition_column}={day} to Parquet...")
+            if not self.compact_partition(day, columns):
+                print(f"\033[91mError converting {self.partition_column}={day}, stopping.\033[00m")
+                break
+            partitions.add(day)
+            self.save_manifest(partitions)
+        if partitions:
+            return self.update_view(partitions)
+        return True
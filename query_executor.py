@@ -1,71 +1,504 @@
-from tqdm import tqdm
-import pandas as pd
-from time import sleep
-from tabulate import tabulate
-import pydoc
+from query_poller import QueryPoller, TERMINAL_STATES
+from query_history import format_bytes
+from result_writer import ResultWriter, OUTPUT_FORMATS
+from client_pool import get_client
+from query_templates import inline_parameters
+from time import sleep, monotonic
+import botocore
 from datetime import datetime
 import re
+import threading
+
+INTEGER_TYPES = {'tinyint', 'smallint', 'integer', 'int', 'bigint'}
+FLOAT_TYPES = {'double', 'float', 'real', 'decimal'}
+DATETIME_TYPES = {'date', 'timestamp', 'timestamp with time zone'}
+STRING_TYPES = {'varchar', 'char', 'string'}
+CATEGORY_MIN_ROWS = 100
+CATEGORY_MAX_RATIO = 0.5
+# Rows shown by the progressive display before the rest of the result is downloaded
+FIRST_PAGE_ROWS = 1000
 
 class QueryExecutor:
-    def __init__(self, session, athena_database, athena_table, log_type, athena_bucket):
+    def __init__(self, session, athena_database, athena_table, log_type, athena_bucket, fetch_mode='auto', stream_threshold_bytes=1024 * 1024, chunk_size=100000, query_timeout=None, table_location='', result_cache=None, result_reuse_max_age=60, local_engine=None, output_format='table', query_history=None, query_scan_budget=None, session_scan_budget=None, scan_estimator=None, table_ready=None):
         self.session = session
         self.athena_database = athena_database
         self.athena_table = athena_table
         self.log_type = log_type
         self.athena_bucket = athena_bucket
+        # 'auto' streams the output CSV from S3 when it is large, 's3' always streams, 'paginate' never does
+        self.fetch_mode = fetch_mode
+        self.stream_threshold_bytes = stream_threshold_bytes
+        self.chunk_size = chunk_size
+        self.query_timeout = query_timeout
+        self.table_location = table_location
+        # Local on-disk cache of decoded results, None disables both cache tiers
+        self.result_cache = result_cache
+        self.result_reuse_max_age = result_reuse_max_age
+        # Runs queries on downloaded logs instead of Athena when set
+        self.local_engine = local_engine
+        self.output_format = output_format
+        # Scanned-bytes limits: each query is stopped above query_scan_budget, no query starts once the session used session_scan_budget
+        self.query_history = query_history
+        self.query_scan_budget = query_scan_budget
+        self.session_scan_budget = session_scan_budget
+        self.session_scanned_bytes = 0
+        self.scan_estimator = scan_estimator
+        self.table_ready = table_ready
+
+    def wait_until_ready(self):
+        # The table is created in the background while the user picks a query
+        if self.table_ready is None:
+            return
+        if not self.table_ready.done():
+            print("Waiting for the Athena table to be ready...")
+        if not self.table_ready.result():
+            print("\033[91mThe Athena table could not be created, queries may fail.\033[00m")
+
+    def is_cacheable(self, query):
+        return re.match(r'\s*(SELECT|WITH)\b', query, re.IGNORECASE) is not None
+
+    def get_cached_results(self, query, parameters=None):
+        if not self.result_cache or not self.is_cacheable(query):
+            return None, None
+        cache_key = self.result_cache.make_key(query, self.athena_database, self.athena_table, self.table_location, parameters)
+        df = self.result_cache.get(cache_key)
+        if df is not None:
+            self.print_query(query, parameters)
+            print("\033[93mAthena query results loaded from local cache.\033[00m")
+        return cache_key, df
+
+    def get_scan_limit(self, running_bytes=0):
+        limits = []
+        if self.query_scan_budget:
+            limits.append(self.query_scan_budget)
+        if self.session_scan_budget:
+            limits.append(self.session_scan_budget - self.session_scanned_bytes - running_bytes)
+        return min(limits) if limits else None
+
+    def get_budget_reason(self, scanned, running_bytes=0):
+        if self.query_scan_budget and scanned > self.query_scan_budget:
+            return f"scan budget of {format_bytes(self.query_scan_budget)} exceeded"
+        if self.session_scan_budget and self.session_scanned_bytes + running_bytes + scanned > self.session_scan_budget:
+            return f"session scan budget of {format_bytes(self.session_scan_budget)} exceeded"
+        return None
 
-    def execute_athena_query(self, query):
+    def has_session_budget(self):
+        if self.session_scan_budget and self.session_scanned_bytes >= self.session_scan_budget:
+            print(f"\033[91mSession scan budget of {format_bytes(self.session_scan_budget)} used up, the query is not started.\033[00m")
+            return False
+        return True
+
+    def print_scan_estimate(self, query):
+        # Only the table location is listed, queries answered from other tables such as rollups are not estimated
+        if self.scan_estimator and self.is_cacheable(query) and f'"{self.athena_table}"' in query:
+            self.scan_estimator.print_estimate(query, self.query_scan_budget)
+
+    def record_query(self, query_execution, query, template=None):
+        self.session_scanned_bytes += query_execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+        if self.query_history:
+            self.query_history.record(query_execution, query, template, self.log_type)
+
+    def run_query(self, query, template=None, parameters=None):
+        if self.local_engine:
+            return self.local_engine.run_query(inline_parameters(query, parameters))
+        cache_key, df = self.get_cached_results(query, parameters)
+        if df is not None:
+            return df
+        self.wait_until_ready()
+        self.print_scan_estimate(query)
+        query_execution_id = self.execute_athena_query(query, template=template, parameters=parameters)
+        if not query_execution_id:
+            return None
+        df = self.get_query_results(query_execution_id)
+        if cache_key:
+            self.result_cache.put(cache_key, df)
+        return df
+
+    def run_query_progressive(self, query, template=None, parameters=None):
+        # Shows the first rows as soon as the query finishes and downloads the rest into the result file while the pager is open
+        if self.local_engine or not ResultWriter(None, self.output_format).is_text():
+            df = self.run_query(query, template, parameters)
+            if df is not None:
+                self.display_results(df, label=template)
+            return
+        cache_key, df = self.get_cached_results(query, parameters)
+        if df is not None:
+            self.display_results(df, label=template)
+            return
+        self.wait_until_ready()
+        self.print_scan_estimate(query)
+        query_execution_id = self.execute_athena_query(query, template=template, parameters=parameters)
+        if not query_execution_id:
+            return
+        filename = self.get_output_filename(template)
+        writer = ResultWriter(filename, self.output_format, self.chunk_size)
+        chunks = self.iter_result_chunks(query_execution_id)
+        try:
+            first_chunk = next(chunks, None)
+        except Exception as e:
+            print(f"Error fetching the results of {query_execution_id}: {e}")
+            return
+        if first_chunk is None:
+            chunks.close()
+            print("The query returned no results.")
+            return
+        writer.write(first_chunk)
+        downloaded = [first_chunk]
+        stopped = threading.Event()
+        complete = threading.Event()
+
+        def download():
+            try:
+                for chunk in chunks:
+                    if stopped.is_set():
+                        return
+                    writer.write(chunk)
+                    downloaded.append(chunk)
+                complete.set()
+            except Exception as e:
+                print(f"Error downloading the rest of the results: {e}")
+            finally:
+                chunks.close()
+
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        print(f"\033[93mAthena query results are being saved in {filename}, quit the pager to stop the download.\033[00m")
+        try:
+            writer.page(follow=thread.is_alive)
+        finally:
+            stopped.set()
+            thread.join()
+            writer.close()
+        if not complete.is_set():
+            print(f"\033[93mDownload stopped after {writer.rows_written} rows, the partial results are in {filename}\033[00m")
+            return
+        print(f"\033[93mAll {writer.rows_written} rows saved in {filename}\033[00m")
+        if self.output_format != 'table' and not cache_key:
+            return
+        import pandas as pd
+
+        df = pd.concat(downloaded, ignore_index=True)
+        if self.output_format == 'table':
+            # The pager showed the columns as wide as the first page, the saved file is aligned on the whole result
+            ResultWriter(filename, self.output_format, self.chunk_size).write_dataframe(df)
+        if cache_key:
+            self.result_cache.put(cache_key, self.apply_categories(df, self.get_column_info(query_execution_id)))
+
+    def iter_result_chunks(self, query_execution_id, first_rows=FIRST_PAGE_ROWS):
+        # Typed chunks of the result in order, the first one is small so it can be shown right away
+        import pandas as pd
+
+        output_location = self.get_output_location(query_execution_id) if self.fetch_mode != 'paginate' else None
+        rows_yielded = 0
+        if output_location and self.should_stream_results(output_location):
+            try:
+                column_info = self.get_column_info(query_execution_id)
+                s3_client = get_client(self.session, 's3')
+                bucket, key = self.split_s3_uri(output_location)
+                body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+                try:
+                    reader = pd.read_csv(body, dtype=str, keep_default_na=False, iterator=True)
+                    size = first_rows
+                    while True:
+                        try:
+                            chunk = reader.get_chunk(size)
+                        except StopIteration:
+                            return
+                        yield self.apply_column_types(chunk, column_info, categorize=False)
+                        rows_yielded += len(chunk)
+                        size = self.chunk_size
+                finally:
+                    body.close()
+            except Exception as e:
+                # Pagination goes on after the rows already yielded
+                print(f"Error streaming results from {output_location}, falling back to pagination: {e}")
+        athena_client = get_client(self.session, 'athena')
+        paginator = athena_client.get_paginator('get_query_results')
+        column_info = None
+        for results in paginator.paginate(QueryExecutionId=query_execution_id, PaginationConfig={'PageSize': first_rows}):
+            rows = results['ResultSet']['Rows']
+            if column_info is None:
+                column_info = results['ResultSet']['ResultSetMetadata']['ColumnInfo']
+                if len(rows) > 0 and [col.get('VarCharValue') for col in rows[0]['Data']] == [column['Name'] for column in column_info]:
+                    rows = rows[1:]
+            if rows_yielded:
+                skipped = min(rows_yielded, len(rows))
+                rows = rows[skipped:]
+                rows_yielded -= skipped
+                if not rows:
+                    continue
+            df = pd.DataFrame([[col.get('VarCharValue', '') for col in row['Data']] for row in rows], columns=[column['Name'] for column in column_info])
+            yield self.apply_column_types(df, column_info, categorize=False)
+
+    def run_queries(self, queries, max_concurrency=5):
+        # Submit up to max_concurrency queries, poll them together and yield (label, query, df) as each one finishes.
+        # Queries are (label, query) or (label, query, parameters)
+        if self.local_engine:
+            for label, query, *parameters in queries:
+                yield label, query, self.local_engine.run_query(inline_parameters(query, parameters[0] if parameters else None))
+            return
+        self.wait_until_ready()
+        athena_client = get_client(self.session, 'athena')
+        poller = QueryPoller(athena_client, timeout=self.query_timeout)
+        pending = list(queries)
+        running = {}
+        scanned_bytes = {}
+        estimated = set()
+        attempt = 0
+        try:
+            while pending or running:
+                while pending and len(running) < max_concurrency:
+                    label, query, *parameters = pending[0]
+                    parameters = parameters[0] if parameters else None
+                    cache_key, df = self.get_cached_results(query, parameters)
+                    if df is not None:
+                        pending.pop(0)
+                        yield label, query, df
+                        continue
+                    if not self.has_session_budget():
+                        pending.pop(0)
+                        yield label, query, None
+                        continue
+                    if label not in estimated:
+                        self.print_scan_estimate(query)
+                        estimated.add(label)
+                    try:
+                        query_execution_id = self.start_query(query, parameters)
+                    except botocore.exceptions.ClientError as e:
+                        # Over the account's active DML query quota, wait for a running query to finish
+                        if e.response['Error']['Code'] == 'TooManyRequestsException' and running:
+                            break
+                        raise
+                    pending.pop(0)
+                    running[query_execution_id] = (label, query, cache_key, monotonic())
+                    attempt = 0
+                if not running:
+                    continue
+                response = athena_client.batch_get_query_execution(QueryExecutionIds=list(running))
+                for query_execution in response['QueryExecutions']:
+                    query_execution_id = query_execution['QueryExecutionId']
+                    label, query, cache_key, started = running[query_execution_id]
+                    query_state = query_execution['Status']['State']
+                    scanned_bytes[query_execution_id] = query_execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+                    if query_state not in TERMINAL_STATES:
+                        # The session budget is shared with the other running queries of the batch
+                        running_bytes = sum(scanned_bytes.get(other, 0) for other in running if other != query_execution_id)
+                        reason = self.get_budget_reason(scanned_bytes[query_execution_id], running_bytes)
+                        if self.query_timeout and monotonic() - started > self.query_timeout:
+                            reason = f"timeout of {self.query_timeout}s exceeded"
+                        if reason:
+                            query_execution = poller.cancel(query_execution_id, query_execution, reason)
+                            del running[query_execution_id]
+                            self.record_query(query_execution, query, label)
+                            yield label, query, None
+                        continue
+                    del running[query_execution_id]
+                    self.record_query(query_execution, query, label)
+                    attempt = 0
+                    if query_state != 'SUCCEEDED':
+                        print(f"Athena query {label} failed with state: {query_state}")
+                        if query_execution['Status'].get('StateChangeReason'):
+                            print(f"Reason: {query_execution['Status']['StateChangeReason']}")
+                        yield label, query, None
+                        continue
+                    df = self.get_query_results(query_execution_id)
+                    if cache_key:
+                        self.result_cache.put(cache_key, df)
+                    yield label, query, df
+                if running:
+                    sleep(poller.next_interval(attempt))
+                    attempt += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Reached on Ctrl-C and when the caller closes the generator early, abandoned queries must stop scanning
+            for query_execution_id in running:
+                poller.stop_query(query_execution_id, "batch interrupted")
+
+    def print_query(self, query, parameters=None):
         print(f"\033[92m{query}\033[00m")
-        athena_client = self.session.client('athena')
+        if parameters:
+            print(f"\033[92mParameters: {', '.join(parameters)}\033[00m")
+
+    def start_query(self, query, parameters=None):
+        self.print_query(query, parameters)
+        athena_client = get_client(self.session, 'athena')
+        arguments = {}
+        if parameters:
+            # The same query text with other values is parsed once by Athena and reuses results per set of values
+            arguments['ExecutionParameters'] = list(parameters)
         query_execution = athena_client.start_query_execution(
             QueryString=query,
             QueryExecutionContext={'Database': self.athena_database},
-            ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"}
+            ResultConfiguration={'OutputLocation': f"s3://{self.athena_bucket}/"},
+            ResultReuseConfiguration={'ResultReuseByAgeConfiguration': {
+                'Enabled': self.result_cache is not None and self.is_cacheable(query),
+                'MaxAgeInMinutes': self.result_reuse_max_age
+            }},
+            **arguments
         )
-        query_execution_id = query_execution['QueryExecutionId']
-        with tqdm(total=100, desc="Running Athena query") as pbar:
-            while True:
-                query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-                query_state = query_status['QueryExecution']['Status']['State']
-                if query_state in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-                    break
-                sleep(1)
-                pbar.update(1)
+        return query_execution['QueryExecutionId']
+
+    def execute_athena_query(self, query, timeout=None, template=None, parameters=None):
+        self.wait_until_ready()
+        if not self.has_session_budget():
+            return None
+        athena_client = get_client(self.session, 'athena')
+        query_execution_id = self.start_query(query, parameters)
+        poller = QueryPoller(athena_client, timeout=timeout or self.query_timeout, max_scanned_bytes=self.get_scan_limit())
+        query_execution = poller.wait(query_execution_id)
+        self.record_query(query_execution, query, template)
+        query_state = query_execution['Status']['State']
         if query_state == 'SUCCEEDED':
-            print("Athena query executed successfully.")
+            scanned = query_execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+            cost = f", {self.query_history.get_cost(scanned):.4f} USD" if self.query_history else ''
+            print(f"Athena query executed successfully, {format_bytes(scanned)} scanned{cost}.")
+            if query_execution.get('Statistics', {}).get('ResultReuseInformation', {}).get('ReusedPreviousResult'):
+                print("\033[93mAthena reused the results of a previous query, no data was scanned.\033[00m")
             return query_execution_id
         else:
             print(f"Athena query failed with state: {query_state}")
+            if query_execution['Status'].get('StateChangeReason'):
+                print(f"Reason: {query_execution['Status']['StateChangeReason']}")
             return None
 
     def get_query_results(self, query_execution_id):
-        athena_client = self.session.client('athena')
+        if self.fetch_mode != 'paginate':
+            output_location = self.get_output_location(query_execution_id)
+            if output_location and self.should_stream_results(output_location):
+                try:
+                    return self.stream_query_results(query_execution_id, output_location)
+                except Exception as e:
+                    print(f"Error streaming results from {output_location}, falling back to pagination: {e}")
+        return self.paginate_query_results(query_execution_id)
+
+    def get_output_location(self, query_execution_id):
+        athena_client = get_client(self.session, 'athena')
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+        output_location = query_execution.get('ResultConfiguration', {}).get('OutputLocation', '')
+        # Only DML statements write a plain CSV; DDL and utility statements write .txt/.metadata files
+        if query_execution.get('StatementType') != 'DML' or not output_location.endswith('.csv'):
+            return None
+        return output_location
+
+    def get_column_info(self, query_execution_id):
+        athena_client = get_client(self.session, 'athena')
+        results = athena_client.get_query_results(QueryExecutionId=query_execution_id, MaxResults=1)
+        return results['ResultSet']['ResultSetMetadata']['ColumnInfo']
+
+    def split_s3_uri(self, s3_uri):
+        bucket, _, key = s3_uri.replace('s3://', '', 1).partition('/')
+        return bucket, key
+
+    def should_stream_results(self, output_location):
+        if self.fetch_mode == 's3':
+            return True
+        s3_client = get_client(self.session, 's3')
+        bucket, key = self.split_s3_uri(output_location)
+        try:
+            content_length = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        except Exception as e:
+            print(f"Error reading size of {output_location}: {e}")
+            return False
+        return content_length >= self.stream_threshold_bytes
+
+    def stream_query_results(self, query_execution_id, output_location):
+        column_info = self.get_column_info(query_execution_id)
+        s3_client = get_client(self.session, 's3')
+        bucket, key = self.split_s3_uri(output_location)
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        # pandas and tqdm are the slowest imports of the tool, they are only loaded once results are fetched
+        import pandas as pd
+        from tqdm import tqdm
+
+        chunks = []
+        with tqdm(desc="Downloading Athena results", unit=" rows") as pbar:
+            # Athena writes NULL as an empty field, read everything as text and type each chunk from the metadata
+            for chunk in pd.read_csv(body, dtype=str, keep_default_na=False, chunksize=self.chunk_size):
+                chunks.append(self.apply_column_types(chunk, column_info, categorize=False))
+                pbar.update(len(chunk))
+        body.close()
+        if len(chunks) > 0:
+            df = pd.concat(chunks, ignore_index=True)
+            df = self.apply_categories(df, column_info)
+        else:
+            df = pd.DataFrame()
+        return df
+
+    def paginate_query_results(self, query_execution_id):
+        import pandas as pd
+
+        athena_client = get_client(self.session, 'athena')
         paginator = athena_client.get_paginator('get_query_results')
-        result_data = []
+        column_info = None
+        columns = []
         for results in paginator.paginate(QueryExecutionId=query_execution_id):
-            result_data.extend(results['ResultSet']['Rows'])
-        rows = []
-        for row in result_data:
-            row_data = []
-            for col in row['Data']:
-                if 'VarCharValue' in col:
-                    row_data.append(col['VarCharValue'])
-                else:
-                    row_data.append('')
-            rows.append(row_data)
-        if len(rows) > 0:
-            df = pd.DataFrame(rows[1:], columns=rows[0])
-        else:
-            df = pd.DataFrame()  
+            rows = results['ResultSet']['Rows']
+            if column_info is None:
+                column_info = results['ResultSet']['ResultSetMetadata']['ColumnInfo']
+                columns = [[] for _ in column_info]
+                # DML results repeat the column names as the first row, DDL and utility results do not
+                if len(rows) > 0 and [col.get('VarCharValue') for col in rows[0]['Data']] == [column['Name'] for column in column_info]:
+                    rows = rows[1:]
+            for row in rows:
+                for i, col in enumerate(row['Data']):
+                    columns[i].append(col.get('VarCharValue', ''))
+        if not column_info:
+            return pd.DataFrame()
+        df = pd.DataFrame({i: values for i, values in enumerate(columns)})
+        df.columns = [column['Name'] for column in column_info]
+        return self.apply_column_types(df, column_info)
+
+    def apply_column_types(self, df, column_info, categorize=True):
+        import pandas as pd
+
+        for i, column in enumerate(column_info):
+            if i >= len(df.columns):
+                break
+            athena_type = column['Type'].lower()
+            values = df.iloc[:, i]
+            if athena_type in INTEGER_TYPES:
+                values = pd.to_numeric(values, errors='coerce')
+                values = values.astype('Int64') if values.isna().any() else values.astype('int64')
+            elif athena_type in FLOAT_TYPES:
+                values = pd.to_numeric(values, errors='coerce').astype('float64')
+            elif athena_type == 'boolean':
+                values = values.map({'true': True, 'false': False}).astype('boolean')
+            elif athena_type in DATETIME_TYPES:
+                values = pd.to_datetime(values.str.replace(r' UTC$', '', regex=True), errors='coerce', utc=athena_type.endswith('time zone'))
+            else:
+                continue
+            df.isetitem(i, values)
+        if categorize:
+            df = self.apply_categories(df, column_info)
+        return df
+
+    def apply_categories(self, df, column_info):
+        for i, column in enumerate(column_info):
+            if i >= len(df.columns) or column['Type'].lower() not in STRING_TYPES:
+                continue
+            values = df.iloc[:, i]
+            # Repeated values such as client_ip, request_verb or x_edge_location are stored once per category
+            if len(values) >= CATEGORY_MIN_ROWS and values.nunique() <= len(values) * CATEGORY_MAX_RATIO:
+                df.isetitem(i, values.astype('category'))
         return df
 
-    def display_results(self, df):
-        output = tabulate(df, headers='keys', tablefmt='mysql')
+    def get_output_filename(self, label=None):
         safe_athena_database = re.sub(r'[^a-zA-Z0-9]', '_', self.athena_database)[:20]
         safe_athena_table = re.sub(r'[^a-zA-Z0-9]', '_', self.athena_table)[:20]
         safe_log_type = re.sub(r'[^a-zA-Z0-9]', '_', self.log_type)[:20]
-        filename = f"/tmp/{datetime.now().strftime('%Y%m%d%H%M%S')}-aws-athena-tool-{safe_athena_database}-{safe_athena_table}-{safe_log_type}.txt"
-        with open(filename, 'w') as f:
-            f.write(output)
-            print(f"\033[93mAthena query results saved in {filename}\033[00m")
-        pydoc.pager(output)
+        safe_label = f"-q{re.sub(r'[^a-zA-Z0-9]', '_', label)[:20]}" if label else ''
+        return f"/tmp/{datetime.now().strftime('%Y%m%d%H%M%S')}-aws-athena-tool-{safe_athena_database}-{safe_athena_table}-{safe_log_type}{safe_label}.{OUTPUT_FORMATS[self.output_format]}"
+
+    def display_results(self, df, pager=True, label=None, preview_rows=20):
+        filename = self.get_output_filename(label)
+        writer = ResultWriter(filename, self.output_format, self.chunk_size)
+        writer.write_dataframe(df)
+        print(f"\033[93mAthena query results saved in {filename}\033[00m")
+        if pager and writer.is_text():
+            writer.page()
+        else:
+            from tabulate import tabulate
+            print(tabulate(df.head(preview_rows), headers='keys', tablefmt='simple'))
+            if len(df) > preview_rows:
+                print(f"... {len(df) - preview_rows} more rows in {filename}")
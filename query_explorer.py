@@ -0,0 +1,105 @@
+import re
+
+# Share of the rows read by an exploration query, in percent
+DEFAULT_SAMPLE_PERCENT = 10
+# Above this relative error in the first rows the exact query is worth running
+MAX_RELATIVE_ERROR = 0.1
+ROWS_CHECKED = 20
+# approx_distinct has a standard error of 2.3% with its default settings
+APPROX_DISTINCT_ERROR = 0.023
+Z_95 = 1.96
+
+class QueryExplorer:
+    def __init__(self, sample_percent=DEFAULT_SAMPLE_PERCENT, max_relative_error=MAX_RELATIVE_ERROR):
+        self.sample_percent = sample_percent
+        self.max_relative_error = max_relative_error
+
+    def split_select_list(self, query):
+        # Top level items between SELECT and FROM, with the position of the list in the query
+        select = re.search(r'^\s*SELECT\s+', query, re.IGNORECASE)
+        if not select:
+            return None
+        depth, items, start = 0, [], select.end()
+        in_string = False
+        for i in range(select.end(), len(query)):
+            char = query[i]
+            if char == "'":
+                in_string = not in_string
+            if in_string:
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif depth == 0 and char == ',':
+                items.append(query[start:i].strip())
+                start = i + 1
+            elif depth == 0 and re.match(r'FROM\b', query[i:i + 5], re.IGNORECASE) and re.match(r'\s', query[i - 1]):
+                items.append(query[start:i].strip())
+                return items, select.end(), i
+        return None
+
+    def approximate_item(self, item, fraction):
+        # Counts and sums of a Bernoulli sample are divided by the sampling fraction, the error column is the 95% interval half-width
+        match = re.fullmatch(r'(count|sum)\s*\((.*)\)(?:\s+AS\s+("?)(\w+)"?)?', item, re.IGNORECASE | re.DOTALL)
+        if not match:
+            return [item], None
+        function, argument, quote, alias = match.group(1).lower(), match.group(2).strip(), match.group(3), match.group(4)
+        if function == 'count' and re.match(r'DISTINCT\b', argument, re.IGNORECASE):
+            # Distinct values don't grow with the sample size, they are estimated on all rows instead
+            column = re.sub(r'^DISTINCT\s+', '', argument, flags=re.IGNORECASE)
+            if not alias:
+                return [f"approx_distinct({column})"], None
+            return [f"approx_distinct({column}) AS {quote}{alias}{quote}",
+                    f"CAST(round(approx_distinct({column}) * {Z_95 * APPROX_DISTINCT_ERROR:.4f}) AS bigint) AS {quote}{alias}_error{quote}"], alias
+        if fraction == 1:
+            return [item], None
+        if function == 'count':
+            estimate = f"CAST(round(count({argument}) / {fraction}) AS bigint)"
+            error = f"CAST(round({Z_95} * sqrt(count({argument}) * (1 - {fraction})) / {fraction}) AS bigint)"
+        else:
+            estimate = f"CAST(round(sum({argument}) / {fraction}) AS bigint)"
+            error = f"CAST(round({Z_95} * sqrt((1 - {fraction}) * sum(CAST({argument} AS double) * ({argument}))) / {fraction}) AS bigint)"
+        if not alias:
+            return [estimate], None
+        return [f"{estimate} AS {quote}{alias}{quote}", f"{error} AS {quote}{alias}_error{quote}"], alias
+
+    def approximate(self, query, table):
+        # Returns the exploration query and the columns with an error column, or None when it would not be faster
+        if table not in query or not re.search(r'\b(count|sum|approx_percentile|approx_distinct|avg)\s*\(', query, re.IGNORECASE):
+            return None
+        select_list = self.split_select_list(query)
+        if not select_list:
+            return None
+        items, start, end = select_list
+        distinct = any(re.match(r'count\s*\(\s*DISTINCT\b', item, re.IGNORECASE) for item in items)
+        fraction = 1 if distinct else self.sample_percent / 100
+        approximated, estimated = [], []
+        for item in items:
+            new_items, alias = self.approximate_item(item, fraction)
+            approximated.extend(new_items)
+            if alias:
+                estimated.append(alias)
+        query = f"{query[:start]}{', '.join(approximated)} {query[end:]}"
+        if not distinct:
+            query = query.replace(table, f"{table} TABLESAMPLE BERNOULLI ({self.sample_percent:g})", 1)
+        return query, estimated
+
+    def get_relative_error(self, df, estimated):
+        # Largest error relative to its estimate in the rows read first, None when nothing was estimated
+        errors = []
+        for alias in estimated:
+            columns = {column.lower(): column for column in df.columns}
+            if alias.lower() not in columns or f"{alias}_error".lower() not in columns:
+                continue
+            rows = df.head(ROWS_CHECKED)
+            values = rows[columns[alias.lower()]].astype(float).clip(lower=1)
+            errors.append((rows[columns[f"{alias}_error".lower()]].astype(float) / values).max())
+        errors = [error for error in errors if error == error]
+        return max(errors) if errors else None
+
+    def needs_exact(self, df, estimated):
+        if df is None or df.empty:
+            return True
+        relative_error = self.get_relative_error(df, estimated)
+        return relative_error is not None and relative_error > self.max_relative_error
@@ -0,0 +1,92 @@
+from settings import CACHE_DIR
+from datetime import datetime, timezone
+import json
+import os
+import threading
+
+# Athena on-demand pricing: 5 USD per TB scanned, each query is billed for at least 10 MB
+PRICE_PER_TB = 5.0
+MIN_BILLED_BYTES = 10 * 1024 ** 2
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+class QueryHistory:
+    def __init__(self, path=os.path.join(CACHE_DIR, 'history.jsonl'), price_per_tb=PRICE_PER_TB):
+        self.path = path
+        self.price_per_tb = price_per_tb
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    def get_cost(self, scanned_bytes):
+        # Queries that scan nothing, such as DDL or reused results, are not billed
+        if not scanned_bytes:
+            return 0.0
+        return max(scanned_bytes, MIN_BILLED_BYTES) / 1024 ** 4 * self.price_per_tb
+
+    def record(self, query_execution, query, template, log_type):
+        statistics = query_execution.get('Statistics', {})
+        scanned_bytes = statistics.get('DataScannedInBytes', 0)
+        entry = {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'query_execution_id': query_execution.get('QueryExecutionId'),
+            'log_type': log_type,
+            'template': template,
+            'query': query,
+            'state': query_execution['Status'].get('State'),
+            'state_change_reason': query_execution['Status'].get('StateChangeReason'),
+            'data_scanned_bytes': scanned_bytes,
+            'total_execution_ms': statistics.get('TotalExecutionTimeInMillis'),
+            'engine_execution_ms': statistics.get('EngineExecutionTimeInMillis'),
+            'queue_ms': statistics.get('QueryQueueTimeInMillis'),
+            'service_processing_ms': statistics.get('ServiceProcessingTimeInMillis'),
+            'reused_result': statistics.get('ResultReuseInformation', {}).get('ReusedPreviousResult', False),
+            'cost_usd': self.get_cost(scanned_bytes),
+        }
+        # Batches finish queries from several places, one line per write keeps the file valid JSONL
+        with self.lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+            except Exception as e:
+                print(f"Error writing query history: {e}")
+
+    def load(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return entries
+
+    def print_summary(self):
+        import pandas as pd
+        from tabulate import tabulate
+
+        entries = self.load()
+        if not entries:
+            print(f"No queries recorded in {self.path}.")
+            return
+        df = pd.DataFrame(entries)
+        df['template'] = df['template'].fillna('internal')
+        df['log_type'] = df['log_type'].fillna('')
+        df['latency_s'] = df['total_execution_ms'].astype('float64') / 1000
+        summary = df.groupby(['log_type', 'template']).agg(
+            queries=('query', 'size'),
+            failed=('state', lambda states: int((states != 'SUCCEEDED').sum())),
+            p50_latency_s=('latency_s', lambda values: values.quantile(0.5)),
+            p95_latency_s=('latency_s', lambda values: values.quantile(0.95)),
+            scanned=('data_scanned_bytes', 'sum'),
+            cost_usd=('cost_usd', 'sum'),
+        ).sort_values('cost_usd', ascending=False).reset_index()
+        summary['scanned'] = summary['scanned'].map(format_bytes)
+        print(tabulate(summary, headers='keys', floatfmt='.4f', showindex=False))
+        print(f"\033[96m{len(df)} queries, {format_bytes(df['data_scanned_bytes'].sum())} scanned, {df['cost_usd'].sum():.4f} USD since {df['time'].min()[:10]}.\033[00m")
@@ -0,0 +1,65 @@
+from query_history import format_bytes
+from time import sleep, monotonic
+import random
+
+TERMINAL_STATES = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+
+class QueryPoller:
+    def __init__(self, athena_client, initial_interval=0.2, max_interval=5.0, backoff_factor=1.5, timeout=None, max_scanned_bytes=None):
+        self.athena_client = athena_client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.max_scanned_bytes = max_scanned_bytes
+
+    def next_interval(self, attempt):
+        # Exponential backoff with jitter: short queries are seen quickly, long ones cost few API calls
+        interval = min(self.max_interval, self.initial_interval * self.backoff_factor ** attempt)
+        return random.uniform(interval / 2, interval)
+
+    def update_progress(self, pbar, query_execution):
+        statistics = query_execution.get('Statistics', {})
+        pbar.n = statistics.get('DataScannedInBytes', 0)
+        pbar.set_postfix(state=query_execution['Status']['State'],
+                         queued=f"{statistics.get('QueryQueueTimeInMillis', 0) / 1000:.1f}s",
+                         engine=f"{statistics.get('EngineExecutionTimeInMillis', 0) / 1000:.1f}s")
+
+    def is_over_budget(self, query_execution):
+        return self.max_scanned_bytes is not None and query_execution.get('Statistics', {}).get('DataScannedInBytes', 0) > self.max_scanned_bytes
+
+    def stop_query(self, query_execution_id, reason):
+        print(f"\033[93mStopping Athena query {query_execution_id}: {reason}\033[00m")
+        try:
+            self.athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+        except Exception as e:
+            print(f"Error stopping Athena query: {e}")
+
+    def wait(self, query_execution_id, desc="Running Athena query", progress=True):
+        from tqdm import tqdm
+
+        started = monotonic()
+        attempt = 0
+        query_execution = None
+        with tqdm(desc=desc, unit='B', unit_scale=True, unit_divisor=1024, disable=not progress) as pbar:
+            try:
+                while True:
+                    query_execution = self.athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+                    self.update_progress(pbar, query_execution)
+                    if query_execution['Status']['State'] in TERMINAL_STATES:
+                        return query_execution
+                    if self.timeout and monotonic() - started > self.timeout:
+                        return self.cancel(query_execution_id, query_execution, f"timeout of {self.timeout}s exceeded")
+                    if self.is_over_budget(query_execution):
+                        return self.cancel(query_execution_id, query_execution, f"scan budget of {format_bytes(self.max_scanned_bytes)} exceeded")
+                    sleep(self.next_interval(attempt))
+                    attempt += 1
+            except KeyboardInterrupt:
+                return self.cancel(query_execution_id, query_execution, "interrupted by user")
+
+    def cancel(self, query_execution_id, query_execution, reason):
+        self.stop_query(query_execution_id, reason)
+        query_execution = query_execution or {'QueryExecutionId': query_execution_id, 'Status': {}}
+        query_execution['Status']['State'] = 'CANCELLED'
+        query_execution['Status']['StateChangeReason'] = reason
+        return query_execution
@@ -0,0 +1,203 @@
+from datetime import datetime, timedelta
+import re
+
+# Java date patterns used with parse_datetime and their Python equivalents
+JAVA_PATTERN_TOKENS = [('yyyy', '%Y'), ('MM', '%m'), ('dd', '%d'), ('HH', '%H'), ('mm', '%M'), ('ss', '%S'), ("'T'", 'T')]
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d-%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+TIMESTAMP_VALUE = r"(parse_datetime\(\s*'[^']*'\s*,\s*'[^']*'\s*\)|from_iso8601_timestamp\(\s*'[^']*'\s*\)|TIMESTAMP\s+'[^']*')"
+VALUE = rf"({TIMESTAMP_VALUE[1:-1]}|'[^']*')"
+DATE_VALUE = r"(?:DATE\s*)?'([^']*)'"
+DAY_LITERAL = "'%Y/%m/%d'"
+COMPARISONS = {'>=': 'lower', '>': 'lower', '<=': 'upper', '<': 'upper', '=': 'both'}
+CLAUSE_END = re.compile(r'\b(GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|UNION|WINDOW)\b|;', re.IGNORECASE)
+
+class QueryRewriter:
+    def __init__(self, log_type, partition_column=None):
+        self.log_type = log_type
+        self.partition_column = partition_column
+        # ELBv2 logs keep an ISO 8601 timestamp, CloudFront splits it in a date and a time column
+        if log_type == 'elbv2':
+            self.time_expression = 'time'
+        else:
+            self.time_expression = "concat(CAST(date AS varchar), 'T', time)"
+
+    def parse_time(self, value):
+        value = value.strip()
+        match = re.fullmatch(r"parse_datetime\(\s*'([^']*)'\s*,\s*'([^']*)'\s*\)", value, re.IGNORECASE)
+        if match:
+            pattern = match.group(2)
+            for java_token, python_token in JAVA_PATTERN_TOKENS:
+                pattern = pattern.replace(java_token, python_token)
+            try:
+                return datetime.strptime(match.group(1), pattern)
+            except ValueError:
+                return None
+        match = re.fullmatch(r"(?:from_iso8601_timestamp\(\s*|TIMESTAMP\s+)?'([^']*)'\s*\)?", value, re.IGNORECASE)
+        if not match:
+            return None
+        text = re.sub(r'(\.\d+)?Z?$', '', match.group(1))
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.strptime(text, time_format)
+            except ValueError:
+                continue
+        return None
+
+    def format_time(self, value, upper=False):
+        text = value.strftime('%Y-%m-%dT%H:%M:%S')
+        # ELBv2 times end in microseconds and Z, so the upper bound of its second is written out in full
+        if upper and self.log_type == 'elbv2':
+            return f"'{text}.000000Z'"
+        return f"'{text}'"
+
+    def get_depths(self, sql):
+        # Parenthesis depth of every character, None inside string literals
+        depths = []
+        depth = 0
+        in_string = False
+        for char in sql:
+            if char == "'":
+                in_string = not in_string
+                depths.append(None)
+                continue
+            if in_string:
+                depths.append(None)
+                continue
+            if char == '(':
+                depths.append(depth)
+                depth += 1
+                continue
+            if char == ')':
+                depth -= 1
+            depths.append(depth)
+        return depths
+
+    def find_where(self, sql):
+        depths = self.get_depths(sql)
+        where = next((match for match in re.finditer(r'\bWHERE\b', sql, re.IGNORECASE) if depths[match.start()] == 0), None)
+        if not where:
+            return None
+        end = next((match.start() for match in CLAUSE_END.finditer(sql, where.end()) if depths[match.start()] == 0), len(sql))
+        return where.end(), end
+
+    def split(self, condition, keyword):
+        depths = self.get_depths(condition)
+        parts, start, between = [], 0, False
+        for match in re.finditer(rf'\b({keyword}|BETWEEN)\b', condition, re.IGNORECASE):
+            if depths[match.start()] != 0:
+                continue
+            if match.group(1).upper() == 'BETWEEN':
+                between = True
+            elif between and keyword == 'AND':
+                # The AND of BETWEEN x AND y belongs to the same term
+                between = False
+            else:
+                parts.append(condition[start:match.start()])
+                start = match.end()
+        parts.append(condition[start:])
+        return [part.strip() for part in parts]
+
+    def strip_parentheses(self, term):
+        while term.startswith('(') and term.endswith(')') and self.get_depths(term)[-1] == 0:
+            term = term[1:-1].strip()
+        return term
+
+    def get_term_days(self, term):
+        # Days a row must belong to for the term to be true, None for an unbounded side
+        time_column = r'"?time"?'
+        match = re.fullmatch(rf'{time_column}\s+BETWEEN\s+{VALUE}\s+AND\s+{VALUE}', term, re.IGNORECASE | re.DOTALL)
+        if match and (self.log_type == 'elbv2' or re.match(TIMESTAMP_VALUE, match.group(1), re.IGNORECASE)):
+            start, end = self.parse_time(match.group(1)), self.parse_time(match.group(2))
+            return (start.date() if start else None, end.date() if end else None)
+        match = re.fullmatch(rf'{time_column}\s*(>=|>|<=|<|=)\s*{VALUE}', term, re.IGNORECASE | re.DOTALL)
+        if match and (self.log_type == 'elbv2' or re.match(TIMESTAMP_VALUE, match.group(2), re.IGNORECASE)):
+            value = self.parse_time(match.group(2))
+            return self.get_bounds(match.group(1), value.date() if value else None)
+        match = re.fullmatch(rf"{time_column}\s+LIKE\s+'(\d{{4}}-\d{{2}}-\d{{2}})[^']*'", term, re.IGNORECASE)
+        if match and self.log_type == 'elbv2':
+            day = self.parse_time(f"'{match.group(1)}'").date()
+            return (day, day)
+        match = re.fullmatch(rf'"?date"?\s+BETWEEN\s+{DATE_VALUE}\s+AND\s+{DATE_VALUE}', term, re.IGNORECASE)
+        if match and self.log_type == 'cloudfront':
+            start, end = self.parse_time(f"'{match.group(1)}'"), self.parse_time(f"'{match.group(2)}'")
+            return (start.date() if start else None, end.date() if end else None)
+        match = re.fullmatch(rf'"?date"?\s*(>=|>|<=|<|=)\s*{DATE_VALUE}', term, re.IGNORECASE)
+        if match and self.log_type == 'cloudfront':
+            value = self.parse_time(f"'{match.group(2)}'")
+            return self.get_bounds(match.group(1), value.date() if value else None)
+        return (None, None)
+
+    def get_bounds(self, operator, day):
+        side = COMPARISONS[operator]
+        return (day if side in ('lower', 'both') else None, day if side in ('upper', 'both') else None)
+
+    def get_branch_days(self, condition):
+        # Terms joined by AND narrow the days down, each branch joined by OR keeps its own days
+        branches = []
+        for branch in self.split(self.strip_parentheses(condition), 'OR'):
+            lower, upper = None, None
+            for term in self.split(self.strip_parentheses(branch), 'AND'):
+                term = self.strip_parentheses(term)
+                term_lower, term_upper = self.get_term_days(term)
+                if term_lower is None and term_upper is None and re.search(r'\bOR\b', term, re.IGNORECASE):
+                    term_lower, term_upper = self.get_hull(self.get_branch_days(term))
+                if term_lower and (lower is None or term_lower > lower):
+                    lower = term_lower
+                if term_upper and (upper is None or term_upper < upper):
+                    upper = term_upper
+            branches.append((lower, upper))
+        return branches
+
+    def get_hull(self, branches):
+        lower = None if any(branch[0] is None for branch in branches) else min(branch[0] for branch in branches)
+        upper = None if any(branch[1] is None for branch in branches) else max(branch[1] for branch in branches)
+        return lower, upper
+
+    def get_partition_predicate(self, condition):
+        branches = self.get_branch_days(condition)
+        lower, upper = self.get_hull(branches)
+        if lower is None and upper is None:
+            return None
+        column = self.partition_column
+        # The folder is the day a file was delivered, requests of the end of a day are in the folder of the next one
+        if all(branch_lower == branch_upper for branch_lower, branch_upper in branches):
+            days = sorted({day + timedelta(days=offset) for day, _ in branches for offset in (0, 1)})
+            return f"{column} IN ({', '.join(day.strftime(DAY_LITERAL) for day in days)})"
+        if lower and upper:
+            return f"{column} BETWEEN '{lower:%Y/%m/%d}' AND '{upper + timedelta(days=1):%Y/%m/%d}'"
+        if lower:
+            return f"{column} >= '{lower:%Y/%m/%d}'"
+        return f"{column} <= '{upper + timedelta(days=1):%Y/%m/%d}'"
+
+    def rewrite_comparisons(self, condition):
+        # time is a string column, comparing it with a timestamp fails in Athena and would parse every row.
+        # The bounds are turned into ISO strings once, the column is compared as it is stored
+        def rewrite_between(match):
+            start, end = self.parse_time(match.group(1)), self.parse_time(match.group(2))
+            if not start or not end:
+                return match.group(0)
+            return f"{self.time_expression} BETWEEN {self.format_time(start)} AND {self.format_time(end, upper=True)}"
+
+        def rewrite_comparison(match):
+            value = self.parse_time(match.group(2))
+            if not value:
+                return match.group(0)
+            return f"{self.time_expression} {match.group(1)} {self.format_time(value, upper=match.group(1) in ('<=', '>', '='))}"
+
+        condition = re.sub(rf'"?time"?\s+BETWEEN\s+{TIMESTAMP_VALUE}\s+AND\s+{TIMESTAMP_VALUE}', rewrite_between, condition, flags=re.IGNORECASE)
+        return re.sub(rf'"?time"?\s*(>=|>|<=|<|=)\s*{TIMESTAMP_VALUE}', rewrite_comparison, condition, flags=re.IGNORECASE)
+
+    def rewrite(self, query):
+        where = self.find_where(query)
+        if not where:
+            return query
+        start, end = where
+        condition = query[start:end].strip()
+        rewritten = self.rewrite_comparisons(condition)
+        partition_filtered = self.partition_column and re.search(rf'\b{re.escape(self.partition_column)}\b', condition, re.IGNORECASE)
+        predicate = None if not self.partition_column or partition_filtered else self.get_partition_predicate(condition)
+        if predicate:
+            rewritten = f"({rewritten}) AND {predicate}"
+        if rewritten == condition:
+            return query
+        return f"{query[:start]} {rewritten} {query[end:].lstrip()}".rstrip()
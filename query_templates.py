@@ -0,0 +1,96 @@
+from itertools import product
+import re
+
+# The table can't be a parameter and the time range decides which partitions are read, so these are written into the query
+INLINE_PLACEHOLDERS = {'athena_database', 'athena_table'}
+TIME_PLACEHOLDERS = {'start_time', 'end_time', 'start_date', 'end_date'}
+# Times are only written into the query when they can't close the string literal around them
+TIME_VALUE = re.compile(r'\d[\dT:. /-]*')
+NUMBER_VALUE = re.compile(r'-?\d+(\.\d+)?')
+# Several values separated by this character run the template once for each of them
+VALUE_SEPARATOR = '|'
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+def inline_parameters(query, parameters):
+    # Engines without execution parameters get the same literals written into the query
+    if not parameters:
+        return query
+    parts = re.split(r"('(?:[^']|'')*')", query)
+    remaining = list(parameters)
+    for i, part in enumerate(parts):
+        if not part.startswith("'"):
+            parts[i] = re.sub(r'\?', lambda match: remaining.pop(0), part)
+    return ''.join(parts)
+
+class QueryTemplates:
+    def __init__(self):
+        self.compiled = {}
+
+    def compile(self, template):
+        # Each placeholder outside the table name and time range becomes a ? bound at execution time, compiled once per template
+        if template in self.compiled:
+            return self.compiled[template]
+        parameters = []
+
+        def compile_literal(match):
+            type_name, literal = match.group(1), match.group(2)
+            names = [name for name in re.findall(r'@@@(\w+)@@@', literal) if name not in INLINE_PLACEHOLDERS | TIME_PLACEHOLDERS]
+            if not names:
+                return match.group(0)
+            parameters.append(('string', literal))
+            return f"CAST(? AS {type_name.strip().lower()})" if type_name else "?"
+
+        def compile_number(match):
+            if match.group(1) in INLINE_PLACEHOLDERS | TIME_PLACEHOLDERS:
+                return match.group(0)
+            parameters.append(('number', match.group(0)))
+            return "?"
+
+        # String literals first, so the placeholders left afterwards are the ones standing for numbers
+        parts = re.split(r"((?:\b(?:DATE|TIMESTAMP)\s+)?'(?:[^']|'')*')", template, flags=re.IGNORECASE)
+        for i, part in enumerate(parts):
+            if i % 2:
+                parts[i] = re.sub(r"^((?:DATE|TIMESTAMP)\s+)?'(.*)'$", compile_literal, part, flags=re.IGNORECASE | re.DOTALL)
+            else:
+                parts[i] = re.sub(r'@@@(\w+)@@@', compile_number, part)
+        self.compiled[template] = (''.join(parts), parameters)
+        return self.compiled[template]
+
+    def get_placeholders(self, template):
+        return list(dict.fromkeys(re.findall(r'@@@(\w+)@@@', template)))
+
+    def fill(self, text, values):
+        return re.sub(r'@@@(\w+)@@@', lambda match: values.get(match.group(1), match.group(0)), text)
+
+    def check_value(self, name, value):
+        if name in TIME_PLACEHOLDERS and not TIME_VALUE.fullmatch(value):
+            raise ValueError(f"{name} must be a date or time such as 2024-05-01 or 2024-05-01-10:00:00, got {value!r}")
+        return value
+
+    def bind(self, template, values, keep=()):
+        # Returns the query with the table and times written in and the literals of its parameters
+        query, specs = self.compile(template)
+        inline_values = {name: self.check_value(name, value) for name, value in values.items() if name not in keep}
+        parameters = []
+        for kind, text in specs:
+            value = self.fill(text, values)
+            if kind == 'number':
+                if not NUMBER_VALUE.fullmatch(value.strip()):
+                    raise ValueError(f"{text.strip('@')} must be a number, got {value!r}")
+                parameters.append(value.strip())
+            else:
+                parameters.append(quote_literal(value))
+        return self.fill(query, {name: value for name, value in inline_values.items() if name in INLINE_PLACEHOLDERS | TIME_PLACEHOLDERS}), parameters
+
+    def expand(self, values):
+        # One set of values per combination of the alternatives given with |
+        names = list(values)
+        alternatives = [[value.strip() for value in str(values[name]).split(VALUE_SEPARATOR)] for name in names]
+        variants = []
+        for combination in product(*alternatives):
+            variant = dict(zip(names, combination))
+            label = ', '.join(f"{name}={variant[name]}" for name, options in zip(names, alternatives) if len(options) > 1)
+            variants.append((label, variant))
+        return variants
@@ -0,0 +1,74 @@
+from settings import CACHE_DIR
+import hashlib
+import json
+import os
+import re
+import time
+
+class ResultCache:
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'results'), max_bytes=512 * 1024 * 1024, max_age_minutes=60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_minutes = max_age_minutes
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+
+    def normalize_query(self, query):
+        # Collapse whitespace and drop the trailing semicolon outside of string literals only
+        parts = re.split(r"('(?:[^']|'')*')", query.strip().rstrip(';').strip())
+        return ''.join(part if part.startswith("'") else re.sub(r'\s+', ' ', part) for part in parts)
+
+    def make_key(self, query, athena_database, athena_table, table_location, parameters=None):
+        key = [self.normalize_query(query), athena_database, athena_table, table_location]
+        if parameters:
+            key.append(list(parameters))
+        key = json.dumps(key)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        written = os.path.getmtime(path)
+        if time.time() - written > self.max_age_minutes * 60:
+            os.remove(path)
+            return None
+        import pandas as pd
+
+        try:
+            df = pd.read_pickle(path)
+        except Exception as e:
+            print(f"Error reading cached results: {e}")
+            os.remove(path)
+            return None
+        # The modification time records when the results were written, the access time drives the LRU eviction
+        os.utime(path, (time.time(), written))
+        return df
+
+    def put(self, key, df):
+        path = self.get_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error caching results: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_bytes -= size
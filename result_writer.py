@@ -0,0 +1,135 @@
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+OUTPUT_FORMATS = {
+    'table': 'txt',
+    'csv': 'csv',
+    'jsonl': 'jsonl',
+    'parquet': 'parquet',
+}
+
+class ResultWriter:
+    def __init__(self, filename, output_format='table', chunk_rows=10000):
+        self.filename = filename
+        self.output_format = output_format
+        self.chunk_rows = chunk_rows
+        self.file = None
+        self.parquet_writer = None
+        self.widths = None
+        self.rows_written = 0
+
+    def is_text(self):
+        return self.output_format != 'parquet'
+
+    def open(self):
+        if self.is_text():
+            self.file = open(self.filename, 'w')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.parquet_writer:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+    def format_column(self, values):
+        return values.astype(object).where(values.notna(), '').astype(str)
+
+    def set_widths(self, df):
+        # Widths come from the rows given here. write_dataframe gives the whole result so every chunk lines up with the header,
+        # a result written while it downloads is aligned on its first chunk and wider values overflow their column
+        # Headers get two characters of padding as in tabulate
+        self.widths = [max(len(str(df.index.name or '')) + 2, self.format_column(df.index.to_series()).str.len().max() if len(df) else 0)]
+        for name in df.columns:
+            self.widths.append(max(len(str(name)) + 2, self.format_column(df[name]).str.len().max() if len(df) else 0))
+
+    def write_table(self, df):
+        # tabulate's simple layout, columns separated by two spaces under a dash rule and numbers aligned right
+        import pandas as pd
+
+        if self.widths is None:
+            self.set_widths(df)
+        columns = [(df.index.to_series(), str(df.index.name or ''))] + [(df[name], str(name)) for name in df.columns]
+        right_aligned = [pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values) for values, _ in columns]
+        if self.rows_written == 0:
+            header = [name.rjust(width) if right else name.ljust(width) for (_, name), width, right in zip(columns, self.widths, right_aligned)]
+            self.file.write("  ".join(header).rstrip() + "\n")
+            self.file.write("  ".join('-' * width for width in self.widths) + "\n")
+        cells = []
+        for (values, _), width, right in zip(columns, self.widths, right_aligned):
+            values = self.format_column(values)
+            cells.append(values.str.rjust(width) if right else values.str.ljust(width))
+        if cells and len(df):
+            lines = cells[0].str.cat(cells[1:], sep="  ").str.rstrip()
+            self.file.write("\n".join(lines) + "\n")
+
+    def write_parquet(self, df):
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Parquet dictionary-encodes repeated values itself, per-chunk categories would give each chunk a different schema
+        df = df.astype({name: df[name].cat.categories.dtype for name in df.columns if isinstance(df[name].dtype, pd.CategoricalDtype)})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.filename, table.schema)
+        self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+
+    def write(self, df):
+        if self.file is None and self.parquet_writer is None and self.rows_written == 0:
+            self.open()
+        if self.output_format == 'table':
+            self.write_table(df)
+        elif self.output_format == 'csv':
+            df.to_csv(self.file, header=self.rows_written == 0, index=False)
+        elif self.output_format == 'jsonl':
+            if len(df):
+                output = df.to_json(orient='records', lines=True, date_format='iso')
+                self.file.write(output if output.endswith("\n") else output + "\n")
+        elif self.output_format == 'parquet':
+            self.write_parquet(df)
+        self.rows_written += len(df)
+        if self.file:
+            self.file.flush()
+
+    def write_dataframe(self, df):
+        if self.output_format == 'table':
+            self.set_widths(df)
+        try:
+            self.write(df.iloc[0:self.chunk_rows])
+            for start in range(self.chunk_rows, len(df), self.chunk_rows):
+                self.write(df.iloc[start:start + self.chunk_rows])
+        finally:
+            self.close()
+
+    def page(self, follow=None):
+        # follow tells whether the file is still being written, the built-in pager then waits for more lines at its end
+        pager = os.environ.get('PAGER') or (shutil.which('less') and 'less -S')
+        if sys.stdout.isatty() and pager:
+            # The external pager reads the file itself, nothing is loaded in this process
+            subprocess.call(f"{pager} {shlex.quote(self.filename)}", shell=True)
+            return
+        page_lines = shutil.get_terminal_size().lines - 1
+        with open(self.filename) as f:
+            i, line = 0, ''
+            while True:
+                # Checked before reading, so nothing written before the writer finished is missed
+                writing = follow is not None and follow()
+                line += f.readline()
+                if not line.endswith("\n"):
+                    if writing:
+                        time.sleep(0.2)
+                        continue
+                    if not line:
+                        break
+                sys.stdout.write(line)
+                line = ''
+                i += 1
+                if sys.stdout.isatty() and i % page_lines == 0:
+                    if input("-- More -- (Enter for the next page, q to quit) ").strip().lower() == 'q':
+                        break
@@ -0,0 +1,193 @@
+from client_pool import get_client
+from athena_utils import CLOUDFRONT_COLUMNS, ELBV2_COLUMNS
+from datetime import datetime, timedelta, timezone
+import botocore
+import json
+import re
+
+# Athena's INSERT INTO writes at most 100 partitions per query
+MAX_HOURS_PER_INSERT = 96
+# Grouping columns, the columns summed per hour, the expression giving the hour of a log line and how long the logs of an hour
+# keep arriving after it ends. ALBs deliver every 5 minutes, CloudFront up to a day late, later hours are read from the raw logs
+ROLLUPS = {
+    'elbv2': {
+        'dimensions': ['elb', 'client_ip', 'request_url', 'elb_status_code', 'target_status_code'],
+        'measures': ['received_bytes', 'sent_bytes'],
+        'hour': "substr(time, 1, 13)",
+        'required': 'client_ip',
+        'lag_hours': 2,
+    },
+    'cloudfront': {
+        'dimensions': ['date', 'x_edge_location', 'c_ip', 'cs_uri_stem', 'sc_status'],
+        'measures': ['sc_bytes', 'cs_bytes'],
+        'hour': "concat(CAST(date AS varchar), 'T', substr(time, 1, 2))",
+        'required': 'c_ip',
+        'lag_hours': 24,
+    },
+}
+# Words a query answered from the rollup may contain besides its columns and aliases
+SQL_KEYWORDS = {'select', 'from', 'where', 'and', 'or', 'not', 'like', 'in', 'between', 'is', 'null', 'as', 'group', 'by', 'order',
+                'asc', 'desc', 'limit', 'count', 'sum', 'distinct', 'date', 'true', 'false'}
+
+class RollupManager:
+    def __init__(self, session, query_executor, athena_database, source_table, partition_column, output_bucket, log_type, backfill_days=7):
+        self.session = session
+        self.query_executor = query_executor
+        self.athena_database = athena_database
+        self.source_table = source_table
+        self.partition_column = partition_column
+        self.log_type = log_type
+        self.rollup = ROLLUPS[log_type]
+        self.rollup_table = f"{source_table}_rollup"
+        # Queries answered from the rollup read this view, hours outside the low and high-water marks come from the raw logs
+        self.view_name = f"{source_table}_rollup_view"
+        self.output_location = f"s3://{output_bucket}/aws-athena-tool/rollups/{athena_database}/{self.rollup_table}"
+        self.backfill_days = backfill_days
+        self.watermark = None
+        self.low_watermark = None
+
+    def get_table_metadata(self, table):
+        athena_client = get_client(self.session, 'athena')
+        try:
+            return athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=self.athena_database, TableName=table)['TableMetadata']
+        except botocore.exceptions.ClientError:
+            return None
+
+    def get_watermark_key(self):
+        return self.query_executor.split_s3_uri(f"{self.output_location}/_watermark.json")
+
+    def load_watermark(self):
+        # Kept next to the rollup files, so everyone updating the same table agrees on it. Athena skips files starting with _
+        s3_client = get_client(self.session, 's3')
+        bucket, key = self.get_watermark_key()
+        try:
+            marks = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            marks = {}
+        self.watermark = marks.get('watermark')
+        self.low_watermark = marks.get('low_watermark')
+        return self.watermark
+
+    def save_watermark(self, watermark):
+        s3_client = get_client(self.session, 's3')
+        bucket, key = self.get_watermark_key()
+        marks = {'watermark': watermark, 'low_watermark': self.low_watermark, 'source_table': self.source_table}
+        s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(marks).encode())
+        self.watermark = watermark
+
+    def get_column_types(self):
+        columns = ELBV2_COLUMNS if self.log_type == 'elbv2' else CLOUDFRONT_COLUMNS
+        return {name: column_type.upper() for name, column_type in columns}
+
+    def create_rollup_table(self):
+        column_types = self.get_column_types()
+        columns = [(name, column_types[name]) for name in self.rollup['dimensions']]
+        columns += [('requests', 'BIGINT')] + [(name, 'BIGINT') for name in self.rollup['measures']]
+        column_definitions = ",\n                    ".join(f"`{name}` {column_type}" for name, column_type in columns)
+        query = f"""
+                CREATE EXTERNAL TABLE IF NOT EXISTS `{self.athena_database}`.`{self.rollup_table}` (
+                    {column_definitions}
+                    )
+                    PARTITIONED BY (`hour` STRING)
+                    STORED AS PARQUET
+                    LOCATION '{self.output_location}/'
+                    TBLPROPERTIES ('parquet.compression'='ZSTD')
+                """
+        return self.query_executor.execute_athena_query(query, template='rollup') is not None
+
+    def format_hour(self, hour):
+        return hour.strftime('%Y-%m-%dT%H')
+
+    def parse_hour(self, hour):
+        return datetime.strptime(hour, '%Y-%m-%dT%H')
+
+    def get_pending_hours(self):
+        # Only complete hours are rolled up, log times are in UTC
+        last_hour = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0) - timedelta(hours=self.rollup['lag_hours'])
+        if self.watermark:
+            current = self.parse_hour(self.watermark) + timedelta(hours=1)
+        else:
+            current = last_hour - timedelta(days=self.backfill_days) + timedelta(hours=1)
+        hours = []
+        while current <= last_hour:
+            hours.append(current)
+            current += timedelta(hours=1)
+        return hours
+
+    def delete_hour_objects(self, hours):
+        # A failed INSERT INTO can leave files behind, they would be counted twice once the hour is inserted again
+        s3_client = get_client(self.session, 's3')
+        bucket, prefix = self.query_executor.split_s3_uri(self.output_location)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for hour in hours:
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/hour={self.format_hour(hour)}/"):
+                objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+                if objects:
+                    s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+
+    def get_day_filter(self, first_hour, last_hour):
+        # The last hours of a day are delivered in the folder of the next one
+        return f"{self.partition_column} BETWEEN '{first_hour.strftime('%Y/%m/%d')}' AND '{(last_hour + timedelta(days=1)).strftime('%Y/%m/%d')}'"
+
+    def insert_hours(self, hours):
+        hour = self.rollup['hour']
+        dimensions = ", ".join(f'"{name}"' for name in self.rollup['dimensions'])
+        measures = ", ".join(f"sum({name}) AS {name}" for name in self.rollup['measures'])
+        query = f"""INSERT INTO "{self.athena_database}"."{self.rollup_table}" SELECT {dimensions}, count(*) AS requests, {measures}, {hour} AS hour FROM "{self.athena_database}"."{self.source_table}" WHERE {self.get_day_filter(hours[0], hours[-1])} AND {hour} BETWEEN '{self.format_hour(hours[0])}' AND '{self.format_hour(hours[-1])}' AND {self.rollup['required']} IS NOT NULL GROUP BY {hour}, {dimensions}"""
+        self.delete_hour_objects(hours)
+        return self.query_executor.execute_athena_query(query, template='rollup') is not None
+
+    def update_view(self):
+        dimensions = ", ".join(f'"{name}"' for name in self.rollup['dimensions'])
+        measures = ", ".join(self.rollup['measures'])
+        hour = self.rollup['hour']
+        low_day = (self.parse_hour(self.low_watermark) + timedelta(days=1)).strftime('%Y/%m/%d')
+        watermark_day = self.parse_hour(self.watermark).strftime('%Y/%m/%d')
+        raw_logs = f"""SELECT {hour} AS hour, {dimensions}, CAST(1 AS BIGINT) AS requests, {measures}, {self.partition_column} FROM "{self.athena_database}"."{self.source_table}" WHERE {self.rollup['required']} IS NOT NULL"""
+        # The days before the first rolled up hour still come from the raw logs, a query filtering on the day skips them
+        query = f"""CREATE OR REPLACE VIEW "{self.athena_database}"."{self.view_name}" AS {raw_logs} AND {self.partition_column} <= '{low_day}' AND {hour} < '{self.low_watermark}' UNION ALL SELECT hour, {dimensions}, requests, {measures}, replace(substr(hour, 1, 10), '-', '/') AS {self.partition_column} FROM "{self.athena_database}"."{self.rollup_table}" WHERE hour BETWEEN '{self.low_watermark}' AND '{self.watermark}' UNION ALL {raw_logs} AND {self.partition_column} >= '{watermark_day}' AND {hour} > '{self.watermark}'"""
+        return self.query_executor.execute_athena_query(query, template='rollup') is not None
+
+    def update(self):
+        if self.get_table_metadata(self.source_table) is None:
+            print(f"\033[91mTable {self.source_table} not found in {self.athena_database}.\033[00m")
+            return False
+        self.load_watermark()
+        pending = self.get_pending_hours()
+        print(f"\033[96m{len(pending)} hours to roll up, rolled up until {self.watermark or 'never'}.\033[00m")
+        if pending and not self.create_rollup_table():
+            return False
+        if pending and not self.low_watermark:
+            self.low_watermark = self.format_hour(pending[0])
+        updated = False
+        for start in range(0, len(pending), MAX_HOURS_PER_INSERT):
+            hours = pending[start:start + MAX_HOURS_PER_INSERT]
+            print(f"Rolling up {self.format_hour(hours[0])} to {self.format_hour(hours[-1])}...")
+            if not self.insert_hours(hours):
+                print(f"\033[91mError rolling up {self.format_hour(hours[0])} to {self.format_hour(hours[-1])}, stopping.\033[00m")
+                break
+            self.save_watermark(self.format_hour(hours[-1]))
+            updated = True
+        if self.watermark and (updated or self.get_table_metadata(self.view_name) is None):
+            return self.update_view()
+        return self.watermark is not None
+
+    def rewrite(self, query, table):
+        # Queries that only group and filter by rollup columns and count rows or sum bytes get the same answer from the rollup
+        source = f'"{self.athena_database}"."{table}"'
+        if not self.watermark or source not in query or not re.search(r'\b(count|sum)\s*\(', query, re.IGNORECASE):
+            return query
+        without_literals = re.sub(r"'[^']*'", "''", query.replace(source, ''))
+        aliases = {alias.lower() for alias in re.findall(r'\bAS\s+"?(\w+)"?', without_literals, re.IGNORECASE)}
+        columns = set(self.rollup['dimensions'] + self.rollup['measures'] + [self.partition_column])
+        identifiers = {word.lower() for word in re.findall(r'[A-Za-z_]\w*', without_literals)}
+        if identifiers - SQL_KEYWORDS - aliases - columns:
+            return query
+        if any(name.lower() not in self.rollup['measures'] for name in re.findall(r'\bsum\s*\(\s*(\w+)\s*\)', query, re.IGNORECASE)):
+            return query
+        if re.search(r'\bcount\s*\(\s*DISTINCT\b', query, re.IGNORECASE):
+            return query
+        query = re.sub(r'\bcount\s*\(\s*[\w*]+\s*\)', 'sum(requests)', query, flags=re.IGNORECASE)
+        return query.replace(source, f'"{self.athena_database}"."{self.view_name}"')
@@ -0,0 +1,166 @@
+from client_pool import get_client
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from query_history import QueryHistory, format_bytes
+from settings import CACHE_DIR
+import json
+import os
+import re
+import threading
+import time
+
+# Used until the query history has enough queries to measure the scan rate of this account
+DEFAULT_SCAN_RATE = 256 * 1024 ** 2
+MIN_RATE_SAMPLES = 3
+
+class ScanEstimator:
+    def __init__(self, session, table_location, partition_column=None, query_history=None, cache_path=os.path.join(CACHE_DIR, 'scan_estimates.json'),
+                 ttl=900, max_workers=16, split_depth=3):
+        self.session = session
+        self.table_location = table_location
+        self.partition_column = partition_column
+        self.query_history = query_history or QueryHistory()
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.split_depth = split_depth
+        self.lock = threading.Lock()
+        self.cache = self.load_cache()
+        self.scan_rate = None
+
+    def load_cache(self):
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error reading scan estimate cache: {e}")
+            return {}
+
+    def save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.cache, f)
+            os.replace(tmp_path, self.cache_path)
+
+    def get_cached(self, uri):
+        entry = self.cache.get(uri)
+        # Past days no longer receive logs, their size is cached for good
+        if entry and (entry['immutable'] or time.time() - entry['listed_at'] < self.ttl):
+            return entry['bytes'], entry['objects']
+        return None
+
+    def list_level(self, s3_client, bucket, prefix):
+        total_bytes, objects, sub_prefixes = 0, 0, []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                total_bytes += obj['Size']
+                objects += 1
+            sub_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        return total_bytes, objects, sub_prefixes
+
+    def list_all(self, s3_client, bucket, prefix):
+        total_bytes, objects = 0, 0
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                total_bytes += obj['Size']
+                objects += 1
+        return total_bytes, objects
+
+    def measure_prefix(self, uri, executor):
+        bucket, _, prefix = uri.replace('s3://', '', 1).partition('/')
+        s3_client = get_client(self.session, 's3')
+        total_bytes, objects = 0, 0
+        frontier = [prefix]
+        # Walk down year/month/day folders until there are enough prefixes to list them in parallel
+        for _ in range(self.split_depth):
+            if len(frontier) >= self.max_workers:
+                break
+            next_frontier = []
+            for level_bytes, level_objects, sub_prefixes in executor.map(lambda level_prefix: self.list_level(s3_client, bucket, level_prefix), frontier):
+                total_bytes += level_bytes
+                objects += level_objects
+                next_frontier.extend(sub_prefixes)
+            frontier = next_frontier
+            if not frontier:
+                break
+        for leaf_bytes, leaf_objects in executor.map(lambda leaf_prefix: self.list_all(s3_client, bucket, leaf_prefix), frontier):
+            total_bytes += leaf_bytes
+            objects += leaf_objects
+        return total_bytes, objects
+
+    def estimate_prefixes(self, prefixes):
+        # prefixes maps each S3 URI to whether its content can still change
+        total_bytes, objects = 0, 0
+        missing = []
+        for uri, immutable in prefixes.items():
+            cached = self.get_cached(uri)
+            if cached:
+                total_bytes += cached[0]
+                objects += cached[1]
+            else:
+                missing.append((uri, immutable))
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor, ThreadPoolExecutor(max_workers=min(len(missing), self.max_workers)) as prefix_executor:
+                for (uri, immutable), (prefix_bytes, prefix_objects) in zip(missing, prefix_executor.map(lambda item: self.measure_prefix(item[0], executor), missing)):
+                    self.cache[uri] = {'bytes': prefix_bytes, 'objects': prefix_objects, 'listed_at': time.time(), 'immutable': immutable}
+                    total_bytes += prefix_bytes
+                    objects += prefix_objects
+            self.save_cache()
+        return total_bytes, objects
+
+    def parse_day(self, value):
+        try:
+            return datetime.strptime(value.replace('-', '/'), '%Y/%m/%d')
+        except ValueError:
+            return None
+
+    def get_query_days(self, query):
+        if not self.partition_column:
+            return None
+        column = rf'"?{re.escape(self.partition_column)}"?'
+        values = []
+        for match in re.finditer(rf"{column}\s+BETWEEN\s+'([^']*)'\s+AND\s+'([^']*)'", query, re.IGNORECASE):
+            start, end = self.parse_day(match.group(1)), self.parse_day(match.group(2))
+            if not start or not end:
+                return None
+            while start <= end:
+                values.append(start)
+                start += timedelta(days=1)
+        for match in re.finditer(rf"{column}\s+IN\s*\(([^)]*)\)", query, re.IGNORECASE):
+            values.extend(self.parse_day(value) for value in re.findall(r"'([^']*)'", match.group(1)))
+        values.extend(self.parse_day(value) for value in re.findall(rf"{column}\s*=\s*'([^']*)'", query, re.IGNORECASE))
+        if not values or None in values:
+            return None
+        return sorted(set(values))
+
+    def estimate(self, query):
+        days = self.get_query_days(query)
+        if days is None:
+            return self.estimate_prefixes({self.table_location: False})
+        today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+        return self.estimate_prefixes({f"{self.table_location}{day.strftime('%Y/%m/%d')}/": day < today for day in days})
+
+    def get_scan_rate(self):
+        if self.scan_rate is None:
+            rates = sorted(entry['data_scanned_bytes'] / entry['engine_execution_ms'] * 1000 for entry in self.query_history.load()
+                           if entry.get('state') == 'SUCCEEDED' and entry.get('engine_execution_ms') and entry.get('data_scanned_bytes', 0) > 10 * 1024 ** 2)
+            self.scan_rate = rates[len(rates) // 2] if len(rates) >= MIN_RATE_SAMPLES else DEFAULT_SCAN_RATE
+        return self.scan_rate
+
+    def print_estimate(self, query, budget=None):
+        try:
+            scanned_bytes, objects = self.estimate(query)
+        except Exception as e:
+            print(f"Error estimating the scan size: {e}")
+            return None
+        seconds = scanned_bytes / self.get_scan_rate()
+        runtime = f"{seconds / 60:.1f} min" if seconds >= 60 else f"{seconds:.0f}s"
+        color = '\033[91m' if budget and scanned_bytes > budget else '\033[96m'
+        print(f"{color}Estimated scan: up to {format_bytes(scanned_bytes)} in {objects} objects, about {self.query_history.get_cost(scanned_bytes):.4f} USD and {runtime}.\033[00m")
+        return scanned_bytes
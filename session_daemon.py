@@ -0,0 +1,135 @@
+from aws_auth import SessionExpiredError
+from daemon_client import DaemonClient, SOCKET_PATH
+from logger import Logger
+import json
+import os
+import re
+import socketserver
+import threading
+
+# Rows sent back to the client, the full result is saved to a file by the daemon
+MAX_RESPONSE_ROWS = 1000
+
+class SessionDaemon:
+    def __init__(self, socket_path=SOCKET_PATH, max_rows=MAX_RESPONSE_ROWS):
+        self.socket_path = socket_path
+        self.max_rows = max_rows
+        self.logger = Logger()
+        self.lock = threading.Lock()
+        self.workspaces = {}
+        self.workspace_locks = {}
+        self.server = None
+
+    def get_workspace_key(self, request):
+        return (request.get('profile'), request.get('region'), request.get('log_type'), request.get('selected_resource'),
+                bool(request.get('fleet')), tuple(request.get('scan_regions') or ()))
+
+    def get_workspace(self, request):
+        # Authentication, discovery and table setup run once per resource, later queries go straight to Athena
+        key = self.get_workspace_key(request)
+        with self.lock:
+            workspace_lock = self.workspace_locks.setdefault(key, threading.Lock())
+        with workspace_lock:
+            if key not in self.workspaces:
+                from aws_log_analyzer import AWSLogAnalyzer
+
+                if not request.get('profile') or not request.get('region') or request.get('log_type') not in ('cloudfront', 'elbv2'):
+                    raise ValueError("profile, region and log_type (cloudfront or elbv2) are required")
+                if not request.get('selected_resource') and not request.get('fleet'):
+                    raise ValueError("selected_resource or fleet is required")
+                analyzer = AWSLogAnalyzer(profile=request['profile'], region=request['region'], log_type=request['log_type'],
+                                          selected_resource=request.get('selected_resource'), fleet=bool(request.get('fleet')),
+                                          scan_regions=request.get('scan_regions'))
+                self.logger.log(f"Preparing {request['log_type']} {request.get('selected_resource') or 'fleet'} for profile {request['profile']}...", "cyan")
+                prepared = analyzer.prepare_fleet() if analyzer.fleet else analyzer.prepare_with_arguments()
+                if not prepared:
+                    raise ValueError("the resource could not be prepared, see the daemon output")
+                self.workspaces[key] = analyzer
+            return self.workspaces[key]
+
+    def drop_workspace(self, request):
+        with self.lock:
+            self.workspaces.pop(self.get_workspace_key(request), None)
+
+    def get_missing_values(self, analyzer, query, values):
+        placeholders = set(re.findall(r'@@@(\w+)@@@', query)) - {'athena_table'}
+        return sorted(name for name in placeholders if getattr(analyzer, name, None) is None and name not in values)
+
+    def run_query(self, request):
+        analyzer = self.get_workspace(request)
+        query_choice = str(request.get('query_choice') or '1')
+        query = request.get('query') or analyzer.queries[analyzer.log_type].get(query_choice)
+        if not query or query_choice == '0':
+            raise ValueError(f"unknown query {query_choice}")
+        values = request.get('values') or {}
+        # Nobody can answer a prompt in the daemon, every placeholder needs a value in the request
+        missing = self.get_missing_values(analyzer, query, values)
+        if missing:
+            raise ValueError(f"missing values for {', '.join(missing)}")
+        try:
+            df = analyzer.run_query(query, query_choice, dict(values))
+        except SessionExpiredError:
+            # The cached session can't be used anymore, the next request prepares the workspace again after a new MFA code
+            self.drop_workspace(request)
+            raise
+        if df is None:
+            raise ValueError("the query failed, see the daemon output")
+        from result_writer import ResultWriter
+
+        filename = analyzer.query_executor.get_output_filename(query_choice)
+        ResultWriter(filename, request.get('output_format') or analyzer.query_executor.output_format).write_dataframe(df)
+        result = json.loads(df.head(request.get('max_rows') or self.max_rows).to_json(orient='split', index=False, date_format='iso'))
+        return {'status': 'ok', 'columns': result['columns'], 'rows': result['data'], 'total_rows': len(df), 'file': filename}
+
+    def get_status(self):
+        return {'status': 'ok', 'workspaces': [{'profile': key[0], 'region': key[1], 'log_type': key[2], 'selected_resource': key[3], 'fleet': key[4],
+                                                'table': f"{analyzer.athena_database}.{analyzer.athena_table}"}
+                                               for key, analyzer in list(self.workspaces.items())]}
+
+    def handle(self, request):
+        command = request.get('command', 'query')
+        if command == 'query':
+            return self.run_query(request)
+        if command == 'status':
+            return self.get_status()
+        if command == 'shutdown':
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return {'status': 'ok'}
+        raise ValueError(f"unknown command {command}")
+
+    def serve(self):
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # One JSON request per line, answered with one JSON line
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except Exception as e:
+                        print(f"Error handling request: {e}")
+                        response = {'status': 'error', 'error': str(e)}
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            if DaemonClient(self.socket_path).is_running():
+                self.logger.log(f"A daemon is already listening on {self.socket_path}.", "red")
+                return
+            os.remove(self.socket_path)
+        # Only the owner can connect, the socket gives access to the authenticated session
+        old_umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+        self.logger.log(f"Listening on {self.socket_path}, press Ctrl-C to stop.", "green")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
@@ -0,0 +1,3 @@
+import os
+
+CACHE_DIR = os.environ.get('AWS_ATHENA_TOOL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'aws-athena-tool'))
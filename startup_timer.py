@@ -0,0 +1,41 @@
+from time import perf_counter
+import os
+
+STARTUP_TARGET_MS = int(os.environ.get('AWS_ATHENA_TOOL_STARTUP_TARGET_MS', 1000))
+
+class StartupTimer:
+    def __init__(self, target_ms=STARTUP_TARGET_MS):
+        self.started = perf_counter()
+        self.target_ms = target_ms
+        self.enabled = os.environ.get('AWS_ATHENA_TOOL_STARTUP_TIMING') == '1'
+        self.stages = [('interpreter', self.get_process_age())]
+        self.reported = False
+
+    def get_process_age(self):
+        # Time spent before this module was imported, read from /proc so the interpreter startup is counted too
+        try:
+            with open('/proc/self/stat') as f:
+                start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+            return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+        except Exception:
+            return 0.0
+
+    def mark(self, stage):
+        elapsed = perf_counter() - self.started
+        self.stages.append((stage, elapsed - sum(duration for _, duration in self.stages[1:])))
+
+    def report(self):
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        self.mark('ready')
+        print("\033[96mStartup timing:\033[00m")
+        for stage, duration in self.stages:
+            print(f"  {stage:<16}{duration * 1000:>9.1f} ms")
+        total = sum(duration for _, duration in self.stages) * 1000
+        color = '\033[92m' if total <= self.target_ms else '\033[91m'
+        print(f"{color}  {'total':<16}{total:>9.1f} ms (target {self.target_ms} ms)\033[00m")
+
+startup_timer = StartupTimer()
@@ -0,0 +1,98 @@
+from client_pool import get_client
+from settings import CACHE_DIR
+import botocore
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Tables dropped outside the tool are noticed after this long at the latest
+CATALOG_TTL_HOURS = 24
+
+class TableCatalog:
+    def __init__(self, session, path=os.path.join(CACHE_DIR, 'catalog.json'), ttl_hours=CATALOG_TTL_HOURS):
+        self.session = session
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error reading catalog cache: {e}")
+            return {}
+
+    def save(self):
+        # Called with the lock held, another thread changing the entries during the dump would break it
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get_key(self, database, table=None):
+        # Profiles of different accounts can use the same database and table names
+        key = f"{self.session.profile_name}/{self.session.region_name}/{database}"
+        return f"{key}/{table}" if table else key
+
+    def get_signature(self, location, columns, partition_keys):
+        definition = {'location': location.rstrip('/'), 'columns': [[name, column_type.lower()] for name, column_type in columns],
+                      'partition_keys': list(partition_keys)}
+        return hashlib.sha256(json.dumps(definition).encode()).hexdigest()
+
+    def is_known(self, key, signature=None):
+        entry = self.entries.get(key)
+        return entry is not None and entry.get('signature') == signature and time.time() - entry['checked_at'] < self.ttl
+
+    def remember(self, key, signature=None):
+        with self.lock:
+            self.entries[key] = {'signature': signature, 'checked_at': time.time()}
+            self.save()
+
+    def database_created(self, database):
+        self.remember(self.get_key(database))
+
+    def forget(self, database, table=None):
+        with self.lock:
+            if self.entries.pop(self.get_key(database, table), None) is not None:
+                self.save()
+
+    def database_exists(self, database):
+        key = self.get_key(database)
+        if self.is_known(key):
+            return True
+        athena_client = get_client(self.session, 'athena')
+        try:
+            athena_client.get_database(CatalogName='AwsDataCatalog', DatabaseName=database)
+        except botocore.exceptions.ClientError:
+            return False
+        self.remember(key)
+        return True
+
+    def get_table_state(self, database, table, location, columns, partition_keys=()):
+        # 'current' when the table exists with this location and schema, 'missing' or 'different' otherwise
+        key = self.get_key(database, table)
+        signature = self.get_signature(location, columns, partition_keys)
+        if self.is_known(key, signature):
+            return 'current'
+        athena_client = get_client(self.session, 'athena')
+        try:
+            metadata = athena_client.get_table_metadata(CatalogName='AwsDataCatalog', DatabaseName=database, TableName=table)['TableMetadata']
+        except botocore.exceptions.ClientError:
+            return 'missing'
+        existing_location = metadata.get('Parameters', {}).get('location', location)
+        existing_columns = [(column['Name'], column['Type']) for column in metadata.get('Columns', [])]
+        existing_partition_keys = [column['Name'] for column in metadata.get('PartitionKeys', [])]
+        if self.get_signature(existing_location, existing_columns, existing_partition_keys) != signature:
+            return 'different'
+        self.remember(key, signature)
+        return 'current'
+
+    def table_created(self, database, table, location, columns, partition_keys=()):
+        self.remember(self.get_key(database, table), self.get_signature(location, columns, partition_keys))